@@ -4,14 +4,33 @@ Team Peacock.
 """
 
 
+import os
 import sys
-import psycopg2
+import json
+import socket
 import struct
 import hashlib
+import threading
 from time import time
-from psycopg2 import sql
-from sshtunnel import SSHTunnelForwarder
-from datetime import datetime, timezone
+from contextlib import contextmanager, ExitStack
+from datetime import date, datetime, timedelta, timezone
+from result_cache import ResultCache
+from unit_of_work import GroupCommitter
+from watch_journal import WatchJournal
+from autocomplete import PrefixIndex, load_catalog
+from fuzzy_search import NGramIndex, pg_candidates, rank
+from search_planner import SelectivityCache, matching_mids, parse_filter
+from als import FactorModel
+from social_graph import SocialGraph
+from prefetch import Prefetcher
+from session_state import SessionState
+from db_router import Router, routed
+from renderer import render
+from name_dictionary import NameDictionary
+from popularity_sketch import PopularitySketch
+
+# psycopg2 and sshtunnel are imported on first database use (they dominate
+# start-up time, see benchmarks/bench_startup.py)
 
 
 # movie selection query macro (this is often needed throughout the program, so
@@ -23,7 +42,7 @@ MOVIE_QUERY = """SELECT movie.mid, movie.title,
                 movie.length, movie.rating, 
                 ARRAY_AGG(DISTINCT genre.name) AS genres, 
                 ARRAY_AGG(DISTINCT release.releasedate) AS release_dates,
-                ROUND(AVG(rates.rating), 3) as user_rating
+                ROUND(movie.rating_sum::NUMERIC / NULLIF(movie.rating_count, 0), 3) AS user_rating
                 FROM movie
                 LEFT JOIN release ON movie.mid = release.mid 
                 LEFT JOIN makesmovie ON movie.mid = makesmovie.mid 
@@ -33,8 +52,479 @@ MOVIE_QUERY = """SELECT movie.mid, movie.title,
                 LEFT JOIN person actors ON actsin.peid = actors.peid
                 LEFT JOIN person directors ON directs.peid = directors.peid
                 LEFT JOIN moviegenre ON movie.mid = moviegenre.mid
-                LEFT JOIN genre ON moviegenre.gid = genre.gid
-                LEFT JOIN rates ON movie.mid = rates.mid"""
+                LEFT JOIN genre ON moviegenre.gid = genre.gid"""
+# the average user rating is read from movie.rating_sum / rating_count, kept
+# up to date by triggers on rates (migrations/0008_movie_rating_aggregates.sql)
+
+
+# MOVIE_QUERY variant returning person, studio and genre ids instead of names
+# (same columns); the names are resolved locally by NAME_DICTIONARY
+MOVIE_ID_QUERY = """SELECT movie.mid, movie.title, 
+                ARRAY_AGG(DISTINCT actsin.peid) AS cast_members, 
+                ARRAY_AGG(DISTINCT directs.peid) AS directs,
+                ARRAY_AGG(DISTINCT makesmovie.prid) AS studios, 
+                movie.length, movie.rating, 
+                ARRAY_AGG(DISTINCT moviegenre.gid) AS genres, 
+                ARRAY_AGG(DISTINCT release.releasedate) AS release_dates,
+                ROUND(movie.rating_sum::NUMERIC / NULLIF(movie.rating_count, 0), 3) AS user_rating
+                FROM movie
+                LEFT JOIN release ON movie.mid = release.mid 
+                LEFT JOIN makesmovie ON movie.mid = makesmovie.mid 
+                LEFT JOIN actsin ON movie.mid = actsin.mid 
+                LEFT JOIN directs ON movie.mid = directs.mid
+                LEFT JOIN moviegenre ON movie.mid = moviegenre.mid"""
+MOVIE_ID_COLUMNS = ((2, "person"), (3, "person"), (4, "studio"), (7, "genre"))
+# (column, dictionary kind) of each id array
+
+
+# local name dictionary when PDM_NAME_IDS=1 (see name_dictionary.py); listings
+# then run MOVIE_ID_QUERY as MOVIE_QUERY. PDM_NAME_CACHE sets the file keeping
+# the names between runs
+NAME_DICTIONARY = None
+
+if os.environ.get("PDM_NAME_IDS") == "1":
+    NAME_DICTIONARY = NameDictionary(os.environ.get("PDM_NAME_CACHE",
+                                                    os.path.join(os.path.expanduser("~"), ".pdm_names.json")))
+    MOVIE_QUERY = MOVIE_ID_QUERY
+
+
+def resolve_names(rows: list, conn) -> list:
+    """
+    Resolves the id arrays of MOVIE_QUERY rows to names (in id mode).
+    """
+    
+    if NAME_DICTIONARY is None:
+        return rows
+        
+    return NAME_DICTIONARY.resolve_rows(rows, MOVIE_ID_COLUMNS, conn)
+
+
+# watch history macro (watches is partitioned by month and old partitions are
+# rolled up into watches_user_monthly, so queries over the full history read
+# both; each row carries its number of plays)
+WATCH_HISTORY = """(SELECT username, mid, watchdate, 1 AS plays FROM watches
+                UNION ALL
+                SELECT username, mid, month AS watchdate, plays FROM watches_user_monthly)"""
+
+
+# shared cache for results that are the same for every user (leaderboards);
+# PDM_CACHE_TTL sets the lifetime in seconds, PDM_CACHE_FILE an optional
+# file that keeps the cache warm across restarts and PDM_CACHE_METRICS=1
+# prints its hit rates on exit
+LEADERBOARD_CACHE = ResultCache(float(os.environ.get("PDM_CACHE_TTL", "300")),
+                                os.environ.get("PDM_CACHE_FILE"))
+CACHE_METRICS = os.environ.get("PDM_CACHE_METRICS") == "1"
+
+
+
+# group committer shared by all write paths (see start_group_commit); None
+# means every write commits on the caller's connection
+WRITE_COMMITTER = None
+
+
+def start_group_commit(get_params) -> bool:
+    """
+    Routes all writes through a GroupCommitter if PDM_GROUP_COMMIT is set.
+    
+    PDM_GROUP_COMMIT_DELAY_MS sets the latency bound of a group (default 5)
+    and PDM_DURABILITY the durability mode (strict, relaxed or async). Async
+    writes report success as soon as they are queued; the in-memory caches
+    only follow them once they commit (see after_commit).
+    
+    :param get_params: function returning psycopg2 connection parameters
+        (only called once the first write arrives)
+    :return: True if group commit is enabled; the session connection then
+        only reads and should run in autocommit mode
+    """
+    
+    global WRITE_COMMITTER
+    
+    if not os.environ.get("PDM_GROUP_COMMIT"):
+        return False
+        
+    import psycopg2
+    
+    WRITE_COMMITTER = GroupCommitter(
+        lambda: psycopg2.connect(**get_params()),
+        max_delay=float(os.environ.get("PDM_GROUP_COMMIT_DELAY_MS", "5")) / 1000,
+        durability=os.environ.get("PDM_DURABILITY", "strict"))
+    return True
+
+
+def queued_writes() -> bool:
+    """
+    Checks whether execute_write returns before its write is committed
+    (PDM_DURABILITY=async), so its row count is only a guess.
+    """
+    
+    return WRITE_COMMITTER is not None and WRITE_COMMITTER.durability == "async"
+    
+    
+def after_commit(func) -> None:
+    """
+    Applies the last write to an in-memory cache once it has committed.
+    
+    Runs func now, or for a queued write on the committer thread once the
+    write has committed and changed a row (never if it fails).
+    """
+    
+    if not queued_writes():
+        func()
+        return
+        
+    WRITE_COMMITTER.when_done(lambda rowcount, error: func() if error is None and rowcount == 1 else None)
+
+
+
+# write-behind journal for watches (see start_watch_journal); None means
+# watch_movie inserts directly
+WATCH_JOURNAL = None
+
+
+def start_watch_journal(get_params) -> None:
+    """
+    Records watches through a WatchJournal if PDM_WATCH_JOURNAL is set.
+    
+    PDM_WATCH_JOURNAL is the directory holding the journal files.
+    
+    :param get_params: function returning psycopg2 connection parameters
+    """
+    
+    global WATCH_JOURNAL
+    
+    directory = os.environ.get("PDM_WATCH_JOURNAL")
+    
+    if not directory:
+        return
+        
+    import psycopg2
+    
+    WATCH_JOURNAL = WatchJournal(directory, lambda: psycopg2.connect(**get_params()))
+        
+        
+# background prefetcher of likely-next screens when PDM_PREFETCH=1 (see
+# prefetch.py); None runs every query when its screen is shown.
+# PDM_PREFETCH_MAX_AGE bounds the age of a prefetched result in seconds
+PREFETCHER = None
+PREFETCH_COLLECTIONS = 3
+# collections whose movies are prefetched when the collection menu opens
+
+
+def start_prefetch(get_params) -> None:
+    """
+    Starts a Prefetcher if PDM_PREFETCH=1.
+    
+    :param get_params: function returning psycopg2 connection parameters
+    """
+    
+    global PREFETCHER
+    
+    if os.environ.get("PDM_PREFETCH") != "1":
+        return
+        
+    import psycopg2
+    
+    PREFETCHER = Prefetcher(lambda: psycopg2.connect(**get_params()),
+                            max_age=float(os.environ.get("PDM_PREFETCH_MAX_AGE", "30")))
+    
+    
+def prefetched(key, func, *args, conn):
+    """
+    Gets func(*args, conn), prefetched under key if available.
+    """
+    
+    if PREFETCHER is None:
+        return func(*args, conn)
+        
+    return PREFETCHER.take(key, func, *args, conn=conn)
+    
+    
+def prefetch(key, func, *args) -> None:
+    """
+    Starts func(*args, conn) in the background if prefetching is enabled.
+    """
+    
+    if PREFETCHER is not None:
+        PREFETCHER.prefetch(key, func, *args)
+        
+        
+# per-session cache of the user's collections, collection movies and friends
+# (see session_state.py), updated in place by the write functions;
+# PDM_SESSION_TTL bounds its age in seconds and PDM_VERIFY_SESSION=1 checks
+# it against the database after every update
+SESSION_STATE = SessionState(float(os.environ.get("PDM_SESSION_TTL", "300")))
+VERIFY_SESSION = os.environ.get("PDM_VERIFY_SESSION") == "1"
+
+
+def session_collections(username: str, conn) -> list:
+    """
+    Gets the user's collections, from the session cache when possible.
+    """
+    
+    return SESSION_STATE.get(username, "collections",
+        lambda: prefetched(("collections", username), get_collections, username, conn=conn))
+        
+        
+def session_collection_movies(username: str, collection: tuple, sort_op: int, order_by: str, conn) -> list:
+    """
+    Gets a collection's movies, from the session cache when possible.
+    """
+    
+    if sort_clause(sort_op, "ASC", "sk") is None:
+        sort_op = 0
+        # find_from_collection falls back to the default ordering
+    order_by = "a" if order_by == "a" else "d"
+    
+    if (sort_op, order_by) == (0, "a"):
+        load = lambda: prefetched(("collection", collection[0]), find_from_collection,
+                                  username, collection, sort_op, order_by, conn=conn)
+        # the default sort may have been prefetched
+    else:
+        load = lambda: find_from_collection(username, collection, sort_op, order_by, conn)
+        
+    return SESSION_STATE.get(username, ("collection", collection[0], sort_op, order_by), load)
+    
+    
+def session_friends(username: str, conn) -> list:
+    """
+    Gets the user's friends, from the session cache when possible.
+    """
+    
+    return SESSION_STATE.get(username, "friends", lambda: get_friends(username, conn))
+    
+    
+def verify_session(username: str, conn) -> list:
+    """
+    Compares the user's cached collections, collection movies and friends
+    with fresh query results, printing any mismatch.
+    
+    :return: a list of (key, cached list, fresh list) for each mismatch
+    """
+    
+    def load(key):
+        if key == "collections":
+            return get_collections(username, conn)
+        if key == "friends":
+            return get_friends(username, conn)
+        return find_from_collection(username, (key[1],), key[2], key[3], conn)
+        
+    mismatches = SESSION_STATE.verify(username, load)
+    
+    for key, cached, fresh in mismatches:
+        print("SESSION CACHE MISMATCH", key, "cached:", cached, "fresh:", fresh)
+        
+    return mismatches
+    
+    
+def collection_movie_keys(cid: int):
+    """
+    Matches the session cache keys of a collection's movie lists (one per sort).
+    """
+    
+    return lambda key: isinstance(key, tuple) and key[:2] == ("collection", cid)
+    
+    
+def collection_with_movie(rows: list, cid: int, length) -> list:
+    """
+    Updates get_collections rows for a movie added to collection cid.
+    
+    Like the query, minutes are 0 for an empty collection and NULL while
+    none of its movies has a length.
+    """
+    
+    updated = []
+    
+    for row in rows:
+        if row[0] == cid:
+            if row[2] == 0 or row[3] is None:
+                minutes = length
+            else:
+                minutes = row[3] + (length or 0)
+            row = (row[0], row[1], row[2] + 1, minutes)
+        updated.append(row)
+        
+    return updated
+    
+    
+def collection_without_movie(rows: list, cid: int, length) -> list:
+    """
+    Updates get_collections rows for a movie removed from collection cid.
+    
+    :return: the new rows, or None if the minutes cannot be told (the
+        remaining movies may all lack a length, which the query shows as NULL)
+    """
+    
+    updated = []
+    
+    for row in rows:
+        if row[0] == cid:
+            if row[2] == 1:
+                minutes = 0
+            elif length is None:
+                minutes = row[3]
+            elif row[3] is not None and row[3] != length:
+                minutes = row[3] - length
+            else:
+                return None
+            row = (row[0], row[1], row[2] - 1, minutes)
+        updated.append(row)
+        
+    return updated
+    
+    
+def session_update(username: str, match, func, conn) -> None:
+    """
+    Applies a write to the matching cached lists (see SessionState.update).
+    
+    A queued write may still fail, so its lists are dropped instead.
+    """
+    
+    if queued_writes():
+        session_drop(username, match, conn)
+        return
+        
+    SESSION_STATE.update(username, match, func)
+    
+    if VERIFY_SESSION:
+        verify_session(username, conn)
+        
+        
+def session_drop(username: str, match, conn) -> None:
+    """
+    Drops cached lists a write changed in a way that cannot be applied.
+    """
+    
+    SESSION_STATE.drop(username, match)
+    
+    if queued_writes():
+        WRITE_COMMITTER.when_done(lambda rowcount, error: SESSION_STATE.drop(username, match))
+        # lists reloaded before the queued write commits still miss it
+    elif VERIFY_SESSION:
+        verify_session(username, conn)
+        
+
+# read/write router when PDM_REPLICA_DSNS is set (see db_router.py); None
+# runs every query on the session connection
+ROUTER = None
+
+
+def start_router() -> None:
+    """
+    Routes reads to replicas if PDM_REPLICA_DSNS is set.
+    
+    PDM_REPLICA_DSNS is a comma-separated list of libpq connection strings
+    of streaming replicas of the session's database (the primary), and
+    PDM_STICKY_SECONDS bounds how long a user's reads stay on the primary
+    after the user's write (default 30).
+    """
+    
+    global ROUTER
+    
+    replicas = [dsn.strip() for dsn in os.environ.get("PDM_REPLICA_DSNS", "").split(",") if dsn.strip()]
+    
+    if not replicas:
+        return
+        
+    import psycopg2
+    
+    ROUTER = Router(replicas, psycopg2.connect, sticky=float(os.environ.get("PDM_STICKY_SECONDS", "30")))
+
+
+# approximate leaderboards when PDM_POPULARITY=sketch (see popularity_sketch.py):
+# watch_movie records each watch in the shared per-day sketches and the
+# overall top 20 and top 5 new releases are ranked from them.
+# PDM_SKETCH_EPSILON / PDM_SKETCH_DELTA bound the play count error and
+# PDM_SKETCH_HEAVY sets the movies tracked per day; every session and
+# build_popularity.py must use the same values
+POPULARITY = None
+
+
+def new_popularity_sketch() -> PopularitySketch:
+    """
+    Makes a PopularitySketch with the PDM_SKETCH_* parameters.
+    """
+    
+    return PopularitySketch(float(os.environ.get("PDM_SKETCH_EPSILON", "0.01")),
+                            float(os.environ.get("PDM_SKETCH_DELTA", "0.01")),
+                            int(os.environ.get("PDM_SKETCH_HEAVY", "100")))
+
+
+if os.environ.get("PDM_POPULARITY") == "sketch":
+    POPULARITY = new_popularity_sketch()
+    
+POPULARITY_FAILURES = 0
+# consecutive failed flushes
+MAX_POPULARITY_FAILURES = 3
+# failed flushes in a row after which the session stops using the sketches
+
+
+def record_popularity(username: str, movie_id: int, when: datetime, conn) -> None:
+    """
+    Records a watch in the popularity sketches, flushing them when due.
+    """
+    
+    global POPULARITY, POPULARITY_FAILURES
+    
+    if POPULARITY is None or not POPULARITY.record(movie_id, username, when):
+        return
+        
+    try:
+        POPULARITY.flush(conn)
+        POPULARITY_FAILURES = 0
+    except Exception as e:
+        POPULARITY_FAILURES += 1
+        print("Popularity sketch flush failed: " + str(e))
+        # the watches stay pending and are flushed with the next ones
+        
+        if POPULARITY_FAILURES >= MAX_POPULARITY_FAILURES:
+            POPULARITY = None
+            print("Popularity sketches disabled for this session, leaderboards are counted exactly")
+            # a persistent failure (e.g. sketch parameters that differ from
+            # the stored windows) would otherwise grow the pending windows
+            # without limit; build_popularity.py --rebuild restores them
+
+
+def flush_popularity(conn) -> None:
+    """
+    Flushes the session's pending watches into the popularity sketches.
+    """
+    
+    if POPULARITY is None or conn is None or not POPULARITY.pending_watches:
+        return
+        
+    try:
+        POPULARITY.flush(conn)
+    except Exception:
+        print("Something went wrong")
+        # the pending watches are still in watches; build_popularity.py
+        # --rebuild restores them in the sketches
+
+
+reads = routed("read", lambda: ROUTER)
+writes = routed("write", lambda: ROUTER)
+# query function tags; reads may run on a replica, writes run on the primary
+
+
+def execute_write(query: str, params: tuple, conn) -> int:
+    """
+    Runs and commits a write, through the group committer when enabled.
+    
+    :return: the number of rows written
+    """
+    
+    if PREFETCHER is not None:
+        PREFETCHER.invalidate()
+        # prefetched screens may predate this write
+        
+    if WRITE_COMMITTER is not None:
+        return WRITE_COMMITTER.execute(query, params)
+        
+    curs = conn.cursor()
+    curs.execute(query, params)
+    rowcount = curs.rowcount
+    conn.commit()
+    curs.close()
+    return rowcount
                 
                 
 def generate_access_code(password, SALT) -> str:
@@ -48,6 +538,7 @@ def generate_access_code(password, SALT) -> str:
     return hashlib.sha3_256(byte_code).hexdigest()
 
 
+@writes
 def login(username: str, password: str, conn) -> bool:
     """
     Logs a user into the database.
@@ -66,11 +557,9 @@ def login(username: str, password: str, conn) -> bool:
     curs.execute(query)
 
     if curs.rowcount == 1:
-        query = f"""UPDATE "User" SET last_access_date = CURRENT_TIMESTAMP WHERE username='{username}' 
-                    AND access_code='{access_code}'"""
-        curs.execute(query)
-        conn.commit()
         curs.close()
+        execute_write("""UPDATE "User" SET last_access_date = CURRENT_TIMESTAMP WHERE username=%s
+                      AND access_code=%s""", (username, access_code), conn)
         print("Accessed " + username + "'s account on " + str(datetime.now(timezone.utc)))
         return True
 
@@ -79,6 +568,7 @@ def login(username: str, password: str, conn) -> bool:
     return False
 
 
+@writes
 def register(username: str, password: str, email: str, firstname: str, lastname: str, SALT: str, conn) -> bool:
     """
     Registers a new user with the database.
@@ -87,23 +577,141 @@ def register(username: str, password: str, email: str, firstname: str, lastname:
     """
     
     access_code = generate_access_code(password, SALT)
-    curs = conn.cursor()
 
-    while True:
-        query = f"""INSERT INTO "User" (username, access_code, email, firstname, lastname, SALT
-                ) VALUES ('{username}', '{access_code}', '{email}', '{firstname}', '{lastname}', '{SALT}')"""
-        curs.execute(query)
-        conn.commit()
-        if curs.rowcount == 1:
-            curs.close()
-            print("User Registered")
-            return True
-        else:
-            curs.close()
-            print("The username you entered is already used. Please try again.")
+    rowcount = execute_write("""INSERT INTO "User" (username, access_code, email, firstname, lastname, SALT
+                             ) VALUES (%s, %s, %s, %s, %s, %s)""",
+                             (username, access_code, email, firstname, lastname, SALT), conn)
+                             
+    if rowcount == 1:
+        print("User Registered")
+        return True
+        
+    print("The username you entered is already used. Please try again.")
+    return False
+
+
+def sort_clause(sort_op: int, order_by: str, alias: str) -> str:
+    """
+    Builds the ORDER BY clause for a sort option.
+    
+    Sorts on the indexed movie_sort_keys columns (normalized title, primary
+    studio, primary genre, first release date) aliased as alias, with the
+    mid as a final tie-breaker so pages are stable.
+    
+    :param sort_op: sort option (see find_movies)
+    :param order_by: "ASC" or "DESC"
+    :return: the ORDER BY clause, or None for an unknown sort option
+    """
+    
+    match sort_op:
+        case 0:
+            keys = f"{alias}.title_key, {alias}.first_release {order_by}"
+        case 1:
+            keys = f"{alias}.title_key {order_by}"
+        case 2:
+            keys = f"{alias}.primary_studio {order_by}, {alias}.title_key"
+        case 3:
+            keys = f"{alias}.primary_genre {order_by}, {alias}.title_key"
+        case 4:
+            keys = f"{alias}.first_release {order_by}, {alias}.title_key"
+        case _:
+            return None
+            
+    return f"ORDER BY {keys}, {alias}.mid"
+
+
+# search categories that have autocomplete suggestions, and the catalog kind
+# suggested for each
+SUGGEST_KINDS = {1: "movie", 3: "actor", 4: "studio", 5: "genre"}
+
+
+# in-process indexes of catalog names: a prefix index for autocomplete and a
+# trigram index for typo-tolerant search (loaded on the first search,
+# refreshed with added or renamed catalog rows at most every CATALOG_REFRESH
+# seconds and reloaded in full every CATALOG_RELOAD seconds)
+AUTOCOMPLETE = PrefixIndex()
+FUZZY_INDEX = NGramIndex()
+CATALOG_REFRESH = 60
+CATALOG_RELOAD = 3600
+catalog_refreshed = None
+catalog_loaded = None
+
+
+# PDM_FUZZY=pg finds fuzzy candidates with Postgres pg_trgm instead of the
+# local trigram index (see migrations/0003_trigram_indexes.sql)
+FUZZY_SOURCE = os.environ.get("PDM_FUZZY", "local")
+
+
+def refresh_catalog_indexes(conn) -> None:
+    """
+    Loads the catalog name indexes, or applies the catalog rows added or
+    renamed since.
+    
+    The full reload also drops deleted rows and updates the weights.
+    """
+    
+    global catalog_refreshed, catalog_loaded
+    
+    if catalog_loaded is None or time() - catalog_loaded > CATALOG_RELOAD:
+        rows, version = load_catalog(conn)
+        AUTOCOMPLETE.load(rows, version)
+        
+        if FUZZY_SOURCE == "local":
+            FUZZY_INDEX.load(rows)
+            
+        catalog_loaded = time()
+        
+    elif time() - catalog_refreshed > CATALOG_REFRESH:
+        for row in AUTOCOMPLETE.refresh(conn):
+            if FUZZY_SOURCE == "local":
+                FUZZY_INDEX.add(*row)
+                
+    else:
+        return
+        
+    catalog_refreshed = time()
+
+
+@reads
+def get_suggestions(category_code: int, search_term: str, conn) -> list:
+    """
+    Gets autocomplete suggestions for a search.
+    
+    :return: a list of (kind, id, name) tuples
+    """
+    
+    kind = SUGGEST_KINDS.get(category_code)
+    
+    if kind is None:
+        return []
+        
+    refresh_catalog_indexes(conn)
+    return AUTOCOMPLETE.suggest(search_term, kind)
 
 
-def find_movies(category_code: int, search_term: str, sort_op: int, order_by: str, conn) -> list:
+@reads
+def get_fuzzy_matches(category_code: int, search_term: str, conn) -> list:
+    """
+    Gets the catalog entries closest to a possibly misspelled search term.
+    
+    :return: a list of (kind, id, name) tuples, closest first
+    """
+    
+    kind = SUGGEST_KINDS.get(category_code)
+    
+    if kind is None:
+        return []
+        
+    if FUZZY_SOURCE == "pg":
+        return rank(search_term, pg_candidates(kind, search_term, conn), 10)
+        
+    refresh_catalog_indexes(conn)
+    return FUZZY_INDEX.search(search_term, kind)
+
+
+@reads
+def find_movies(category_code: int, search_term: str, sort_op: int, order_by: str, conn,
+                limit: int = None, offset: int = 0, exact_id: int = None) -> list:
     """
     Finds movies based on search.
     
@@ -130,6 +738,10 @@ def find_movies(category_code: int, search_term: str, sort_op: int, order_by: st
     the director, the length and the ratings (MPAA and user)
 
     :param conn: the database connection object
+    :param limit: maximum number of movies to return (None for all)
+    :param offset: number of movies to skip (for paging)
+    :param exact_id: id of a suggested movie/person/studio/genre to match
+        exactly instead of search_term (see get_suggestions)
         
     :return: a list of tuples containing movie information (mid, movie name, cast members, studio, length and ratings (MPAA and user))
     """
@@ -139,74 +751,163 @@ def find_movies(category_code: int, search_term: str, sort_op: int, order_by: st
     else:
         order_by = "DESC"
 
-    query = MOVIE_QUERY
-
-    statement_tuple = (search_term,)
-    # default prepared statement tuple
-
     # quering based on the category code and search term
-    if category_code == 1:
-        query += """ WHERE movie.title ILIKE {search_term}"""
+    if exact_id is not None:
+        if category_code == 1:
+            match = """movie.mid = {exact_id}"""
+        elif category_code == 3:
+            match = """EXISTS (SELECT 1 FROM actsin a WHERE a.mid = movie.mid AND a.peid = {exact_id})"""
+        elif category_code == 4:
+            match = """EXISTS (SELECT 1 FROM makesmovie mm WHERE mm.mid = movie.mid AND mm.prid = {exact_id})"""
+        elif category_code == 5:
+            match = """EXISTS (SELECT 1 FROM moviegenre mg WHERE mg.mid = movie.mid AND mg.gid = {exact_id})"""
+        else:
+            return []
+    elif category_code == 1:
+        match = """movie.title ILIKE {search_term}"""
     elif category_code == 2:
-        query += """ WHERE release.releasedate ILIKE {search_term}"""
+        match = """EXISTS (SELECT 1 FROM release r WHERE r.mid = movie.mid
+                AND r.releasedate ILIKE {search_term})"""
     elif category_code == 3:
-        query += """ WHERE actors.firstname ILIKE {search_term} OR actors.lastname ILIKE {search_term}"""
-        statement_tuple = (search_term, search_term)
-        # updates statement tuple
-        
+        match = """EXISTS (SELECT 1 FROM actsin a JOIN person p ON a.peid = p.peid
+                WHERE a.mid = movie.mid
+                AND (p.firstname ILIKE {search_term} OR p.lastname ILIKE {search_term}))"""
     elif category_code == 4:
-        query += """ WHERE producer_studio.name ILIKE {search_term}"""
+        match = """EXISTS (SELECT 1 FROM makesmovie mm JOIN producer_studio ps ON mm.prid = ps.prid
+                WHERE mm.mid = movie.mid AND ps.name ILIKE {search_term})"""
     elif category_code == 5:
-        query += """ WHERE genre.name ILIKE {search_term}"""
+        match = """EXISTS (SELECT 1 FROM moviegenre mg JOIN genre g ON mg.gid = g.gid
+                WHERE mg.mid = movie.mid AND g.name ILIKE {search_term})"""
     else:
         return []
 
-    query += f" GROUP BY movie.mid"
-
     # sort the results based on the sort operation
-    if sort_op == 0:
-        query += f" ORDER BY movie.title, release_dates {order_by};"
-    elif sort_op == 1:
-        query += f" ORDER BY movie.title {order_by};"
-    elif sort_op == 2:
-        query += f" ORDER BY studios {order_by};"
-    elif sort_op == 3:
-        query += f" ORDER BY genres {order_by};"
-    elif sort_op == 4:
-        query += f" ORDER BY release_dates {order_by};"
-    else:
+    page_order = sort_clause(sort_op, order_by, "sk")
+    
+    if page_order is None:
         return []
         
+    page = "" if limit is None else f" LIMIT {int(limit)} OFFSET {int(offset)}"
+    
+    # the matching mids are ordered on the indexed sort keys (and cut to the
+    # requested page) before the expensive MOVIE_QUERY aggregation, which then
+    # only runs for the movies that are returned
+    query = f"""WITH page AS (
+                SELECT movie.mid, sk.title_key, sk.primary_studio, sk.primary_genre, sk.first_release
+                FROM movie JOIN movie_sort_keys sk ON movie.mid = sk.mid
+                WHERE {match} {page_order}{page})
+                {MOVIE_QUERY} INNER JOIN page ON movie.mid = page.mid
+                GROUP BY movie.mid, page.mid, page.title_key, page.primary_studio,
+                page.primary_genre, page.first_release
+                {sort_clause(sort_op, order_by, "page")}"""
+        
+    from psycopg2 import sql
+
     stmt = sql.SQL(query).format(
             search_term = sql.Literal("%" + search_term + "%"),
+            exact_id = sql.Literal(exact_id),
     )
 
     curs = conn.cursor()
     curs.execute(stmt)
-    results = curs.fetchall()
+    results = resolve_names(curs.fetchall(), conn)
+    curs.close()
+    return results
+
+
+# cached filter selectivity estimates for multi-criteria searches
+SEARCH_STATS = SelectivityCache()
+
+
+@reads
+def find_movies_multi(filters: list, sort_op: int, order_by: str, conn,
+                      limit: int = None, offset: int = 0) -> list:
+    """
+    Finds movies matching several filters at once.
+    
+    :param filters: a list of (field, op, value) tuples (see
+        search_planner.parse_filter), e.g. [("genre", "=", "Horror"),
+        ("actor", "=", "Price"), ("year", ">", 1970)]
+    :param sort_op: sort option (see find_movies)
+    :param order_by:
+        "a" - ascending
+        "d" - descending
+    :param limit: maximum number of movies to return (None for all)
+    :param offset: number of movies to skip (for paging)
+    
+    :return: a list of tuples containing movie information
+    """
+    
+    if order_by == "a":
+        order_by = "ASC"
+    else:
+        order_by = "DESC"
+        
+    page_order = sort_clause(sort_op, order_by, "sk")
+    
+    if len(filters) == 0 or page_order is None:
+        return []
+        
+    mids = matching_mids(filters, SEARCH_STATS, conn)
+    # runs the most selective filter first and intersects the rest
+    
+    if len(mids) == 0:
+        return []
+        
+    page = "" if limit is None else f" LIMIT {int(limit)} OFFSET {int(offset)}"
+    
+    # only the requested page of the matches is aggregated
+    query = f"""WITH page AS (
+                SELECT sk.mid, sk.title_key, sk.primary_studio, sk.primary_genre, sk.first_release
+                FROM movie_sort_keys sk WHERE sk.mid = ANY(%s) {page_order}{page})
+                {MOVIE_QUERY} INNER JOIN page ON movie.mid = page.mid
+                GROUP BY movie.mid, page.mid, page.title_key, page.primary_studio,
+                page.primary_genre, page.first_release
+                {sort_clause(sort_op, order_by, "page")}"""
+                
+    curs = conn.cursor()
+    curs.execute(query, (list(mids),))
+    results = resolve_names(curs.fetchall(), conn)
     curs.close()
     return results
 
 
+@writes
 def watch_movie(username: str, movie: tuple, conn) -> None:
     """
     Watch a movie.
     """
 
-    curs = conn.cursor()
     movie_id = movie[0]
+    now = datetime.now()
+
+    if WATCH_JOURNAL is not None:
+        if not WATCH_JOURNAL.append(username, movie_id, now):
+            print("Something went wrong")
+            return
+            # the journal is full and not draining
+
+        record_popularity(username, movie_id, now, conn)
+        print("You have watched the Movie " + str(movie))
+        return
+        # the journal inserts it into watches in the background
 
     # Add the watched movie to the Watched table
-    curs.execute("INSERT INTO watches (username, mid, watchdate) VALUES (%s, %s, %s)",
-                 (username, movie_id, datetime.now()))
-    if curs.rowcount == 1:
-        conn.commit()
+    rowcount = execute_write("INSERT INTO watches (username, mid, watchdate) VALUES (%s, %s, %s)",
+                             (username, movie_id, now), conn)
+    if rowcount == 1:
+        if not queued_writes():
+            record_popularity(username, movie_id, now, conn)
+        elif POPULARITY is not None:
+            sketch = POPULARITY
+            after_commit(lambda: sketch.record(movie_id, username, now))
+            # flushed on exit by flush_popularity
         print("You have watched the Movie " + str(movie))
     else:
         print("Something went wrong")
-    curs.close()
 
 
+@writes
 def add_collection(username: str, col_name: str, conn) -> None:
     """
     Add a collection to the database.
@@ -214,97 +915,97 @@ def add_collection(username: str, col_name: str, conn) -> None:
     :param col_name: collection name
     """
 
-    curs = conn.cursor()
-    curs.execute("SELECT max(cid) from collection")
-    cid = curs.fetchone()[0]
-    cid += 1
-    curs.execute("INSERT INTO collection (cid, name, username) values (%s, %s, %s)",
-                 (cid, col_name, username))
-    if curs.rowcount == 1:
-        conn.commit()
+    rowcount = execute_write("""INSERT INTO collection (cid, name, username)
+                             SELECT COALESCE(max(cid), 0) + 1, %s, %s FROM collection""",
+                             (col_name, username), conn)
+    # the next cid is computed in the same statement so grouped writes
+    # cannot hand out the same cid twice
+    
+    if rowcount == 1:
+        session_drop(username, "collections", conn)
+        # the new cid is only known to the database
         print("Collection " + col_name + " added")
     else:
         print("Something went wrong")
-    curs.close()
 
 
+@writes
 def del_collection(username: str, collection: tuple, conn) -> None:
     """
     Delete a collection from the database.
     """
 
-    curs = conn.cursor()
     cid = collection[0]
 
-    curs.execute("DELETE FROM collection where cid = %s", (cid,))
+    rowcount = execute_write("DELETE FROM collection where cid = %s", (cid,), conn)
 
-    if curs.rowcount == 1:
-        conn.commit()
+    if rowcount == 1:
+        session_update(username, "collections", lambda rows: [row for row in rows if row[0] != cid], conn)
+        session_drop(username, collection_movie_keys(cid), conn)
         print("Deleted Collection " + str(collection))
     else:
         print("Something went wrong")
 
-    curs.close()
-
 
+@writes
 def rename_collection(username: str, collection: tuple, new_name: str, conn) -> None:
     """
     Renames a collection.
     """
 
-    curs = conn.cursor()
     cid = collection[0]
-    curs.execute("UPDATE collection SET name=%s WHERE cid=%s", (new_name, cid))
+    rowcount = execute_write("UPDATE collection SET name=%s WHERE cid=%s", (new_name, cid), conn)
 
-    if curs.rowcount == 1:
-        conn.commit()
+    if rowcount == 1:
+        session_drop(username, "collections", conn)
+        # get_collections orders by name in the database's collation, which
+        # a Python sort does not reproduce
         print("Updated Collection " + str(collection) + " to new name " + new_name)
     else:
         print("Something went wrong")
 
-    curs.close()
-
 
+@writes
 def add_movie_to_collection(username: str,collection: tuple, movie: tuple, conn) -> None:
     """
     Adds movie to a collection.
     """
 
-    curs = conn.cursor()
     cid = collection[0]
     mid = movie[0]
 
-    curs.execute("INSERT INTO collectionmovies (cid, mid) values (%s, %s)",
-                 (cid, mid))
+    rowcount = execute_write("INSERT INTO collectionmovies (cid, mid) values (%s, %s)",
+                             (cid, mid), conn)
 
-    if curs.rowcount == 1:
-        conn.commit()
+    if rowcount == 1:
+        session_update(username, "collections", lambda rows: collection_with_movie(rows, cid, movie[5]), conn)
+        session_drop(username, collection_movie_keys(cid), conn)
+        # the new movie's position depends on the sort keys
         print("Updated Collection " + str(collection) + " to have Movie " + str(movie))
     else:
         print("Something went wrong")
 
-    curs.close()
-
 
+@writes
 def del_movie_from_collection(username: str, collection: tuple, movie: tuple, conn) -> None:
     """
     Delectes movie from a collection.
     """
 
-    curs = conn.cursor()
     cid = collection[0]
     mid = movie[0]
-    curs.execute("DELETE FROM collectionmovies where cid = %s and mid = %s", (cid, mid))
+    rowcount = execute_write("DELETE FROM collectionmovies where cid = %s and mid = %s", (cid, mid), conn)
 
-    if curs.rowcount == 1:
-        conn.commit()
+    if rowcount == 1:
+        session_update(username, "collections", lambda rows: collection_without_movie(rows, cid, movie[5]), conn)
+        session_update(username, collection_movie_keys(cid), lambda rows: [row for row in rows if row[0] != mid],
+                       conn)
         print("Deleted Movie " + str(movie) + " from Collection " + str(collection))
     else:
         print("Something went wrong")
 
-    curs.close()
-
 
+@reads
 def get_collections(username: str, conn) -> list:
     """
     Gets a list of user collections.
@@ -331,6 +1032,7 @@ def get_collections(username: str, conn) -> list:
     return collections
 
 
+@reads
 def find_from_collection(username: str, collection: tuple, sort_op: int, order_by: str, conn) -> list:
     """
     Finds movies in a collection.
@@ -357,29 +1059,24 @@ def find_from_collection(username: str, collection: tuple, sort_op: int, order_b
     curs = conn.cursor()
     cid = collection[0]
 
-    match sort_op:
-        case 0:
-            order = f"ORDER BY movie.title, release_dates {order_by}"
-        case 1:
-            order = f"ORDER BY movie.title {order_by}"
-        case 2:
-            order = f"ORDER BY studios {order_by}"
-        case 3:
-            order = f"ORDER BY genres {order_by}"
-        case 4:
-            order = f"ORDER BY release_dates {order_by}"
+    order = sort_clause(sort_op, order_by, "sk")
+    
+    if order is None:
+        order = sort_clause(0, order_by, "sk")
+        # unknown sort option; use the default ordering
 
-    query = f"""{MOVIE_QUERY}
+    query = f"""{MOVIE_QUERY} LEFT JOIN movie_sort_keys sk ON movie.mid = sk.mid
                 WHERE movie.mid = (SELECT movie.mid from collectionmovies
                                    WHERE movie.mid = collectionmovies.mid and collectionmovies.cid = {cid})
-                GROUP BY movie.mid {order}"""
+                GROUP BY movie.mid, sk.mid {order}"""
 
     curs.execute(query)
-    results = curs.fetchall()
+    results = resolve_names(curs.fetchall(), conn)
     curs.close()
     return results
 
 
+@writes
 def rate(username: str, movie: tuple, stars: int, conn) -> None:
     """
     Adds user rating to database
@@ -388,17 +1085,18 @@ def rate(username: str, movie: tuple, stars: int, conn) -> None:
     # rating a movie
     curs = conn.cursor()
     mid = movie[0]
-    curs.execute(f"""SELECT * FROM rates WHERE username = '{username}' AND mid = {mid};""")
+    curs.execute("SELECT * FROM rates WHERE username = %s AND mid = %s;", (username, mid))
     print('You have rated the movie!')
     results = curs.rowcount
+    curs.close()
 
     if results > 0:
-        curs.execute(f"""UPDATE rates SET rating = {stars} WHERE username = '{username}' AND mid = {mid};""")
+        execute_write("UPDATE rates SET rating = %s WHERE username = %s AND mid = %s;", (stars, username, mid), conn)
     else:
-        curs.execute("INSERT INTO rates (username, mid, rating) values (%s, %s, %s);", (username, mid, stars))
-    curs.close()
+        execute_write("INSERT INTO rates (username, mid, rating) values (%s, %s, %s);", (username, mid, stars), conn)
 
 
+@reads
 def get_friends(username: str, conn) -> list:
     """
     Gets current user's friends
@@ -412,6 +1110,7 @@ def get_friends(username: str, conn) -> list:
     return friends
 
 
+@reads
 def find_user(username: str, email: str, conn) -> tuple:
     """
     Finds a user by email.
@@ -426,41 +1125,80 @@ def find_user(username: str, email: str, conn) -> tuple:
     return user
 
 
+# in-memory follow graph for "people you may know" (loaded on first use,
+# updated by follow/unfollow and reloaded every GRAPH_REFRESH seconds to pick
+# up other sessions' follows)
+SOCIAL_GRAPH = None
+GRAPH_REFRESH = 300
+graph_loaded = None
+
+
+def get_social_graph(conn) -> SocialGraph:
+    """
+    Gets the follow graph, (re)loading it from friends when stale.
+    """
+
+    global SOCIAL_GRAPH, graph_loaded
+
+    if SOCIAL_GRAPH is None or time() - graph_loaded > GRAPH_REFRESH:
+        curs = conn.cursor()
+        curs.execute("SELECT username1, username2 FROM friends")
+        graph = SocialGraph()
+        graph.load(curs.fetchall())
+        curs.close()
+        SOCIAL_GRAPH, graph_loaded = graph, time()
+
+    return SOCIAL_GRAPH
+
+
+@reads
+def get_people_you_may_know(username: str, conn) -> list:
+    """
+    Gets users followed by the most of a user's friends.
+
+    :return: a list of (username, mutual friend count) tuples
+    """
+
+    return get_social_graph(conn).suggest(username)
+
+
+@writes
 def follow(username: str, friend: tuple, conn) -> None:
     """
     Follows/adds a user as a friend.
     """
 
-    curs = conn.cursor()
-    curs.execute("INSERT INTO friends (username1, username2) VALUES (%s, %s)", (username, friend[0]))
+    rowcount = execute_write("INSERT INTO friends (username1, username2) VALUES (%s, %s)", (username, friend[0]), conn)
 
-    if curs.rowcount == 1:
-        conn.commit()
+    if rowcount == 1:
+        if SOCIAL_GRAPH is not None:
+            graph = SOCIAL_GRAPH
+            after_commit(lambda: graph.update(username, friend[0], True))
+        session_update(username, "friends", lambda rows: rows + [(friend[0],)], conn)
         print("Followed User ", friend[0])
     else:
         print("Something went wrong")
 
-    conn.commit()
-    curs.close()
-
 
+@writes
 def unfollow(username: str, friend: tuple, conn) -> None:
     """
     Unfollows/removes a user as a friend 
     """
 
-    curs = conn.cursor()
-    curs.execute("DELETE FROM friends WHERE username1=%s AND username2=%s", (username, friend[0]))
+    rowcount = execute_write("DELETE FROM friends WHERE username1=%s AND username2=%s", (username, friend[0]), conn)
 
-    if curs.rowcount == 1:
-        conn.commit()
+    if rowcount == 1:
+        if SOCIAL_GRAPH is not None:
+            graph = SOCIAL_GRAPH
+            after_commit(lambda: graph.update(username, friend[0], False))
+        session_update(username, "friends", lambda rows: [row for row in rows if row[0] != friend[0]], conn)
         print("Unfollowed User ", friend[0])
     else:
         print("Something went wrong")
-
-    curs.close()
     
     
+@reads
 def get_collection_count(username: str, conn) -> int:
     """
     Gets number of colections for a user.
@@ -475,6 +1213,7 @@ def get_collection_count(username: str, conn) -> int:
     return int(result[0])
     
     
+@reads
 def get_num_followers(username: str, conn) -> int:
     """
     Gets number of follwers a user has.
@@ -489,6 +1228,7 @@ def get_num_followers(username: str, conn) -> int:
     return int(result[0])
     
     
+@reads
 def get_num_following(username: str, conn) -> int:
     """
     Gets number of people a user is following.
@@ -502,7 +1242,35 @@ def get_num_following(username: str, conn) -> int:
     curs.close()
     return int(result[0])
     
+    
+    
+ANALYTICS_MONTHS = 12
+# months of history shown by the profile analytics view
+
+
+@reads
+def get_genre_minutes(username: str, conn) -> list:
+    """
+    Gets a user's watch minutes and plays per genre for the last
+    ANALYTICS_MONTHS months, from the user_genre_monthly rollup (at most
+    one row per month and genre, however long the history).
+    
+    :return: a list of (month, genre, minutes, plays) tuples, latest month first
+    """
+    
+    curs = conn.cursor()
+    curs.execute("""SELECT to_char(ugm.month, 'YYYY-MM'), genre.name, ugm.minutes, ugm.plays
+        FROM user_genre_monthly ugm JOIN genre ON ugm.gid = genre.gid
+        WHERE ugm.username = %s AND ugm.plays > 0
+        AND ugm.month >= date_trunc('month', CURRENT_DATE) - %s * INTERVAL '1 month'
+        ORDER BY ugm.month DESC, ugm.minutes DESC""", (username, ANALYTICS_MONTHS - 1))
+    
+    result = curs.fetchall()
+    curs.close()
+    return result
+    
    
+@reads
 def get_user_top_10_movies(username: str, mode: int, conn) -> list:
     """
     Gets a user's top 10 movies
@@ -519,60 +1287,73 @@ def get_user_top_10_movies(username: str, mode: int, conn) -> list:
     
     match mode:
         case 0:
-            query = f"""{MOVIE_QUERY}
+            query = f"""{MOVIE_QUERY} INNER JOIN rates ON movie.mid = rates.mid
                 WHERE rates.username=%s group by movie.mid ORDER BY AVG(rates.rating) DESC LIMIT 10"""
         case 1: 
-            query = f"""{MOVIE_QUERY} INNER JOIN watches ON movie.mid = watches.mid
-                WHERE watches.username=%s GROUP BY movie.mid ORDER BY count(*) DESC LIMIT 10"""
+            query = f"""{MOVIE_QUERY} INNER JOIN {WATCH_HISTORY} W ON movie.mid = W.mid
+                WHERE W.username=%s GROUP BY movie.mid ORDER BY sum(W.plays) DESC LIMIT 10"""
         case 2:
             query = f"""{MOVIE_QUERY}
-                    WHERE movie.mid in (SELECT mov.mid FROM
-                    (SELECT movie.mid, 3 AS rating, count(*) AS num FROM movie
-                        INNER JOIN watches ON movie.mid = watches.mid
-                        WHERE watches.username=%s AND 0 = (
-                            SELECT count(*) FROM rates WHERE rates.username=%s
-                            AND rates.mid = movie.mid
-                            ) GROUP BY movie.mid
-                    UNION
-                    SELECT movie.mid, AVG(rates.rating), count(*) FROM movie
-                        INNER JOIN rates ON movie.mid = rates.mid
-                        INNER JOIN watches ON movie.mid = watches.mid
-                        WHERE watches.username=%s AND rates.username=%s
-                        GROUP BY movie.mid) 
-                AS mov ORDER BY mov.rating/5*mov.num DESC LIMIT 10) GROUP BY movie.mid"""
-                
-            exec_tuple = (username, username, username, username)
-            # updates prepared statement tuple
+                    INNER JOIN (SELECT W.mid, COALESCE(R.rating, 3) / 5.0 * sum(W.plays) AS score
+                        FROM {WATCH_HISTORY} W
+                        LEFT JOIN rates R ON R.username = W.username AND R.mid = W.mid
+                        WHERE W.username=%s GROUP BY W.mid, R.rating
+                        ORDER BY score DESC, W.mid LIMIT 10) mov ON movie.mid = mov.mid
+                    GROUP BY movie.mid, mov.score ORDER BY mov.score DESC, movie.mid"""
+            # unrated movies count as 3 stars; precompute_recommendations.py
+            # ranks top10_combined with the same expression and tie-break
 
     curs.execute(query, exec_tuple)
-    results = curs.fetchall()
+    results = resolve_names(curs.fetchall(), conn)
     curs.close()
     return results
     
     
+def get_movies_in_order(mids: list, condition: str, limit: int, conn) -> list:
+    """
+    Gets the movies of mids that meet a condition, in the order of mids.
+    
+    :param condition: SQL appended to the mid filter ("" for none)
+    """
+    
+    curs = conn.cursor()
+    curs.execute(f"""{MOVIE_QUERY} WHERE movie.mid = ANY(%s) {condition}
+        GROUP BY movie.mid ORDER BY array_position(%s, movie.mid) LIMIT %s""", (mids, mids, limit))
+    results = resolve_names(curs.fetchall(), conn)
+    curs.close()
+    return results
+    
+    
+@LEADERBOARD_CACHE.cached("overall_top_20_movies")
+@reads
 def get_overall_top_20_movies(conn) -> list:
     """
     Gets top 20 most popular movies in the last 90 days.
     """
     
+    if POPULARITY is not None:
+        top = POPULARITY.top(20, date.today() - timedelta(days=90), conn)
+        return get_movies_in_order([row[0] for row in top], "", 20, conn)
+        
     curs = conn.cursor()
     query = f"""{MOVIE_QUERY} INNER JOIN watches ON movie.mid = watches.mid
         WHERE watches.watchdate > CURRENT_DATE-INTERVAL '90 days'
         GROUP BY movie.mid ORDER BY count(*) DESC limit 20"""
         
     curs.execute(query)
-    results = curs.fetchall()
+    results = resolve_names(curs.fetchall(), conn)
     curs.close()
     return results
 
     
+@reads
 def get_friends_top_20_movies(username: str, conn) -> list:
     """
     Gets top 20 most popular movies among friends.
     """
     
     curs = conn.cursor()
-    query = f"""{MOVIE_QUERY} inner join watches w on movie.mid = w.mid
+    query = f"""{MOVIE_QUERY} inner join {WATCH_HISTORY} w on movie.mid = w.mid
             where w.username in (
                 select username1 as name from friends
                 where username2=%s
@@ -580,85 +1361,259 @@ def get_friends_top_20_movies(username: str, conn) -> list:
                 select username2 as name from friends
                 where username1=%s
             )
-            group by movie.mid order by count(*) DESC limit 20"""
+            group by movie.mid order by sum(w.plays) DESC limit 20"""
             
     curs.execute(query, (username, username))
-    results = curs.fetchall()
+    results = resolve_names(curs.fetchall(), conn)
     curs.close()
     return results
     
     
+@LEADERBOARD_CACHE.cached("top_5_new_releases")
+@reads
 def get_top_5_new_releases(conn) -> list:
     """
     Gets top 5 new releases of the calendar month.
     """
     
+    if POPULARITY is not None:
+        curs = conn.cursor()
+        curs.execute("SELECT DISTINCT mid FROM release WHERE releasedate >= date_trunc('month', current_date)")
+        plays = POPULARITY.plays([row[0] for row in curs.fetchall()], date.today().replace(day=1), conn)
+        curs.close()
+        # new releases are rarely among the tracked heavy hitters, so they
+        # are ranked by their count-min estimates
+        ranked = sorted((mid for mid in plays if plays[mid]), key=lambda mid: (-plays[mid], mid))
+        return get_movies_in_order(ranked, "AND release.releasedate >= date_trunc('month', current_date)", 5, conn)
+        
     curs = conn.cursor()
     curs.execute(f"""{MOVIE_QUERY}
         inner join watches on movie.mid = watches.mid
         where release.releasedate >= date_trunc('month', current_date)
+        and watches.watchdate >= date_trunc('month', current_date)
         group by movie.mid order by count(*) DESC limit 5""")
+    # a movie released this month can only have been watched this month, so
+    # the watchdate bound only lets the planner skip older partitions
         
-    results = curs.fetchall()
+    results = resolve_names(curs.fetchall(), conn)
     curs.close()
     return results
     
     
+@reads
 def get_recommended_movies(username: str, conn) -> list:
     """
-    Gets recommendations based on user play history and the play history of
-    similar users.
+    Gets recommendations based on user play history and the play history of
+    similar users.
+    """
+
+    curs = conn.cursor()
+    
+    #finding the top 5 genres the user likes
+    user_top_genres_query = f"""
+        WITH UserTopGenres AS (
+            SELECT MG.gid, SUM(W.plays) AS genrecount
+            FROM {WATCH_HISTORY} W JOIN moviegenre MG ON W.mid = MG.mid
+            WHERE W.username=%s
+            GROUP BY MG.gid
+            ORDER BY genrecount DESC
+            LIMIT 5
+        )
+        SELECT gid FROM UserTopGenres;
+        """
+        
+    curs.execute(user_top_genres_query, (username,))
+    top_genres = [row[0] for row in curs.fetchall()]
+
+    #finding similar users with at least 2 overlapping genres
+    similar_users_query = f"""
+        WITH SimilarUsers AS (
+            SELECT W.username, SUM(W.plays) AS overlap_count
+            FROM {WATCH_HISTORY} W JOIN moviegenre MG ON W.mid = MG.mid
+            WHERE MG.gid IN %s AND W.username != %s
+            GROUP BY W.username
+            HAVING SUM(W.plays) >= 2
+        )
+        SELECT username FROM SimilarUsers;
+        """
+        
+    curs.execute(similar_users_query, (tuple(top_genres), username))
+    similar_users = [row[0] for row in curs.fetchall()]
+
+    #recommending up to 15 movies based on top genres and similar users
+    recommended_movies_query = f"""
+        {MOVIE_QUERY} WHERE movie.mid in (
+    
+            SELECT DISTINCT M.mid
+            FROM movie M JOIN moviegenre MG ON M.mid = MG.mid JOIN {WATCH_HISTORY} W ON MG.mid = W.mid
+            WHERE MG.gid IN %s AND W.username IN %s
+            AND M.mid NOT IN (SELECT mid FROM {WATCH_HISTORY} H WHERE H.username=%s)
+            LIMIT 15
+        
+        ) GROUP BY movie.mid ORDER BY movie.rating DESC, movie.title
+        """
+        
+    curs.execute(recommended_movies_query, (tuple(top_genres), tuple(similar_users), username))
+    recommendations = resolve_names(curs.fetchall(), conn)
+    
+    return recommendations
+
+
+@reads
+def get_similar_movies(movie: tuple, conn) -> list:
+    """
+    Gets the movies most similar to a movie (precomputed by similar_movies.py).
+
+    :return: a list of tuples containing movie information, most similar first
+    """
+
+    curs = conn.cursor()
+
+    query = f"""{MOVIE_QUERY} INNER JOIN similar_movies s ON movie.mid = s.similar_mid
+                WHERE s.mid = %s GROUP BY movie.mid, s.rank ORDER BY s.rank"""
+
+    curs.execute(query, (movie[0],))
+    results = resolve_names(curs.fetchall(), conn)
+    curs.close()
+    return results
+
+
+@reads
+def get_cowatched_movies(mid: int, conn) -> list:
+    """
+    Gets the movies most often watched in the same week as a movie
+    (counted by cowatch.py).
+
+    :return: a list of tuples containing movie information, most co-watched first
+    """
+
+    curs = conn.cursor()
+
+    query = f"""{MOVIE_QUERY} INNER JOIN (
+                SELECT other_mid, count FROM cowatch_topk WHERE mid = %s
+                ORDER BY count DESC, other_mid LIMIT 20) c ON movie.mid = c.other_mid
+                GROUP BY movie.mid, c.count ORDER BY c.count DESC, movie.mid"""
+
+    curs.execute(query, (mid,))
+    results = resolve_names(curs.fetchall(), conn)
+    curs.close()
+    return results
+
+
+@reads
+def get_last_watched(username: str, conn):
+    """
+    Gets the user's most recently watched movie.
+
+    :return: (mid, title), or None if the user has not watched anything
+    """
+
+    curs = conn.cursor()
+    curs.execute("""SELECT movie.mid, movie.title FROM watches INNER JOIN movie ON watches.mid = movie.mid
+                 WHERE watches.username = %s ORDER BY watches.watchdate DESC LIMIT 1""", (username,))
+    result = curs.fetchone()
+    curs.close()
+    return result
+
+
+# PDM_PRECOMPUTED=1 serves recommendation and top 10 lists from the
+# user_recommendations table written by precompute_recommendations.py (users
+# it has not covered yet, and lists older than PDM_PRECOMPUTED_MAX_AGE
+# seconds, default two days, get the live queries)
+PRECOMPUTED = os.environ.get("PDM_PRECOMPUTED") == "1"
+PRECOMPUTED_MAX_AGE = float(os.environ.get("PDM_PRECOMPUTED_MAX_AGE", "172800"))
+
+
+@reads
+def get_precomputed_movies(username: str, kind: str, conn) -> list:
+    """
+    Gets a precomputed list (see migrations/0005_precomputed_recommendations.sql).
+
+    :return: a list of tuples containing movie information, or None if the
+        user has no list of this kind younger than PRECOMPUTED_MAX_AGE
+    """
+
+    curs = conn.cursor()
+
+    query = f"""{MOVIE_QUERY} INNER JOIN user_recommendations ur ON movie.mid = ur.mid
+                WHERE ur.username = %s AND ur.kind = %s
+                AND ur.computed_at > LOCALTIMESTAMP - %s * INTERVAL '1 second'
+                GROUP BY movie.mid, ur.rank ORDER BY ur.rank"""
+
+    curs.execute(query, (username, kind, PRECOMPUTED_MAX_AGE))
+    results = resolve_names(curs.fetchall(), conn)
+    curs.close()
+    return results if results else None
+
+
+def precomputed_or_live(username: str, kind: str, live, conn) -> list:
+    """
+    Gets a precomputed list if enabled and present, else runs live(conn).
+    """
+
+    if PRECOMPUTED:
+        results = get_precomputed_movies(username, kind, conn)
+
+        if results is not None:
+            return results
+
+    return live(conn)
+
+
+# factors trained by train_als.py, served memory-mapped; reloaded when the
+# trainer saves a new model
+ALS_DIR = os.environ.get("PDM_ALS_DIR", "als_model")
+ALS_MODEL = None
+als_loaded = None
+
+
+def get_als_model():
+    """
+    Gets the current ALS model, or None if none has been trained.
+    """
+
+    global ALS_MODEL, als_loaded
+
+    if not FactorModel.exists(ALS_DIR):
+        return None
+
+    saved = os.path.getmtime(os.path.join(ALS_DIR, "users.json"))
+    # users.json is saved last
+
+    if ALS_MODEL is None or saved != als_loaded:
+        ALS_MODEL = FactorModel(ALS_DIR)
+        als_loaded = saved
+
+    return ALS_MODEL
+
+
+@reads
+def get_personal_recommendations(username: str, conn) -> list:
     """
+    Gets up to 15 unwatched movies ranked by the ALS model.
+
+    Falls back to get_recommended_movies without a model or for users the
+    model has not seen yet.
+    """
+
+    model = get_als_model()
+
+    if model is None or username not in model:
+        return get_recommended_movies(username, conn)
 
     curs = conn.cursor()
-    
-    #finding the top 5 genres the user likes
-    user_top_genres_query = """
-        WITH UserTopGenres AS (
-            SELECT MG.gid, COUNT(*) AS genrecount
-            FROM watches W JOIN moviegenre MG ON W.mid = MG.mid
-            WHERE W.username=%s
-            GROUP BY MG.gid
-            ORDER BY genrecount DESC
-            LIMIT 5
-        )
-        SELECT gid FROM UserTopGenres;
-        """
-        
-    curs.execute(user_top_genres_query, (username,))
-    top_genres = [row[0] for row in curs.fetchall()]
+    curs.execute(f"SELECT DISTINCT mid FROM {WATCH_HISTORY} W WHERE W.username = %s", (username,))
+    watched = [row[0] for row in curs.fetchall()]
 
-    #finding similar users with at least 2 overlapping genres
-    similar_users_query = """
-        WITH SimilarUsers AS (
-            SELECT W.username, COUNT(*) AS overlap_count
-            FROM watches W JOIN moviegenre MG ON W.mid = MG.mid
-            WHERE MG.gid IN %s AND W.username != %s
-            GROUP BY W.username
-            HAVING COUNT(*) >= 2
-        )
-        SELECT username FROM SimilarUsers;
-        """
-        
-    curs.execute(similar_users_query, (tuple(top_genres), username))
-    similar_users = [row[0] for row in curs.fetchall()]
+    mids = model.recommend(username, 15, watched)
 
-    #recommending up to 15 movies based on top genres and similar users
-    recommended_movies_query = f"""
-        {MOVIE_QUERY} WHERE movie.mid in (
-    
-            SELECT DISTINCT M.mid
-            FROM movie M JOIN moviegenre MG ON M.mid = MG.mid JOIN watches W ON MG.mid = W.mid
-            WHERE MG.gid IN %s AND W.username IN %s AND M.mid NOT IN (SELECT mid FROM watches WHERE username=%s)
-            LIMIT 15
-        
-        ) GROUP BY movie.mid ORDER BY movie.rating DESC, movie.title
-        """
-        
-    curs.execute(recommended_movies_query, (tuple(top_genres), tuple(similar_users), username))
-    recommendations = curs.fetchall()
-    
-    return recommendations
+    query = f"""{MOVIE_QUERY} WHERE movie.mid = ANY(%s)
+                GROUP BY movie.mid ORDER BY array_position(%s, movie.mid)"""
+
+    curs.execute(query, (mids, mids))
+    results = resolve_names(curs.fetchall(), conn)
+    curs.close()
+    return results
 
 
 #########################################################################
@@ -680,6 +1635,10 @@ COLLECTION_DISPLAY = (None, "Name:", "# of movies:",
 FRIEND_DISPLAY = ("Username:", "Email:")
 
 
+PAGE_SIZE = int(os.environ.get("PDM_PAGE_SIZE", "20")) or None
+# records per displayed page (PDM_PAGE_SIZE=0 shows everything at once)
+
+
 def data_display(data: list, title: str, disp_op: tuple) -> None:
     """
     Displays formatted like:
@@ -691,19 +1650,8 @@ def data_display(data: list, title: str, disp_op: tuple) -> None:
         print("NO DATA OF TYPE: " + title)
         return
 
-    count = 0
-
-    for elem in data:
-        count += 1
-        print("\n" + title + " #" + str(count))
-        # displays data count
-
-        for dp_index in range(len(elem)):
-            if disp_op[dp_index] is not None:
-                print(disp_op[dp_index], elem[dp_index])
-                # prints data information
-
-    print()
+    render(data, title, disp_op, PAGE_SIZE)
+    # one buffered write per page (see renderer.py)
     
 
 def login_query() -> tuple:
@@ -827,7 +1775,7 @@ def watch_query(username: str, movies: list, conn) -> None:
     data_display(movies, "MOVIE", MOVIE_DISPLAY)
     # displays movie data
 
-    print("Select a movie by its number to watch it, or enter 0 to exit")
+    print("Select a movie by its number to watch it, enter s<number> for similar movies, or enter 0 to exit")
 
     watch_option = input("> ")
     # gets user watch option
@@ -835,6 +1783,20 @@ def watch_query(username: str, movies: list, conn) -> None:
     if watch_option == "0":
         return
 
+    if watch_option.lower().startswith("s"):
+        try:
+            similar = get_similar_movies(movies[int(watch_option[1:]) - 1], conn)
+        except (ValueError, IndexError):
+            print("INVALID INPUT")
+            return
+
+        if len(similar) == 0:
+            print("NO SIMILAR MOVIES FOUND")
+            return
+
+        return watch_query(username, similar, conn)
+        # "more like this": pick from the similar movies instead
+
     try:
         watch_option = int(watch_option) - 1
         watch_movie(username, movies[watch_option], conn)
@@ -846,6 +1808,86 @@ def watch_query(username: str, movies: list, conn) -> None:
     rate_prompt(username, movies[watch_option], conn)
 
 
+def suggestion_prompt(search_term: str, suggestions: list):
+    """
+    Offers suggestions (autocomplete or fuzzy matches) for a search term.
+    
+    :param suggestions: a list of (kind, id, name) tuples
+    :return: the id of the chosen suggestion, or None to search by the term
+    """
+    
+    if len(suggestions) == 0:
+        return None
+        
+    print("\nDid you mean:")
+    
+    for count, suggestion in enumerate(suggestions, 1):
+        print(str(count) + " - " + suggestion[2])
+        
+    print("Select a suggestion by its number, or enter 0 to search for '" + search_term + "'")
+    
+    sel = input("> ")
+    # gets suggestion option
+    
+    try:
+        sel = int(sel) - 1
+    except:
+        return None
+        # searches by the term on invalid entry
+        
+    if sel < 0 or sel >= len(suggestions):
+        return None
+        
+    return suggestions[sel][1]
+
+
+def multi_search(username: str, exec_func, conn) -> None:
+    """
+    Searches for movies matching several criteria.
+    :param exec_func: function to be executed after completed search
+    :type exec_func: function
+    """
+    
+    print("\nEnter one filter per line, then an empty line to search.")
+    print("Filters: title=, actor=, director=, studio=, genre= (text)")
+    print("         year=, year<, year>, year<=, year>= (number)")
+    print("Example: genre=Horror, actor=Price, year>1970")
+    
+    filters = []
+    
+    while True:
+        line = input("> ")
+        # gets a filter
+        
+        if line.strip() == "":
+            break
+            
+        search_filter = parse_filter(line)
+        
+        if search_filter is None:
+            print("INVALID FILTER")
+            continue
+            
+        filters.append(search_filter)
+        
+    if len(filters) == 0:
+        return
+        
+    sort_op, order_by = sort_options()
+    # gets sort options
+    
+    movies = find_movies_multi(filters, sort_op, order_by, conn)
+    
+    if len(movies) == 0:
+        print("NO RESULTS FOUND")
+        return
+        # exits search if no results found
+        
+    print("RESULTS FOUND")
+    
+    return exec_func(username, movies, conn)
+
+
 def search_movies(username: str, exec_func, conn) -> None:
     """
     Searches for a movie.
@@ -859,13 +1901,17 @@ def search_movies(username: str, exec_func, conn) -> None:
     print("3 - cast members")
     print("4 - studio")
     print("5 - genre")
-    print("6 - cancel search")
+    print("6 - multiple criteria")
+    print("7 - cancel search")
 
     search_cat = input("> ")
     # gets search category
 
-    if search_cat == "6":
+    if search_cat == "7":
         return
+        
+    if search_cat == "6":
+        return multi_search(username, exec_func, conn)
 
     try:
         search_cat = int(search_cat)
@@ -879,10 +1925,20 @@ def search_movies(username: str, exec_func, conn) -> None:
     search_term = input("> ")
     # gets search term
 
+    exact_id = suggestion_prompt(search_term, get_suggestions(search_cat, search_term, conn))
+    # lets the user pick an exact match
+
     sort_op, order_by = sort_options()
     # gets sort options
 
-    movies = find_movies(search_cat, search_term, sort_op, order_by, conn)
+    movies = find_movies(search_cat, search_term, sort_op, order_by, conn, exact_id=exact_id)
+
+    if len(movies) == 0 and exact_id is None:
+        exact_id = suggestion_prompt(search_term, get_fuzzy_matches(search_cat, search_term, conn))
+        # the term may be misspelled; offers the closest names
+
+        if exact_id is not None:
+            movies = find_movies(search_cat, search_term, sort_op, order_by, conn, exact_id=exact_id)
 
     if len(movies) == 0:
         print("NO RESULTS FOUND")
@@ -909,7 +1965,8 @@ def play_from_collection_prompt(username: str, cur_collections: list, conn) -> N
 
     try:
         col_num = int(col_num) - 1
-        col_movies = find_from_collection(username, cur_collections[col_num], sort_op, order_by, conn)
+
+        col_movies = session_collection_movies(username, cur_collections[col_num], sort_op, order_by, conn)
     except:
         print("INVALID INPUT")
         return
@@ -1072,7 +2129,7 @@ def del_movie_from_collection_prompt(username: str, cur_collections: list, conn)
 
     print("\nFIND MOVIE TO DELETE FROM COLLECTION:")
 
-    col_movies = find_from_collection(username, collection, 0, "a", conn)
+    col_movies = session_collection_movies(username, collection, 0, "a", conn)
 
     if len(col_movies) == 0:
         print("NO MOVIES IN COLLECTION")
@@ -1099,10 +2156,14 @@ def manage_collections(username: str, conn) -> None:
 
     print("CURRENT COLLECTIONS:")
 
-    cur_collections = get_collections(username, conn)
+    cur_collections = session_collections(username, conn)
     data_display(cur_collections, "COLLECTION", COLLECTION_DISPLAY)
     # displays current collection data
 
+    for collection in cur_collections[:PREFETCH_COLLECTIONS]:
+        prefetch(("collection", collection[0]), find_from_collection, username, collection, 0, "a")
+        # likely next: playing one of the first collections (default sort)
+
     print("\nCollection management options:")
     print("1 - play from collection")
     print("2 - add new collection")
@@ -1182,6 +2243,38 @@ def unfollow_prompt(username: str, cur_friends: list, conn) -> None:
         # exits search on invalid entry
 
 
+def people_you_may_know_prompt(username: str, conn) -> None:
+    """
+    "People you may know" prompt.
+    """
+
+    suggestions = get_people_you_may_know(username, conn)
+
+    if len(suggestions) == 0:
+        print("NO SUGGESTIONS FOUND")
+        return
+
+    print("PEOPLE YOU MAY KNOW:")
+
+    for count, (friend, mutual) in enumerate(suggestions, 1):
+        print(str(count) + " - " + friend + " (followed by " + str(mutual) + " of your friends)")
+
+    print("Select a user by their number to follow them, or enter 0 to exit")
+    sel = input("> ")
+    # gets suggestion option
+
+    if sel == "0":
+        return
+
+    try:
+        sel = int(sel) - 1
+        follow(username, suggestions[sel], conn)
+    except:
+        print("INVALID INPUT")
+        return
+        # exits on invalid entry
+
+
 def manage_friends(username: str, conn) -> None:
     """
     Manage friends.
@@ -1189,14 +2282,15 @@ def manage_friends(username: str, conn) -> None:
 
     print("CURRENT FRIENDS:")
 
-    cur_friends = get_friends(username, conn)
+    cur_friends = session_friends(username, conn)
     data_display(cur_friends, "FRIEND", FRIEND_DISPLAY)
     # displays current friends
 
     print("Friend management options:")
     print("1 - follow a new friend")
     print("2 - unfollow a friend")
-    print("3 - quit friend management menu")
+    print("3 - people you may know")
+    print("4 - quit friend management menu")
 
     friend_op = input("> ")
     # gets friend management option
@@ -1206,6 +2300,8 @@ def manage_friends(username: str, conn) -> None:
     elif friend_op == "2":
         unfollow_prompt(username, cur_friends, conn)
     elif friend_op == "3":
+        people_you_may_know_prompt(username, conn)
+    elif friend_op == "4":
         return
     else:
         print("INVALID INPUT")
@@ -1239,11 +2335,43 @@ def show_user_top_10(username: str, conn) -> None:
         return
         # exits on invalid input 
     
+    if mode not in (0, 1, 2):
+        print("INVALID INPUT")
+        return
+
     print("YOUR TOP 10:")
-    data_display(get_user_top_10_movies(username, mode, conn), "MOVIE", MOVIE_DISPLAY)
+    kind = ("top10_rating", "top10_plays", "top10_combined")[mode]
+    data_display(precomputed_or_live(username, kind, lambda c: get_user_top_10_movies(username, mode, c), conn),
+        "MOVIE", MOVIE_DISPLAY)
     # displays top 10 movies
     
 
+def show_viewing_analytics(username: str, conn) -> None:
+    """
+    Shows a user's watch minutes per genre per month.
+    """
+    
+    rows = get_genre_minutes(username, conn)
+    
+    if not rows:
+        print("No watches in the last " + str(ANALYTICS_MONTHS) + " months")
+        return
+        
+    lines = ["\nMINUTES WATCHED PER GENRE (last " + str(ANALYTICS_MONTHS) + " months):"]
+    totals = {}
+    
+    for month, genre, minutes, plays in rows:
+        if month not in totals:
+            lines.append("\n" + month)
+        totals[month] = totals.get(month, 0) + minutes
+        lines.append("  %-20s %6d min %4d play(s)" % (genre, minutes, plays))
+        
+    lines.append("\nTOTAL PER MONTH (movies in several genres count in each):")
+    lines.extend("  %s %8d min" % (month, minutes) for month, minutes in totals.items())
+    print("\n".join(lines))
+    # one write for the whole view
+
+
 def manage_profile(username: str, conn) -> None:
     """
     Allows a user to view profile information.
@@ -1251,11 +2379,19 @@ def manage_profile(username: str, conn) -> None:
     
     print("PROFILE INFORMATION:\n")
     
-    print("Number of collections:", get_collection_count(username, conn))
-    print("Number of followers:", get_num_followers(username, conn))
-    print("Number of following:", get_num_following(username, conn))
+    print("Number of collections:", prefetched(("collection_count", username), get_collection_count,
+                                               username, conn=conn))
+    print("Number of followers:", prefetched(("followers", username), get_num_followers, username, conn=conn))
+    print("Number of following:", prefetched(("following", username), get_num_following, username, conn=conn))
     # displays user data
     
+    print("\nWould you like to view your viewing analytics? (y/n)")
+    view_op = input("> ")
+    # gets view option ("y" or "n")
+
+    if view_op.lower() == "y":
+        show_viewing_analytics(username, conn)
+    
     print("\nWould you like to view your top 10 movies? (y/n)")
     view_op = input("> ")
     # gets view option ("y" or "n")
@@ -1274,7 +2410,9 @@ def manage_recommendations(username: str, conn) -> None:
     print("1 - top 20 most popular movies among my friends")
     print("2 - top 5 new releases of the month")
     print("3 - recommendations based on your play history and the play history of similar users")
-    print("4 - quit recommendation manager")
+    print("4 - personalized recommendations learned from everyone's plays and ratings")
+    print("5 - because you watched your last movie")
+    print("6 - quit recommendation manager")
     
     rec_cat = input("> ")
     # gets recommendation category selection
@@ -1284,12 +2422,25 @@ def manage_recommendations(username: str, conn) -> None:
     if rec_cat == "0":
         data_display(get_overall_top_20_movies(conn), "MOVIE", MOVIE_DISPLAY)
     elif rec_cat == "1":
-        data_display(get_friends_top_20_movies(username, conn), "MOVIE", MOVIE_DISPLAY)
+        data_display(precomputed_or_live(username, "friends_top20",
+            lambda c: get_friends_top_20_movies(username, c), conn), "MOVIE", MOVIE_DISPLAY)
     elif rec_cat == "2":
         data_display(get_top_5_new_releases(conn), "MOVIE", MOVIE_DISPLAY)
     elif rec_cat == "3":
-        data_display(get_recommended_movies(username, conn), "MOVIE", MOVIE_DISPLAY)
+        data_display(precomputed_or_live(username, "recommended",
+            lambda c: get_recommended_movies(username, c), conn), "MOVIE", MOVIE_DISPLAY)
     elif rec_cat == "4":
+        data_display(get_personal_recommendations(username, conn), "MOVIE", MOVIE_DISPLAY)
+    elif rec_cat == "5":
+        last = get_last_watched(username, conn)
+        
+        if last is None:
+            print("NO WATCHED MOVIES FOUND")
+            return
+            
+        print("Because you watched " + last[1] + ":")
+        data_display(get_cowatched_movies(last[0], conn), "MOVIE", MOVIE_DISPLAY)
+    elif rec_cat == "6":
         return
     else:
         print("INVALID INPUT")
@@ -1334,87 +2485,268 @@ def options_loop(username: str, conn) -> None:
             print("INVALID OPTION")
 
 
-def main() -> None:
+# local socket of a shared tunnel daemon (see tunnel_daemon.py)
+TUNNEL_SOCKET = os.environ.get("PDM_TUNNEL_SOCKET",
+                               os.path.join(os.path.expanduser("~"), ".pdm_tunnel.sock"))
+
+
+def daemon_params() -> dict:
+    """
+    Asks a running tunnel daemon for connection parameters.
+    
+    :return: the daemon's connection parameters, or None if no daemon is running
+    """
+    
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(TUNNEL_SOCKET):
+        return None
+        
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(2)
+            client.connect(TUNNEL_SOCKET)
+            data = b""
+            
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+                
+        return json.loads(data)
+    except (OSError, ValueError):
+        return None
+        # stale socket file; fall back to a fresh tunnel
+
+
+@contextmanager
+def db_params(quiet: bool = False):
     """
-    Connects to the database using the credentials file
+    Yields psycopg2 connection parameters for the database.
+    
+    If the PDM_DSN environment variable is set it is used as a libpq
+    connection string (e.g. a local Postgres). Otherwise the tunnel of a
+    running tunnel daemon is reused, and failing that an SSH tunnel is opened
+    using the credentials file:
     The first line of the credentials file is the username
     The second line of the credentials file is the password
     
-    :return: database connection object
+    The tunnel stays open until the with block exits.
+    """
+    
+    dsn = os.environ.get("PDM_DSN")
+    
+    if dsn:
+        yield {'dsn': dsn}
+        return
+        
+    params = daemon_params()
+    
+    if params is not None:
+        yield params
+        return
+        
+    from sshtunnel import SSHTunnelForwarder
+        
+    with open("credentials.txt") as file:
+        admin_username = file.readline().strip()
+        admin_password = file.readline().strip()
+
+    with SSHTunnelForwarder(
+            ('starbug.cs.rit.edu', 22),
+            ssh_username=admin_username,
+            ssh_password=admin_password,
+            remote_bind_address=('localhost', 5432)) as server:
+
+        server.start()
+        if not quiet:
+            print("SSH tunnel established on port: " + str(server.local_bind_port))
+        yield {
+            'database': 'p320_04',
+            'user': admin_username,
+            'password': admin_password,
+            'host': 'localhost',
+            'port': server.local_bind_port
+        }
+
+
+class BackgroundConnection:
+    """
+    Database connection opened on a background thread.
+    
+    Stands in for a psycopg2 connection: attribute access (cursor(),
+    commit(), ...) waits until the connection is ready, so the login prompt
+    can be shown while the tunnel and connection are negotiated.
     """
+    
+    def __init__(self, autocommit: bool = False):
+        self.conn = None
+        self.params = None
+        self.autocommit = autocommit
+        self.error = None
+        self.ready = threading.Event()
+        self.stack = ExitStack()
+        # keeps the tunnel open for the lifetime of the connection
+        
+        threading.Thread(target=self.connect, daemon=True).start()
+        
+    def connect(self) -> None:
+        """
+        Opens the connection (runs on the background thread).
+        """
+        
+        try:
+            import psycopg2
+            
+            self.params = self.stack.enter_context(db_params(quiet=True))
+            self.conn = psycopg2.connect(**self.params)
+            self.conn.autocommit = self.autocommit
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ready.set()
+            
+    def wait(self):
+        """
+        Waits for the connection.
+        
+        :return: the psycopg2 connection
+        """
+        
+        self.ready.wait()
+        
+        if self.error is not None:
+            raise self.error
+            
+        return self.conn
+        
+    def wait_params(self) -> dict:
+        """
+        Waits for the connection.
+        
+        :return: the connection parameters (e.g. for extra connections)
+        """
+        
+        self.wait()
+        return self.params
+        
+    def __getattr__(self, name):
+        return getattr(self.wait(), name)
+        
+    def close(self) -> None:
+        """
+        Closes the connection and its tunnel.
+        """
+        
+        if not self.ready.is_set():
+            return
+            # still connecting; the daemon thread dies with the process
+            
+        if self.conn is not None:
+            self.conn.close()
+        self.stack.close()
 
-    conn = None
+
+def run(conn) -> None:
+    """
+    Runs the login/register menu and then the main options loop.
+    """
     
-    try:
-        with open("credentials.txt") as file:
-            admin_username = file.readline().strip()
-            admin_password = file.readline().strip()
+    print("PEACOCK MOVIES DATABASE")
+    print("=======================")
+    # title display
 
-        with SSHTunnelForwarder(
-                ('starbug.cs.rit.edu', 22),
-                ssh_username=admin_username,
-                ssh_password=admin_password,
-                remote_bind_address=('localhost', 5432)) as server:
+    option = ""
+    # holds user options
 
-            server.start()
-            print("SSH tunnel established on port: " + str(server.local_bind_port))
-            params = {
-                'database': 'p320_04',
-                'user': admin_username,
-                'password': admin_password,
-                'host': 'localhost',
-                'port': server.local_bind_port
-            }
+    while True:
+        print("\nPlease select from the options below:")
+        print("1 - login to existing account")
+        print("2 - register new account")
+        print("3 - exit application")
+        option = input("> ")
+        # gets user option input
 
-            conn = psycopg2.connect(**params)
+        if option == "1":
+            username, password = login_query()
+            status = login(username, password, conn)
+            # logs user in
 
-            print("PEACOCK MOVIES DATABASE")
-            print("=======================")
-            # title display
+        elif option == "2":
+            username, password, email, firstname, lastname, SALT = register_query()
+            status = register(username, password, email, firstname, lastname, SALT, conn)
+            # registers user and logs into account
 
-            option = ""
-            # holds user options
+        elif option == "3":
+            sys.exit(0)
 
-            while True:
-                print("\nPlease select from the options below:")
-                print("1 - login to existing account")
-                print("2 - register new account")
-                print("3 - exit application")
-                option = input("> ")
-                # gets user option input
-
-                if option == "1":
-                    username, password = login_query()
-                    status = login(username, password, conn)
-                    # logs user in
-
-                elif option == "2":
-                    username, password, email, firstname, lastname, SALT = register_query()
-                    status = register(username, password, email, firstname, lastname, SALT, conn)
-                    # registers user and logs into account
-
-                elif option == "3":
-                    sys.exit(0)
-
-                else:
-                    print("INVALID INPUT")
-                    continue
-
-                if status:
-                    break
-                else:
-                    print("REQUEST FAILED -- TRY AGAIN")
+        else:
+            print("INVALID INPUT")
+            continue
 
-            options_loop(username, conn)
-            # runs main options loop
+        if status:
+            break
+        else:
+            print("REQUEST FAILED -- TRY AGAIN")
+
+    prefetch(("collections", username), get_collections, username)
+    prefetch(("collection_count", username), get_collection_count, username)
+    prefetch(("followers", username), get_num_followers, username)
+    prefetch(("following", username), get_num_following, username)
+    # likely next: the collection and profile screens
+
+    options_loop(username, conn)
+    # runs main options loop
+
+
+def main() -> None:
+    """
+    Connects to the database and runs the PTUI.
+    
+    With --fast the menu is shown right away and the connection is opened in
+    the background (see BackgroundConnection).
+    """
+
+    conn = None
+    
+    try:
+        if "--fast" in sys.argv[1:]:
+            conn = BackgroundConnection(start_group_commit(lambda: conn.wait_params()))
+            start_watch_journal(lambda: conn.wait_params())
+            start_prefetch(lambda: conn.wait_params())
+            start_router()
+            run(conn)
+            
+        else:
+            import psycopg2
+            
+            with db_params() as params:
+                conn = psycopg2.connect(**params)
+                conn.autocommit = start_group_commit(lambda: params)
+                start_watch_journal(lambda: params)
+                start_prefetch(lambda: params)
+                start_router()
+                run(conn)
 
     except Exception as e:
         print("Connection Failed")
         print(e)
 
     finally:
+        if PREFETCHER is not None:
+            PREFETCHER.close()
+        flush_popularity(conn)
+        if ROUTER is not None:
+            ROUTER.close()
+        if WATCH_JOURNAL is not None:
+            WATCH_JOURNAL.close()
+            # un-flushed watches stay journaled and are replayed next start
+        if WRITE_COMMITTER is not None:
+            WRITE_COMMITTER.close()
+            # commits any writes still queued
         if conn is not None:
             conn.close()
+        if CACHE_METRICS:
+            print("Leaderboard cache:", LEADERBOARD_CACHE.metrics())
         print("Goodbye :)")
 
 
@@ -0,0 +1,282 @@
+"""
+Implicit-feedback matrix factorization (ALS).
+Team Peacock.
+
+Users and movies get latent factor vectors such that a user's factors dotted
+with a movie's factors predicts how strongly the user prefers the movie.
+Training alternates between solving all user factors with the movie factors
+fixed and vice versa (alternating least squares with confidence weights, as
+in Hu, Koren and Volinsky's implicit-feedback model). Each half-step is split
+into row blocks solved in parallel by a process pool; the factor matrices
+live in shared memory, so workers read and write them without copies.
+
+Models are saved as float32 .npy files and served memory-mapped: a top-N
+query is one matrix-vector product over the movie factors.
+"""
+
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+
+FACTORS = 32
+REGULARIZATION = 0.05
+ALPHA = 10.0
+# confidence = 1 + ALPHA * interaction strength
+ITERATIONS = 10
+BLOCK = 512
+# rows solved per task
+SOLVE_NONZEROS = 8192
+# interactions per batched outer product in solve_rows (it holds
+# SOLVE_NONZEROS x factors x factors values; 32 MB at 32 float32 factors)
+
+MODEL_FILES = ("user_factors.npy", "item_factors.npy", "mids.npy", "users.json")
+
+WORKER = {}
+# per-process shared factor matrices and interaction matrices
+
+
+def build_matrix(rows: list) -> tuple:
+    """
+    Builds the user x movie interaction matrix.
+
+    :param rows: (username, mid, strength) tuples; repeated pairs are summed
+        and pairs summing to zero are not observed interactions
+    :return: (CSR matrix, list of usernames, array of mids), in row/column order
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    users = sorted({row[0] for row in rows})
+    user_index = {username: i for i, username in enumerate(users)}
+    mids = np.array(sorted({row[1] for row in rows}), dtype=np.int64)
+
+    user_rows = np.fromiter((user_index[row[0]] for row in rows), dtype=np.int64, count=len(rows))
+    item_cols = np.searchsorted(mids, np.fromiter((row[1] for row in rows), dtype=np.int64,
+                                                  count=len(rows)))
+    strengths = np.fromiter((row[2] for row in rows), dtype=np.float32, count=len(rows))
+
+    matrix = sparse.csr_matrix((strengths, (user_rows, item_cols)), shape=(len(users), len(mids)))
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    # solve_rows treats every stored entry as observed
+    return matrix, users, mids
+
+
+def solve_rows(interactions, fixed, regularization: float, alpha: float):
+    """
+    Solves the factors of every row of an interaction block.
+
+    For row u with observed columns I(u): x_u = (YtY + Y_I^T (C_u - 1) Y_I
+    + lambda I)^-1 Y_I^T C_u. The corrections Y_I^T (C_u - 1) Y_I are
+    summed from batched outer products over runs of rows with at most
+    SOLVE_NONZEROS interactions (a row with more, e.g. a popular movie, gets
+    a plain matrix product), so memory is bounded by nonzeros rather than
+    rows; all rows are then solved in one batched solve.
+
+    :param interactions: CSR block (rows x columns of fixed)
+    :param fixed: the other side's factors (columns x factors)
+    :return: the block's factors (rows x factors)
+    """
+
+    import numpy as np
+
+    factors = fixed.shape[1]
+    rows = interactions.shape[0]
+    gram = fixed.T @ fixed + regularization * np.eye(factors, dtype=fixed.dtype)
+    result = np.zeros((rows, factors), dtype=fixed.dtype)
+    counts = np.diff(interactions.indptr)
+    active = counts > 0
+    # rows without interactions keep zero factors
+
+    if not active.any():
+        return result
+
+    confidence = 1 + alpha * interactions.data
+    observed = fixed[interactions.indices]
+    starts = interactions.indptr[:-1][active]
+    ends = interactions.indptr[1:][active]
+    # active rows' interactions are contiguous, so ends is increasing
+
+    weighted = observed * (confidence - 1)[:, None]
+    corrections = np.empty((len(starts), factors, factors), dtype=fixed.dtype)
+    i = 0
+
+    while i < len(starts):
+        lo = starts[i]
+
+        if ends[i] - lo > SOLVE_NONZEROS:
+            corrections[i] = observed[lo:ends[i]].T @ weighted[lo:ends[i]]
+            i += 1
+            continue
+
+        j = np.searchsorted(ends, lo + SOLVE_NONZEROS, side="right")
+        # rows i:j fit in the budget
+        hi = ends[j - 1]
+        corrections[i:j] = np.add.reduceat(observed[lo:hi, :, None] * weighted[lo:hi, None, :],
+                                           starts[i:j] - lo, axis=0)
+        i = j
+
+    targets = np.add.reduceat(observed * confidence[:, None], starts, axis=0)
+
+    result[active] = np.linalg.solve(gram + corrections, targets[:, :, None])[:, :, 0]
+    return result
+
+
+def init_worker(shapes: dict, matrices: dict, regularization: float, alpha: float) -> None:
+    """
+    Attaches a pool worker to the shared factor matrices.
+    """
+
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    for side, (name, shape) in shapes.items():
+        memory = shared_memory.SharedMemory(name=name)
+        WORKER[side] = (memory, np.ndarray(shape, dtype=np.float32, buffer=memory.buf))
+
+    WORKER["matrices"] = matrices
+    WORKER["params"] = (regularization, alpha)
+
+
+def solve_block(side: str, start: int, end: int) -> None:
+    """
+    Solves rows start:end of one side in place (runs in a pool worker).
+    """
+
+    other = "items" if side == "users" else "users"
+    interactions = WORKER["matrices"][side][start:end]
+    WORKER[side][1][start:end] = solve_rows(interactions, WORKER[other][1], *WORKER["params"])
+
+
+def train(matrix, factors: int = FACTORS, iterations: int = ITERATIONS,
+          regularization: float = REGULARIZATION, alpha: float = ALPHA,
+          workers: int = None, block: int = BLOCK, seed: int = 0) -> tuple:
+    """
+    Trains user and movie factors on an interaction matrix.
+
+    :param matrix: CSR user x movie interaction strengths
+    :param workers: pool processes (default: one per CPU)
+    :return: (user factors, movie factors) as float32 arrays
+    """
+
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    rng = np.random.default_rng(seed)
+    matrices = {"users": matrix.tocsr().astype(np.float32),
+                "items": matrix.T.tocsr().astype(np.float32)}
+    shapes = {"users": (matrix.shape[0], factors), "items": (matrix.shape[1], factors)}
+    memories = {}
+    arrays = {}
+
+    try:
+        for side, shape in shapes.items():
+            memories[side] = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 4, 1))
+            arrays[side] = np.ndarray(shape, dtype=np.float32, buffer=memories[side].buf)
+
+        arrays["users"][:] = 0
+        arrays["items"][:] = rng.normal(0, 0.01, shapes["items"])
+
+        names = {side: (memories[side].name, shapes[side]) for side in shapes}
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(names, matrices, regularization, alpha)) as pool:
+            for _ in range(iterations):
+                for side in ("users", "items"):
+                    tasks = [pool.submit(solve_block, side, start, start + block)
+                             for start in range(0, shapes[side][0], block)]
+
+                    for task in tasks:
+                        task.result()
+                        # a half-step finishes before the other side reads it
+
+        return arrays["users"].copy(), arrays["items"].copy()
+    finally:
+        arrays.clear()
+
+        for memory in memories.values():
+            memory.close()
+            memory.unlink()
+
+
+def save(directory: str, user_factors, item_factors, users: list, mids) -> None:
+    """
+    Saves a model; each file is replaced atomically, the user list last.
+    """
+
+    import numpy as np
+
+    os.makedirs(directory, exist_ok=True)
+
+    for name, data in (("user_factors.npy", np.asarray(user_factors, dtype=np.float32)),
+                       ("item_factors.npy", np.asarray(item_factors, dtype=np.float32)),
+                       ("mids.npy", np.asarray(mids, dtype=np.int64))):
+        path = os.path.join(directory, name)
+
+        with open(path + ".tmp", "wb") as file:
+            np.save(file, np.ascontiguousarray(data))
+
+        os.replace(path + ".tmp", path)
+
+    path = os.path.join(directory, "users.json")
+
+    with open(path + ".tmp", "w") as file:
+        json.dump(users, file)
+
+    os.replace(path + ".tmp", path)
+
+
+class FactorModel:
+    """
+    Memory-mapped trained model answering top-N queries.
+    """
+
+    def __init__(self, directory: str):
+        import numpy as np
+
+        self.user_factors = np.load(os.path.join(directory, "user_factors.npy"), mmap_mode="r")
+        self.item_factors = np.load(os.path.join(directory, "item_factors.npy"), mmap_mode="r")
+        self.mids = np.load(os.path.join(directory, "mids.npy"), mmap_mode="r")
+
+        with open(os.path.join(directory, "users.json")) as file:
+            self.user_index = {username: i for i, username in enumerate(json.load(file))}
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        """
+        Checks whether a directory holds a saved model.
+        """
+
+        return all(os.path.exists(os.path.join(directory, name)) for name in MODEL_FILES)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.user_index
+
+    def recommend(self, username: str, n: int = 15, exclude=()) -> list:
+        """
+        Gets a user's top-N movies.
+
+        :param exclude: mids never recommended (e.g. already watched)
+        :return: a list of mids, best first; empty for unknown users
+        """
+
+        import numpy as np
+
+        row = self.user_index.get(username)
+
+        if row is None:
+            return []
+
+        scores = self.item_factors @ self.user_factors[row]
+        exclude = set(exclude)
+        wanted = min(n + len(exclude), len(scores))
+
+        if wanted == 0:
+            return []
+
+        best = np.argpartition(-scores, wanted - 1)[:wanted]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [int(mid) for mid in self.mids[best] if int(mid) not in exclude][:n]
@@ -0,0 +1,223 @@
+"""
+In-memory prefix autocomplete for the movie catalog.
+Team Peacock.
+
+Movie titles, actor names, studios and genres are held in one sorted array
+of normalized keys; a prefix lookup is two bisects plus a top-k pick over
+the matching range. Every word start of a name is indexed, so "godf" finds
+"The Godfather" and "pri" finds "Vincent Price".
+
+Titles and names carry a name_version (see migrations/0009_name_versions.sql
+and 0013_movie_name_versions.sql), so a refresh reads only the rows added or
+renamed since the highest version loaded. Rows deleted, versions committed
+out of order and changed weights are picked up by a periodic full load.
+"""
+
+
+import heapq
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+
+KINDS = ("movie", "actor", "studio", "genre")
+# people are suggested for the cast member search, which matches actsin only
+
+# bulk catalog queries: (id, display name, weight, name version) per kind;
+# the weight ranks suggestions (ratings for movies, roles for actors, movies
+# otherwise)
+CATALOG_QUERIES = {
+    "movie": """SELECT movie.mid, movie.title, count(rates.mid), movie.name_version FROM movie
+                LEFT JOIN rates ON movie.mid = rates.mid
+                WHERE movie.name_version > %s GROUP BY movie.mid""",
+    "actor": """SELECT person.peid, CONCAT(person.firstname, ' ', person.lastname), roles.count,
+                person.name_version FROM person
+                INNER JOIN (SELECT peid, count(*) FROM actsin GROUP BY peid) roles
+                ON person.peid = roles.peid
+                WHERE person.name_version > %s""",
+    "studio": """SELECT producer_studio.prid, producer_studio.name, count(makesmovie.mid),
+                producer_studio.name_version FROM producer_studio
+                LEFT JOIN makesmovie ON producer_studio.prid = makesmovie.prid
+                WHERE producer_studio.name_version > %s GROUP BY producer_studio.prid""",
+    "genre": """SELECT genre.gid, genre.name, count(moviegenre.mid), genre.name_version FROM genre
+                LEFT JOIN moviegenre ON genre.gid = moviegenre.gid
+                WHERE genre.name_version > %s GROUP BY genre.gid""",
+}
+
+
+def normalize(text: str) -> str:
+    """
+    Lower-cases text and strips accents for matching.
+    """
+
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower().strip()
+
+
+def load_catalog(conn, since: int = -1) -> tuple:
+    """
+    Reads catalog names in bulk.
+
+    :param since: only rows with a larger name version are read
+    :return: (list of (kind, id, name, weight) tuples, highest version read)
+    """
+
+    rows = []
+    version = since
+    curs = conn.cursor()
+
+    for kind in KINDS:
+        curs.execute(CATALOG_QUERIES[kind], (since,))
+
+        for ident, name, weight, name_version in curs.fetchall():
+            rows.append((kind, ident, name, weight))
+            version = max(version, name_version or 0)
+
+    curs.close()
+    return rows, version
+
+
+class PrefixIndex:
+    """
+    Sorted-array prefix index answering top-k suggestions.
+    """
+
+    SCAN_LIMIT = 4096
+    # larger prefix ranges are answered from a per-prefix memo
+
+    def __init__(self):
+        self.keys = []
+        # sorted (normalized key, entry key) pairs
+        self.entries = {}
+        # (kind, id) -> (display name, weight)
+        self.version = -1
+        # highest name version loaded (for incremental refreshes)
+        self.memo = {}
+        # (prefix, kind, k) -> suggestions for wide prefixes
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def index_keys(name: str) -> set:
+        """
+        Gets the keys a name is indexed under (one per word start).
+        """
+
+        words = normalize(name).split()
+        return {" ".join(words[i:]) for i in range(len(words))}
+
+    def add(self, kind: str, ident: int, name: str, weight: int = 0) -> None:
+        """
+        Adds (or replaces) one catalog entry.
+        """
+
+        with self.lock:
+            self.remove_locked(kind, ident)
+            self.entries[(kind, ident)] = (name, weight)
+
+            for key in self.index_keys(name):
+                insort(self.keys, (key, (kind, ident)))
+
+            self.memo.clear()
+
+    def remove(self, kind: str, ident: int) -> None:
+        """
+        Removes one catalog entry.
+        """
+
+        with self.lock:
+            self.remove_locked(kind, ident)
+            self.memo.clear()
+
+    def remove_locked(self, kind: str, ident: int) -> None:
+        """
+        Removes an entry (caller holds the lock).
+        """
+
+        entry = self.entries.pop((kind, ident), None)
+
+        if entry is None:
+            return
+
+        for key in self.index_keys(entry[0]):
+            i = bisect_left(self.keys, (key, (kind, ident)))
+
+            if i < len(self.keys) and self.keys[i] == (key, (kind, ident)):
+                del self.keys[i]
+
+    def load(self, rows: list, version: int = -1) -> None:
+        """
+        Bulk-loads (kind, id, name, weight) rows, replacing the index.
+
+        :param version: highest name version among the rows
+        """
+
+        keys = []
+        entries = {}
+
+        for kind, ident, name, weight in rows:
+            entries[(kind, ident)] = (name, weight)
+
+            for key in self.index_keys(name):
+                keys.append((key, (kind, ident)))
+
+        keys.sort()
+
+        with self.lock:
+            self.keys = keys
+            self.entries = entries
+            self.version = version
+            self.memo.clear()
+
+    def refresh(self, conn) -> list:
+        """
+        Adds or replaces the catalog rows added or renamed since the last
+        load or refresh.
+
+        :return: the rows read, as (kind, id, name, weight) tuples
+        """
+
+        rows, version = load_catalog(conn, self.version)
+
+        for kind, ident, name, weight in rows:
+            self.add(kind, ident, name, weight)
+
+        with self.lock:
+            self.version = max(self.version, version)
+
+        return rows
+
+    def suggest(self, prefix: str, kind: str = None, k: int = 10) -> list:
+        """
+        Gets the top-k entries with a word starting with prefix.
+
+        :param kind: optional kind filter ("movie", "actor", "studio", "genre")
+        :return: a list of (kind, id, name) tuples, highest weight first
+        """
+
+        prefix = normalize(prefix)
+
+        if not prefix:
+            return []
+
+        with self.lock:
+            memo_key = (prefix, kind, k)
+
+            if memo_key in self.memo:
+                return self.memo[memo_key]
+
+            lo = bisect_left(self.keys, (prefix,))
+            hi = bisect_left(self.keys, (prefix + "\uffff",))
+            matches = {entry for _, entry in self.keys[lo:hi]
+                       if kind is None or entry[0] == kind}
+            best = heapq.nsmallest(k, matches, key=lambda entry: (
+                -self.entries[entry][1], len(self.entries[entry][0]), self.entries[entry][0]))
+            # heaviest first, then shortest name
+            result = [(entry[0], entry[1], self.entries[entry][0]) for entry in best]
+
+            if hi - lo > self.SCAN_LIMIT:
+                self.memo[memo_key] = result
+
+            return result
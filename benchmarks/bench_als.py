@@ -0,0 +1,155 @@
+"""
+Benchmark: ALS recommender training and serving.
+Team Peacock.
+
+Holds out one interaction per user (of the PDM_DSN database, or a synthetic
+catalog with --synthetic), trains on the rest with 1 and --workers
+processes, and reports training time, hit rate@10 on the held-out
+interactions and top-N serving latency from the memory-mapped model.
+
+Usage: python benchmarks/bench_als.py [--synthetic USERS] [--workers N] [--iterations N]
+"""
+
+
+import os
+import sys
+import random
+import tempfile
+import psycopg2
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from als import ITERATIONS, FactorModel, build_matrix, train, save
+from train_als import load_interactions
+
+
+TOP_N = 10
+QUERIES = 2000
+# serving latency samples
+
+
+def synthetic_interactions(users: int, seed: int = 0) -> list:
+    """
+    Generates plays where each user favours a few of 20 taste clusters.
+    """
+
+    rng = random.Random(seed)
+    movies = users // 2 + 100
+    rows = []
+
+    for user in range(users):
+        tastes = rng.sample(range(20), 2)
+
+        for _ in range(rng.randrange(5, 60)):
+            cluster = rng.choice(tastes)
+            mid = rng.randrange(movies // 20) * 20 + cluster
+            rows.append(("user%d" % user, mid, float(rng.randrange(1, 4))))
+
+    return rows
+
+
+def hold_out(rows: list, seed: int = 0) -> tuple:
+    """
+    Moves one random interaction per user (with at least two) to a test set.
+
+    :return: (training rows, {username: held-out mid})
+    """
+
+    rng = random.Random(seed)
+    by_user = {}
+
+    for row in rows:
+        by_user.setdefault(row[0], []).append(row)
+
+    training = []
+    held = {}
+
+    for username, user_rows in by_user.items():
+        if len({row[1] for row in user_rows}) >= 2:
+            test = rng.choice(user_rows)
+            held[username] = test[1]
+            user_rows = [row for row in user_rows if row[1] != test[1]]
+
+        training.extend(user_rows)
+
+    return training, held
+
+
+def evaluate(model: FactorModel, training: list, held: dict) -> tuple:
+    """
+    Measures hit rate@TOP_N and recommendation latency.
+
+    :return: (hit rate, p50 ms, p99 ms)
+    """
+
+    seen = {}
+
+    for username, mid, _ in training:
+        seen.setdefault(username, set()).add(mid)
+
+    hits = 0
+    latencies = []
+
+    for i, (username, mid) in enumerate(held.items()):
+        began = perf_counter()
+        recommended = model.recommend(username, TOP_N, seen.get(username, ()))
+
+        if i < QUERIES:
+            latencies.append(perf_counter() - began)
+
+        hits += mid in recommended
+
+    latencies.sort()
+    return (hits / max(len(held), 1), latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000)
+
+
+def main() -> None:
+    """
+    Runs the benchmark.
+    """
+
+    synthetic = None
+    workers = os.cpu_count()
+    iterations = ITERATIONS
+    args = sys.argv[1:]
+
+    try:
+        if "--synthetic" in args:
+            synthetic = int(args[args.index("--synthetic") + 1])
+        if "--workers" in args:
+            workers = int(args[args.index("--workers") + 1])
+        if "--iterations" in args:
+            iterations = int(args[args.index("--iterations") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    if synthetic is not None:
+        rows = synthetic_interactions(synthetic)
+    else:
+        conn = psycopg2.connect(os.environ["PDM_DSN"])
+        rows = load_interactions(conn)
+        conn.close()
+
+    training, held = hold_out(rows)
+    matrix, users, mids = build_matrix(training)
+    print("%d interactions, %d users x %d movies, %d held out" % (
+        matrix.nnz, len(users), len(mids), len(held)))
+
+    for count in sorted({1, workers}):
+        began = perf_counter()
+        user_factors, item_factors = train(matrix, iterations=iterations, workers=count)
+        print("train  %2d workers  %8.2f s" % (count, perf_counter() - began))
+
+    with tempfile.TemporaryDirectory() as directory:
+        save(directory, user_factors, item_factors, users, mids)
+        hit_rate, p50, p99 = evaluate(FactorModel(directory), training, held)
+
+    print("hit rate@%d  %.3f" % (TOP_N, hit_rate))
+    print("serve  p50 %.3f ms  p99 %.3f ms" % (p50, p99))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Benchmark: per-write commits vs group commit.
+Team Peacock.
+
+Simulated sessions run a mixed write workload (watches, follows/unfollows,
+collection renames) in a scratch "bench_uow" schema of the PDM_DSN
+database. Each mode reports write throughput and commit latency.
+
+Usage: python benchmarks/bench_group_commit.py [--sessions N] [--writes N]
+"""
+
+
+import os
+import sys
+import random
+import threading
+import psycopg2
+from time import perf_counter
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unit_of_work import UnitOfWork, GroupCommitter
+
+
+SESSIONS = 32
+WRITES = 500
+# writes per session
+
+
+def setup(dsn: str, sessions: int) -> None:
+    """
+    Creates the scratch tables.
+    """
+
+    conn = psycopg2.connect(dsn)
+    curs = conn.cursor()
+    curs.execute("DROP SCHEMA IF EXISTS bench_uow CASCADE")
+    curs.execute("CREATE SCHEMA bench_uow")
+    curs.execute("CREATE TABLE bench_uow.watches (username VARCHAR, mid INTEGER, watchdate TIMESTAMP)")
+    curs.execute("""CREATE TABLE bench_uow.friends (username1 VARCHAR, username2 VARCHAR,
+                 PRIMARY KEY (username1, username2))""")
+    curs.execute("CREATE TABLE bench_uow.collection (cid INTEGER PRIMARY KEY, name VARCHAR, username VARCHAR)")
+    curs.execute("""INSERT INTO bench_uow.collection SELECT i, 'collection ' || i, 'user' || i
+                 FROM generate_series(0, %s) i""", (sessions,))
+    conn.commit()
+    conn.close()
+
+
+def workload(session: int, count: int) -> list:
+    """
+    Builds a session's mixed list of (query, params) writes.
+    """
+
+    rng = random.Random(session)
+    user = "user%d" % session
+    writes = []
+
+    for i in range(count):
+        roll = rng.random()
+
+        if roll < 0.6:
+            writes.append(("INSERT INTO bench_uow.watches VALUES (%s, %s, %s)",
+                           (user, rng.randrange(100000), datetime.now())))
+        elif roll < 0.8:
+            writes.append(("""INSERT INTO bench_uow.friends VALUES (%s, %s)
+                           ON CONFLICT DO NOTHING""", (user, "user%d" % rng.randrange(10000))))
+        elif roll < 0.9:
+            writes.append(("DELETE FROM bench_uow.friends WHERE username1 = %s AND username2 = %s",
+                           (user, "user%d" % rng.randrange(10000))))
+        else:
+            writes.append(("UPDATE bench_uow.collection SET name = %s WHERE cid = %s",
+                           ("renamed %d" % i, session)))
+
+    return writes
+
+
+def run_sessions(write_func, sessions: int, writes: int) -> tuple:
+    """
+    Runs every session's workload on its own thread.
+
+    :return: (elapsed seconds, list of per-write latencies)
+    """
+
+    latencies = []
+    lock = threading.Lock()
+
+    def session_thread(session):
+        local = []
+
+        for query, params in workload(session, writes):
+            began = perf_counter()
+            write_func(session, query, params)
+            local.append(perf_counter() - began)
+
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=session_thread, args=(i,)) for i in range(sessions)]
+    began = perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return perf_counter() - began, latencies
+
+
+def report(mode: str, elapsed: float, latencies: list) -> None:
+    """
+    Prints one result line.
+    """
+
+    latencies.sort()
+    print("%-16s %10.0f %10.2f %10.2f" % (
+        mode, len(latencies) / elapsed,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+def main() -> None:
+    """
+    Runs the benchmark.
+    """
+
+    sessions = SESSIONS
+    writes = WRITES
+    args = sys.argv[1:]
+
+    if "--sessions" in args:
+        sessions = int(args[args.index("--sessions") + 1])
+    if "--writes" in args:
+        writes = int(args[args.index("--writes") + 1])
+
+    dsn = os.environ["PDM_DSN"]
+    setup(dsn, sessions)
+    print("%-16s %10s %10s %10s" % ("mode", "writes/s", "p50 ms", "p99 ms"))
+
+    # one commit per write, one connection per session (the PTUI today)
+    conns = [psycopg2.connect(dsn) for _ in range(sessions)]
+
+    def per_write(session, query, params):
+        curs = conns[session].cursor()
+        curs.execute(query, params)
+        conns[session].commit()
+        curs.close()
+
+    report("per-write", *run_sessions(per_write, sessions, writes))
+
+    # each session commits its writes in units of 10
+    units = [UnitOfWork(conn) for conn in conns]
+    counts = [0] * sessions
+
+    def unit_of_work(session, query, params):
+        curs = units[session].cursor()
+        curs.execute(query, params)
+        curs.close()
+        counts[session] += 1
+
+        if counts[session] % 10 == 0:
+            units[session].__exit__(None, None, None)
+
+    report("unit-of-work/10", *run_sessions(unit_of_work, sessions, writes))
+
+    for conn in conns:
+        conn.commit()
+        conn.close()
+
+    for durability in ("strict", "relaxed", "async"):
+        committer = GroupCommitter(lambda: psycopg2.connect(dsn), durability=durability)
+        began = perf_counter()
+        _, latencies = run_sessions(
+            lambda session, query, params: committer.execute(query, params), sessions, writes)
+        committer.close()
+        # close() waits for queued async writes, so they count toward throughput
+        report("group-" + durability, perf_counter() - began, latencies)
+        print("%-16s %d writes in %d groups" % ("", committer.writes, committer.groups))
+
+    conn = psycopg2.connect(dsn)
+    conn.cursor().execute("DROP SCHEMA bench_uow CASCADE")
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark: name listings vs id listings resolved by the name dictionary.
+Team Peacock.
+
+Runs MOVIE_QUERY and MOVIE_ID_QUERY over the same movies against PDM_DSN and
+reports the result payload size (sum of pg_column_size of the rows, which
+approximates the bytes sent), the server execution time (EXPLAIN ANALYZE)
+and the client time including name resolution. The dictionary is loaded
+before timing, as it would be by an earlier run.
+
+Usage: python benchmarks/bench_name_ids.py [--movies N]
+"""
+
+
+import os
+import sys
+import psycopg2
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.pop("PDM_NAME_IDS", None)
+# MOVIE_QUERY must be the name listing whatever mode the caller uses
+
+from PDM_proj import MOVIE_QUERY, MOVIE_ID_QUERY, MOVIE_ID_COLUMNS
+from name_dictionary import NameDictionary
+
+
+MOVIES = 1000
+REPEATS = 5
+
+
+def best_of(func) -> float:
+    """
+    Gets the fastest of REPEATS runs, in milliseconds.
+    """
+
+    times = []
+
+    for _ in range(REPEATS):
+        began = perf_counter()
+        func()
+        times.append((perf_counter() - began) * 1000)
+
+    return min(times)
+
+
+def measure(query: str, mids: list, conn, resolve=None) -> tuple:
+    """
+    Measures one listing query over mids.
+
+    :return: (payload bytes, server ms, client ms)
+    """
+
+    listing = query + " WHERE movie.mid = ANY(%s) GROUP BY movie.mid"
+    curs = conn.cursor()
+    curs.execute("SELECT sum(pg_column_size(q.*)) FROM (" + listing + ") q", (mids,))
+    size = curs.fetchone()[0]
+
+    def server():
+        curs.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + listing, (mids,))
+        return curs.fetchone()[0][0]["Execution Time"]
+
+    server_ms = min(server() for _ in range(REPEATS))
+
+    def client():
+        curs.execute(listing, (mids,))
+        rows = curs.fetchall()
+
+        if resolve is not None:
+            resolve(rows)
+
+    client_ms = best_of(client)
+    curs.close()
+    return size, server_ms, client_ms
+
+
+def main() -> None:
+    """
+    Runs the benchmark.
+    """
+
+    movies = MOVIES
+    args = sys.argv[1:]
+
+    try:
+        if "--movies" in args:
+            movies = int(args[args.index("--movies") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    conn = psycopg2.connect(os.environ["PDM_DSN"])
+    conn.autocommit = True
+    curs = conn.cursor()
+    curs.execute("SELECT mid FROM movie ORDER BY mid LIMIT %s", (movies,))
+    mids = [row[0] for row in curs.fetchall()]
+    curs.close()
+
+    dictionary = NameDictionary()
+    began = perf_counter()
+    loaded = dictionary.refresh(conn, force=True)
+    print("Dictionary: %d names loaded in %.1f ms" % (loaded, (perf_counter() - began) * 1000))
+
+    print("%-8s %12s %10s %10s" % ("listing", "bytes", "server ms", "client ms"))
+
+    for name, query, resolve in (
+            ("names", MOVIE_QUERY, None),
+            ("ids", MOVIE_ID_QUERY, lambda rows: dictionary.resolve_rows(rows, MOVIE_ID_COLUMNS, conn))):
+        size, server_ms, client_ms = measure(query, mids, conn, resolve)
+        print("%-8s %12d %10.2f %10.2f" % (name, size, server_ms, client_ms))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark: per-field prints vs the buffered renderer.
+Team Peacock.
+
+Renders a synthetic result of movie rows (long cast lists included) to
+/dev/null with the old print-per-field data_display loop and with
+renderer.render, reporting render time and the number of terminal writes.
+No database is needed.
+
+Usage: python benchmarks/bench_render.py [--rows N]
+"""
+
+
+import os
+import sys
+import random
+from time import perf_counter
+from contextlib import redirect_stdout
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from renderer import render
+
+
+ROWS = 10000
+
+LABELS = (None, "Title:", "Actor(s):", "Director(s):", "Producer/Studio(s): ",
+          "Length (min):", "MPAA Rating:", "Genre(s):", "Release Date:", "Star Rating:")
+
+
+class CountingSink:
+    """
+    Text stream discarding output and counting writes.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.writes = 0
+
+    def write(self, text: str) -> int:
+        self.writes += 1
+        return self.target.write(text)
+
+    def flush(self) -> None:
+        self.target.flush()
+
+
+def movie_rows(count: int, seed: int = 0) -> list:
+    """
+    Generates MOVIE_QUERY-shaped rows.
+    """
+
+    rng = random.Random(seed)
+    rows = []
+
+    for mid in range(count):
+        rows.append((mid, "Movie %d" % mid,
+                     ["Actor %d" % rng.randrange(100000) for _ in range(rng.randrange(1, 60))],
+                     ["Director %d" % rng.randrange(1000)],
+                     ["Studio %d" % rng.randrange(500) for _ in range(rng.randrange(1, 4))],
+                     rng.randrange(80, 200), rng.choice(["G", "PG", "PG-13", "R"]),
+                     ["Genre %d" % rng.randrange(20) for _ in range(rng.randrange(1, 4))],
+                     [date(rng.randrange(1950, 2024), 1, 1)], round(rng.uniform(1, 5), 3)))
+
+    return rows
+
+
+def print_per_field(data: list, title: str, disp_op: tuple) -> None:
+    """
+    The original data_display loop.
+    """
+
+    count = 0
+
+    for elem in data:
+        count += 1
+        print("\n" + title + " #" + str(count))
+
+        for dp_index in range(len(elem)):
+            if disp_op[dp_index] is not None:
+                print(disp_op[dp_index], elem[dp_index])
+
+    print()
+
+
+def main() -> None:
+    """
+    Runs the benchmark.
+    """
+
+    rows = ROWS
+    args = sys.argv[1:]
+
+    try:
+        if "--rows" in args:
+            rows = int(args[args.index("--rows") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    data = movie_rows(rows)
+
+    with open(os.devnull, "w") as devnull:
+        sink = CountingSink(devnull)
+        began = perf_counter()
+
+        with redirect_stdout(sink):
+            print_per_field(data, "MOVIE", LABELS)
+
+        print("print per field   %8.3f s %9d writes" % (perf_counter() - began, sink.writes))
+
+        for page_size in (20, None):
+            sink = CountingSink(devnull)
+            began = perf_counter()
+            render(data, "MOVIE", LABELS, page_size, sink, ask=lambda prompt: "")
+            print("render page=%-5s %8.3f s %9d writes" % (page_size, perf_counter() - began, sink.writes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark: PTUI start-up time.
+Team Peacock.
+
+Reports the slowest imports from `python -X importtime`, the wall-clock cost
+of importing PDM_proj, and the time until the first menu is printed with
+and without --fast (the process is then told to exit). Uses whatever
+database PDM_proj would (PDM_DSN, a tunnel daemon or the SSH tunnel).
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+"""
+
+
+import os
+import sys
+import subprocess
+from time import perf_counter
+from statistics import median
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 5
+
+
+def import_times() -> list:
+    """
+    Gets (cumulative microseconds, module) for each import of PDM_proj.
+    """
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import PDM_proj"],
+                            cwd=ROOT, capture_output=True, text=True)
+    times = []
+
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times.append((int(cumulative), module.strip()))
+
+    return times
+
+
+def time_import() -> float:
+    """
+    Times a fresh interpreter importing PDM_proj.
+    """
+
+    began = perf_counter()
+    subprocess.run([sys.executable, "-c", "import PDM_proj"], cwd=ROOT, check=True)
+    return perf_counter() - began
+
+
+def time_to_menu(fast: bool) -> float:
+    """
+    Times a PTUI launch until the login menu is printed.
+    """
+
+    args = [sys.executable, "-u", "PDM_proj.py"] + (["--fast"] if fast else [])
+    began = perf_counter()
+    proc = subprocess.Popen(args, cwd=ROOT, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, text=True)
+    elapsed = None
+
+    for line in proc.stdout:
+        if "Please select from the options below" in line:
+            elapsed = perf_counter() - began
+            break
+
+    proc.communicate("3\n")
+    return elapsed if elapsed is not None else float("nan")
+
+
+def main() -> None:
+    """
+    Runs the benchmark.
+    """
+
+    runs = RUNS
+
+    if "--runs" in sys.argv:
+        runs = int(sys.argv[sys.argv.index("--runs") + 1])
+
+    times = import_times()
+    print("slowest imports (cumulative ms):")
+
+    for cumulative, module in sorted(times, reverse=True)[:10]:
+        print("  %8.1f  %s" % (cumulative / 1000, module))
+
+    print("\nimport PDM_proj:   %.3f s (median of %d)" % (median(time_import() for _ in range(runs)), runs))
+    print("menu (blocking):   %.3f s" % median(time_to_menu(False) for _ in range(runs)))
+    print("menu (--fast):     %.3f s" % median(time_to_menu(True) for _ in range(runs)))
+
+
+if __name__ == "__main__":
+    main()
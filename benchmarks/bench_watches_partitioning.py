@@ -0,0 +1,135 @@
+"""
+Benchmark: partitioned vs unpartitioned watches.
+Team Peacock.
+
+Loads the same synthetic watch history into a plain table and a monthly
+range-partitioned table (in a scratch "bench" schema) and times the
+recency-bounded leaderboard queries against both. Runs against the database
+given by PDM_DSN.
+
+Usage: python benchmarks/bench_watches_partitioning.py [--rows N] [--months N]
+"""
+
+
+import os
+import sys
+import psycopg2
+from time import perf_counter
+
+
+ROWS = 500_000_000
+MONTHS = 36
+BATCH = 10_000_000
+USERS = 1_000_000
+MOVIES = 100_000
+
+QUERIES = {
+    "top 20 last 90 days": """SELECT mid, count(*) FROM {table}
+        WHERE watchdate > CURRENT_DATE - INTERVAL '90 days'
+        GROUP BY mid ORDER BY count(*) DESC LIMIT 20""",
+    "top 5 this month": """SELECT mid, count(*) FROM {table}
+        WHERE watchdate >= date_trunc('month', current_date)
+        GROUP BY mid ORDER BY count(*) DESC LIMIT 5""",
+    "one user's history": """SELECT mid, count(*) FROM {table}
+        WHERE username = 'user42' GROUP BY mid""",
+}
+
+
+def setup(curs, rows: int, months: int) -> None:
+    """
+    Creates and loads both watches tables.
+    """
+
+    curs.execute("DROP SCHEMA IF EXISTS bench CASCADE")
+    curs.execute("CREATE SCHEMA bench")
+    curs.execute("""CREATE UNLOGGED TABLE bench.watches_plain
+                 (username VARCHAR, mid INTEGER, watchdate TIMESTAMP)""")
+    curs.execute("""CREATE UNLOGGED TABLE bench.watches_parted
+                 (username VARCHAR, mid INTEGER, watchdate TIMESTAMP)
+                 PARTITION BY RANGE (watchdate)""")
+
+    for month in range(-months, 2):
+        curs.execute(f"""CREATE UNLOGGED TABLE bench.watches_parted_{month + months}
+                     PARTITION OF bench.watches_parted FOR VALUES
+                     FROM (date_trunc('month', CURRENT_DATE) + INTERVAL '{month} months')
+                     TO (date_trunc('month', CURRENT_DATE) + INTERVAL '{month + 1} months')""")
+
+    for start in range(0, rows, BATCH):
+        count = min(BATCH, rows - start)
+        began = perf_counter()
+
+        for table in ("watches_plain", "watches_parted"):
+            curs.execute(f"""INSERT INTO bench.{table}
+                SELECT 'user' || (random() * {USERS})::int,
+                       (random() * {MOVIES})::int,
+                       date_trunc('month', CURRENT_DATE) - INTERVAL '{months} months'
+                           + random() * (CURRENT_DATE - (date_trunc('month', CURRENT_DATE)
+                           - INTERVAL '{months} months'))
+                FROM generate_series(1, {count})""")
+
+        print("loaded %d / %d rows (%.1fs)" % (start + count, rows, perf_counter() - began))
+
+    for table in ("watches_plain", "watches_parted"):
+        curs.execute(f"CREATE INDEX ON bench.{table} (username, watchdate)")
+        curs.execute(f"CREATE INDEX ON bench.{table} (mid, watchdate)")
+        curs.execute(f"ANALYZE bench.{table}")
+
+
+def scanned_relations(curs, query: str) -> int:
+    """
+    Counts the relations a query's plan touches.
+    """
+
+    curs.execute("EXPLAIN (FORMAT JSON) " + query)
+    plan = curs.fetchone()[0][0]["Plan"]
+    stack = [plan]
+    relations = set()
+
+    while stack:
+        node = stack.pop()
+        if "Relation Name" in node:
+            relations.add(node["Relation Name"])
+        stack.extend(node.get("Plans", []))
+
+    return len(relations)
+
+
+def main() -> None:
+    """
+    Runs the benchmark.
+    """
+
+    rows = ROWS
+    months = MONTHS
+    args = sys.argv[1:]
+
+    if "--rows" in args:
+        rows = int(args[args.index("--rows") + 1])
+    if "--months" in args:
+        months = int(args[args.index("--months") + 1])
+
+    conn = psycopg2.connect(os.environ["PDM_DSN"])
+    conn.autocommit = True
+    curs = conn.cursor()
+
+    setup(curs, rows, months)
+
+    print("\n%-22s %-8s %10s %10s" % ("query", "table", "seconds", "relations"))
+
+    for name, query in QUERIES.items():
+        for table in ("watches_plain", "watches_parted"):
+            sql_text = query.format(table="bench." + table)
+            began = perf_counter()
+            curs.execute(sql_text)
+            curs.fetchall()
+            elapsed = perf_counter() - began
+            print("%-22s %-8s %10.3f %10d" % (name, table[8:], elapsed,
+                                              scanned_relations(curs, sql_text)))
+
+    curs.execute("DROP SCHEMA bench CASCADE")
+    curs.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Load test: concurrent scripted PTUI sessions.
+Team Peacock.
+
+Simulated users replay the PTUI flows (login, search, watch, rate,
+collection edits, friends, recommendations) by calling PDM_proj's query
+functions directly, each on its own connection to PDM_DSN. Reports
+per-operation throughput and latency percentiles, errors, and lock waits
+sampled from pg_stat_activity / pg_locks while the test runs.
+
+Run once with --setup to create the loadtest<N> accounts. Every simulated
+user holds a connection, so the server's max_connections must exceed
+--users (plus two for the lock sampler).
+
+Usage: python benchmarks/load_test.py [--setup] [--users N] [--duration SECONDS]
+"""
+
+
+import os
+import sys
+import random
+import hashlib
+import threading
+import psycopg2
+from time import perf_counter, sleep
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDM_proj
+
+
+USERS = 200
+DURATION = 60.0
+PASSWORD = "loadtest"
+SAMPLE_INTERVAL = 0.1
+# seconds between lock samples
+THINK_TIME = 0.05
+# mean seconds a simulated user pauses between operations
+
+
+def setup(dsn: str, users: int) -> None:
+    """
+    Registers the loadtest accounts that do not exist yet.
+    """
+
+    conn = psycopg2.connect(dsn)
+    curs = conn.cursor()
+    curs.execute("""SELECT username FROM "User" WHERE username LIKE 'loadtest%'""")
+    existing = {row[0] for row in curs.fetchall()}
+    curs.close()
+
+    for i in range(users):
+        username = "loadtest%d" % i
+
+        if username not in existing:
+            salt = hashlib.sha3_256(username.encode("utf-8")).hexdigest()
+            PDM_proj.register(username, PASSWORD, username + "@loadtest.invalid",
+                              "Load", "Test %d" % i, salt, conn)
+
+    conn.close()
+
+
+def search_terms(dsn: str) -> list:
+    """
+    Samples words of movie titles to search for.
+    """
+
+    conn = psycopg2.connect(dsn)
+    curs = conn.cursor()
+    curs.execute("SELECT title FROM movie ORDER BY random() LIMIT 500")
+    words = [word for title, in curs.fetchall() for word in title.split() if len(word) > 3]
+    conn.close()
+    return words or ["the"]
+
+
+class Session:
+    """
+    One simulated user replaying scripted sessions.
+    """
+
+    def __init__(self, dsn: str, user: int, users: int, terms: list, stats: dict, lock):
+        self.conn = psycopg2.connect(dsn)
+        self.username = "loadtest%d" % user
+        self.users = users
+        self.rng = random.Random(user)
+        self.terms = terms
+        self.stats = stats
+        # operation -> [latencies], shared by every session
+        self.errors = stats.setdefault("errors", {})
+        self.lock = lock
+
+    def timed(self, name: str, func, *args):
+        """
+        Runs and times one operation; failures are counted and rolled back.
+        """
+
+        began = perf_counter()
+
+        try:
+            result = func(*args, self.conn)
+        except Exception:
+            self.conn.rollback()
+
+            with self.lock:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+
+        elapsed = perf_counter() - began
+
+        with self.lock:
+            self.stats.setdefault(name, []).append(elapsed)
+
+        sleep(self.rng.expovariate(1 / THINK_TIME))
+        return result
+
+    def run_once(self) -> None:
+        """
+        Replays one scripted session.
+        """
+
+        rng = self.rng
+        user = self.username
+        self.timed("login", PDM_proj.login, user, PASSWORD)
+
+        term = rng.choice(self.terms)
+        movies = self.timed("search", lambda conn: PDM_proj.find_movies(1, term, 0, "a", conn, limit=20)) or []
+        # title search, first page
+
+        if movies:
+            movie = rng.choice(movies)
+            self.timed("watch", PDM_proj.watch_movie, user, movie)
+            self.timed("rate", PDM_proj.rate, user, movie, rng.randrange(1, 6))
+
+        collections = self.timed("get_collections", PDM_proj.get_collections, user) or []
+
+        if not collections or rng.random() < 0.2:
+            self.timed("add_collection", PDM_proj.add_collection, user, "load %d" % rng.randrange(10 ** 6))
+        else:
+            collection = rng.choice(collections)
+            roll = rng.random()
+
+            if roll < 0.4 and movies:
+                self.timed("add_to_collection", PDM_proj.add_movie_to_collection, user, collection,
+                           rng.choice(movies))
+            elif roll < 0.7:
+                self.timed("rename_collection", PDM_proj.rename_collection, user, collection,
+                           "renamed %d" % rng.randrange(10 ** 6))
+            elif roll < 0.8 and len(collections) > 3:
+                self.timed("del_collection", PDM_proj.del_collection, user, collection)
+
+            self.timed("open_collection", PDM_proj.find_from_collection, user, collection, 0, "a")
+
+        friend = ("loadtest%d" % rng.randrange(self.users),)
+
+        if friend[0] != user:
+            follow = PDM_proj.follow if rng.random() < 0.6 else PDM_proj.unfollow
+            self.timed(follow.__name__, follow, user, friend)
+
+        roll = rng.random()
+
+        if roll < 0.4:
+            self.timed("top_20", PDM_proj.get_overall_top_20_movies)
+        elif roll < 0.7:
+            self.timed("friends_top_20", PDM_proj.get_friends_top_20_movies, user)
+        else:
+            self.timed("recommended", PDM_proj.get_recommended_movies, user)
+
+    def run(self, deadline: float) -> None:
+        """
+        Replays sessions until the deadline.
+        """
+
+        try:
+            while perf_counter() < deadline:
+                self.run_once()
+        finally:
+            self.conn.close()
+
+
+def sample_locks(dsn: str, stop: threading.Event, samples: list) -> None:
+    """
+    Samples lock waits until stop is set.
+
+    Appends (sessions waiting on a lock, ungranted locks) per sample.
+    """
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    curs = conn.cursor()
+
+    while not stop.wait(SAMPLE_INTERVAL):
+        curs.execute("""SELECT count(*) FROM pg_stat_activity
+                     WHERE datname = current_database() AND wait_event_type = 'Lock'""")
+        waiting = curs.fetchone()[0]
+        curs.execute("SELECT count(*) FROM pg_locks WHERE NOT granted")
+        samples.append((waiting, curs.fetchone()[0]))
+
+    conn.close()
+
+
+def deadlocks(dsn: str) -> int:
+    """
+    Gets the database's deadlock counter.
+    """
+
+    conn = psycopg2.connect(dsn)
+    curs = conn.cursor()
+    curs.execute("SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()")
+    count = curs.fetchone()[0]
+    conn.close()
+    return count
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Gets a percentile of sorted values.
+    """
+
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main() -> None:
+    """
+    Runs the load test.
+    """
+
+    users = USERS
+    duration = DURATION
+    args = sys.argv[1:]
+
+    try:
+        if "--users" in args:
+            users = int(args[args.index("--users") + 1])
+        if "--duration" in args:
+            duration = float(args[args.index("--duration") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    dsn = os.environ["PDM_DSN"]
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        # the query functions print their outcome as the PTUI would
+        if "--setup" in args:
+            setup(dsn, users)
+
+        terms = search_terms(dsn)
+        stats = {}
+        lock = threading.Lock()
+        sessions = [Session(dsn, user, users, terms, stats, lock) for user in range(users)]
+        samples = []
+        stop = threading.Event()
+        deadlocks_before = deadlocks(dsn)
+
+        sampler = threading.Thread(target=sample_locks, args=(dsn, stop, samples))
+        sampler.start()
+
+        began = perf_counter()
+        deadline = began + duration
+        threads = [threading.Thread(target=session.run, args=(deadline,)) for session in sessions]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = perf_counter() - began
+        stop.set()
+        sampler.join()
+        deadlock_count = deadlocks(dsn) - deadlocks_before
+
+    errors = stats.pop("errors", {})
+    print("%d users for %.0fs" % (users, elapsed))
+    print("%-18s %8s %8s %9s %9s %9s %7s" % ("operation", "count", "ops/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+
+    for name in sorted(set(stats) | set(errors)):
+        latencies = sorted(stats.get(name, [])) or [0.0]
+        print("%-18s %8d %8.1f %9.2f %9.2f %9.2f %7d" % (
+            name, len(stats.get(name, [])), len(stats.get(name, [])) / elapsed,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000, errors.get(name, 0)))
+
+    if samples:
+        waiting = [sample[0] for sample in samples]
+        print("lock waits: %.1f%% of samples, mean %.2f / max %d sessions waiting, max %d ungranted locks" % (
+            100 * sum(1 for w in waiting if w > 0) / len(samples), sum(waiting) / len(samples),
+            max(waiting), max(sample[1] for sample in samples)))
+
+    print("deadlocks: %d" % deadlock_count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Popularity sketch rebuild and accuracy check.
+Team Peacock.
+
+--rebuild rewrites the per-day popularity sketches (popularity_sketch.py) of
+the last --days days from watches, with the sketch parameters set by the
+PDM_SKETCH_* variables (see PDM_proj.POPULARITY). Run it once before
+enabling PDM_POPULARITY=sketch, and after changing the parameters; sessions
+keep the sketches current from then on.
+
+--check compares the sketch top 20 of the last 90 days with exact counts
+from watches: plays, distinct viewers and which movies were ranked.
+
+Usage: python build_popularity.py [--rebuild] [--days N] [--check]
+"""
+
+
+import sys
+import psycopg2
+from time import perf_counter
+from datetime import date, timedelta
+from popularity_sketch import RETAIN_DAYS
+from PDM_proj import db_params, new_popularity_sketch
+
+
+FETCH_ROWS = 10000
+# rows per round trip of the rebuild cursor
+
+REBUILD_QUERY = """SELECT watchdate::DATE, mid, username, count(*) FROM watches
+                WHERE watchdate >= %s GROUP BY 1, 2, 3
+                ORDER BY 1, sum(count(*)) OVER (PARTITION BY watchdate::DATE, mid) DESC, 2"""
+# each day's movies most played first, so the heavy hitters are tracked (and
+# their viewers counted) from their first watch
+
+
+def rebuild(days: int, conn) -> tuple:
+    """
+    Rewrites the windows of the last days days from watches.
+
+    :return: (windows written, watches summarized, bytes stored)
+    """
+
+    sketch = new_popularity_sketch()
+    since = date.today() - timedelta(days=days - 1)
+    curs = conn.cursor(name="popularity_rebuild")
+    curs.itersize = FETCH_ROWS
+    curs.execute(REBUILD_QUERY, (since,))
+    windows = {}
+    watches = 0
+
+    for day, mid, username, plays in curs:
+        window = windows.get(day)
+
+        if window is None:
+            window = windows[day] = sketch.new_window()
+
+        window.add(mid, username, plays)
+        watches += plays
+
+    curs.close()
+    stored = 0
+    curs = conn.cursor()
+    curs.execute("DELETE FROM popularity_sketches WHERE window_start >= %s", (since,))
+
+    for day, window in windows.items():
+        data = window.to_bytes()
+        curs.execute("INSERT INTO popularity_sketches (window_start, version, sketch) VALUES (%s, 0, %s)",
+                     (day, data))
+        stored += len(data)
+
+    conn.commit()
+    curs.close()
+    return len(windows), watches, stored
+
+
+def check(conn) -> None:
+    """
+    Prints the sketch top 20 of the last 90 days next to exact counts.
+    """
+
+    since = date.today() - timedelta(days=90)
+    began = perf_counter()
+    top = new_popularity_sketch().top(20, since, conn)
+    elapsed = perf_counter() - began
+
+    curs = conn.cursor()
+    curs.execute("""SELECT mid, count(*), count(DISTINCT username) FROM watches
+                 WHERE watchdate::DATE >= %s GROUP BY mid ORDER BY 2 DESC, 1""", (since,))
+    exact = {mid: (plays, viewers) for mid, plays, viewers in curs.fetchall()}
+    exact_top = list(exact)[:20]
+    curs.execute("SELECT count(*), sum(length(sketch)) FROM popularity_sketches WHERE window_start >= %s",
+                 (since,))
+    windows, size = curs.fetchone()
+    curs.close()
+
+    print("%8s %10s %10s %8s %10s %10s" % ("mid", "plays", "exact", "bound", "viewers", "exact"))
+
+    for mid, plays, bound, viewers in top:
+        exact_plays, exact_viewers = exact.get(mid, (0, 0))
+        print("%8d %10d %10d %8d %10s %10d" % (mid, plays, exact_plays, bound,
+                                               "-" if viewers is None else "%.0f" % viewers, exact_viewers))
+
+    recall = len({row[0] for row in top} & set(exact_top)) / max(len(exact_top), 1)
+    print("top 20 recall %.0f%%, answered in %.1f ms from %d windows (%d bytes)" % (
+        100 * recall, elapsed * 1000, windows, size or 0))
+
+
+def main() -> None:
+    """
+    Rebuilds and/or checks the popularity sketches.
+    """
+
+    days = RETAIN_DAYS
+    args = sys.argv[1:]
+
+    try:
+        if "--days" in args:
+            days = int(args[args.index("--days") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    if "--rebuild" not in args and "--check" not in args:
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            if "--rebuild" in args:
+                began = perf_counter()
+                windows, watches, stored = rebuild(days, conn)
+                print("Summarized %d watches into %d windows (%d bytes) in %.1fs" % (
+                    watches, windows, stored, perf_counter() - began))
+
+            if "--check" in args:
+                check(conn)
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
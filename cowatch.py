@@ -0,0 +1,286 @@
+"""
+"Because you watched" co-watch index.
+Team Peacock.
+
+Counts, for every pair of movies, the user weeks (one user's watches in one
+calendar week) in which both were watched, and keeps each movie's most
+co-watched movies in cowatch_topk (see migrations/0011_cowatch.sql), where
+PDM_proj.get_cowatched_movies looks them up.
+
+--rebuild recounts everything: the watches are loaded in chunks into a
+sparse movie x user-week matrix and its co-occurrence product is computed a
+run of movies at a time (similar_movies.top_k_neighbours sizes the runs so
+each product holds a bounded number of entries). The new counts are staged
+and swapped in at the end, so readers keep seeing the old ones meanwhile.
+Without --rebuild only the watches queued in cowatch_pending since the last
+run are counted (a trigger queues every inserted watch when its transaction
+commits, however old its watchdate): the weeks they fall in are reloaded
+and the pairs they form are added to the stored counts. Run it regularly
+(e.g. from cron).
+
+Each movie keeps its --keep most co-watched movies, more than a list
+shows, so a movie can climb into the list from below. A pair dropped from
+the table restarts from the new watches' count if it comes back; --rebuild
+restores exact counts. Watches rolled up by partitions.py are no longer
+counted.
+
+Usage: python cowatch.py [--rebuild] [--keep N] [--batch N]
+"""
+
+
+import io
+import sys
+import psycopg2
+from time import perf_counter
+from collections import Counter
+from PDM_proj import db_params
+from similar_movies import top_k_neighbours
+
+
+KEEP = 50
+# co-watched movies stored per movie
+BATCH = 1024
+# maximum movies per co-occurrence product
+FETCH_ROWS = 100000
+# (movie, user week) pairs loaded per chunk
+COPY_ROWS = 100000
+# rows buffered per COPY
+
+BASKET_QUERY = """SELECT mid, dense_rank() OVER (ORDER BY username, week) - 1 FROM (
+                SELECT DISTINCT username, date_trunc('week', watchdate) AS week, mid
+                FROM watches) baskets"""
+# (movie, user week number) for every movie watched in a user week
+
+
+def begin_snapshot(curs) -> None:
+    """
+    Starts a repeatable-read transaction holding the co-watch writer lock.
+
+    The snapshot is taken by the first query after the lock, so the watches
+    a run reads and the cowatch_pending rows it consumes always match.
+    """
+
+    curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    curs.execute("LOCK TABLE cowatch_topk IN SHARE ROW EXCLUSIVE MODE")
+    # one writer at a time; readers are not blocked
+
+
+def load_baskets(conn) -> tuple:
+    """
+    Builds the movie x user-week incidence matrix of the watches.
+
+    :return: (CSR matrix, array of mids in row order)
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    curs = conn.cursor(name="cowatch_baskets")
+    curs.execute(BASKET_QUERY)
+    chunks = []
+
+    while True:
+        rows = curs.fetchmany(FETCH_ROWS)
+
+        if not rows:
+            break
+
+        chunks.append(np.array(rows, dtype=np.int64))
+
+    curs.close()
+
+    if not chunks:
+        return sparse.csr_matrix((0, 0), dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+    pairs = np.concatenate(chunks)
+    mids, rows = np.unique(pairs[:, 0], return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(pairs), dtype=np.int32), (rows, pairs[:, 1])),
+                               shape=(len(mids), int(pairs[:, 1].max()) + 1))
+    return matrix, mids
+
+
+def rebuild(keep: int, batch: int, conn) -> tuple:
+    """
+    Recounts cowatch_topk from all watches.
+
+    The counts are copied into a staging table first and replace the old
+    ones with one DELETE and INSERT, so readers are never blocked and see
+    the old counts until commit.
+
+    :return: (movies, rows written)
+    """
+
+    curs = conn.cursor()
+    begin_snapshot(curs)
+    curs.execute("DELETE FROM cowatch_pending")
+    # these watches are in the snapshot counted below; later ones stay queued
+
+    matrix, mids = load_baskets(conn)
+    curs.execute("CREATE TEMP TABLE cowatch_staging (LIKE cowatch_topk) ON COMMIT DROP")
+    buffer = io.StringIO()
+    buffered = 0
+    count = 0
+
+    for row, cols, counts in top_k_neighbours(matrix, keep, batch):
+        for col, together in zip(cols, counts):
+            buffer.write("%d\t%d\t%d\n" % (mids[row], mids[col], together))
+
+        buffered += len(cols)
+        count += len(cols)
+
+        if buffered >= COPY_ROWS:
+            copy_rows(buffer, curs)
+            buffer = io.StringIO()
+            buffered = 0
+
+    copy_rows(buffer, curs)
+    curs.execute("DELETE FROM cowatch_topk")
+    curs.execute("INSERT INTO cowatch_topk (mid, other_mid, count) SELECT mid, other_mid, count FROM cowatch_staging")
+    curs.execute("""INSERT INTO cowatch_state (id, rebuilt_at) VALUES (TRUE, now())
+                 ON CONFLICT (id) DO UPDATE SET rebuilt_at = EXCLUDED.rebuilt_at""")
+    conn.commit()
+    curs.close()
+    return len(mids), count
+
+
+def copy_rows(buffer: io.StringIO, curs) -> None:
+    """
+    Copies buffered co-watch rows into the staging table.
+    """
+
+    buffer.seek(0)
+    curs.copy_expert("COPY cowatch_staging (mid, other_mid, count) FROM STDIN", buffer)
+
+
+def pair_deltas(new_baskets: dict, old_baskets: dict) -> Counter:
+    """
+    Counts the pairs the new watches add to their user weeks.
+
+    :param new_baskets: (username, week) -> mids of the queued watches
+    :param old_baskets: (username, week) -> mids counted before
+    :return: a Counter of (mid, other mid) -> user weeks added
+    """
+
+    deltas = Counter()
+
+    for basket, added in new_baskets.items():
+        seen = set(old_baskets.get(basket, ()))
+
+        for mid in sorted(added - seen):
+            for other in seen:
+                deltas[mid, other] += 1
+                deltas[other, mid] += 1
+
+            seen.add(mid)
+
+    return deltas
+
+
+def update(keep: int, conn) -> tuple:
+    """
+    Adds the pairs formed by the watches queued since the last run.
+
+    :return: (watches counted, pairs updated), or None before a rebuild
+    """
+
+    from psycopg2.extras import execute_values
+
+    curs = conn.cursor()
+    begin_snapshot(curs)
+    curs.execute("SELECT rebuilt_at FROM cowatch_state")
+
+    if curs.fetchone() is None:
+        conn.rollback()
+        curs.close()
+        return None
+
+    curs.execute("DELETE FROM cowatch_pending RETURNING username, date_trunc('week', watchdate), mid")
+    watches = curs.fetchall()
+
+    if not watches:
+        conn.rollback()
+        curs.close()
+        return 0, 0
+
+    new_baskets = {}
+    queued = Counter()
+
+    for username, week, mid in watches:
+        new_baskets.setdefault((username, week), set()).add(mid)
+        queued[username, week, mid] += 1
+
+    users, weeks = zip(*new_baskets)
+    curs.execute("""SELECT b.username, b.week, w.mid, count(*)
+                 FROM unnest(%s::VARCHAR[], %s::TIMESTAMP[]) AS b (username, week)
+                 INNER JOIN watches w ON w.username = b.username
+                 AND w.watchdate >= b.week AND w.watchdate < b.week + INTERVAL '1 week'
+                 GROUP BY 1, 2, 3""", (list(users), list(weeks)))
+    # the weeks' watches in the snapshot, through the (username, watchdate) index
+    old_baskets = {}
+
+    for username, week, mid, plays in curs.fetchall():
+        if plays > queued[username, week, mid]:
+            old_baskets.setdefault((username, week), set()).add(mid)
+            # watched in that week before the queued watches
+
+    deltas = pair_deltas(new_baskets, old_baskets)
+
+    if deltas:
+        execute_values(curs, """INSERT INTO cowatch_topk (mid, other_mid, count) VALUES %s
+                       ON CONFLICT (mid, other_mid) DO UPDATE SET count = cowatch_topk.count + EXCLUDED.count""",
+                       [(mid, other, added) for (mid, other), added in deltas.items()])
+        curs.execute("""DELETE FROM cowatch_topk c USING (
+                     SELECT mid, other_mid, row_number() OVER (PARTITION BY mid ORDER BY count DESC, other_mid) AS rank
+                     FROM cowatch_topk WHERE mid = ANY(%s)) ranked
+                     WHERE c.mid = ranked.mid AND c.other_mid = ranked.other_mid AND ranked.rank > %s""",
+                     (list({mid for mid, _ in deltas}), keep))
+        # keeps each changed movie's keep most co-watched movies
+
+    conn.commit()
+    curs.close()
+    return len(watches), len(deltas)
+
+
+def main() -> None:
+    """
+    Rebuilds or updates cowatch_topk.
+    """
+
+    keep = KEEP
+    batch = BATCH
+    args = sys.argv[1:]
+
+    try:
+        if "--keep" in args:
+            keep = int(args[args.index("--keep") + 1])
+        if "--batch" in args:
+            batch = int(args[args.index("--batch") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            began = perf_counter()
+
+            if "--rebuild" in args:
+                movies, count = rebuild(keep, batch, conn)
+                print("Stored %d co-watch pairs of %d movies in %.1fs" % (count, movies, perf_counter() - began))
+                return
+
+            result = update(keep, conn)
+
+            if result is None:
+                print("No co-watch counts yet, run python cowatch.py --rebuild first")
+                sys.exit(1)
+
+            print("Counted %d new watches (%d pairs updated) in %.1fs" % (
+                result[0], result[1], perf_counter() - began))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
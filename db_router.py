@@ -0,0 +1,262 @@
+"""
+Read/write routing to replica connections.
+Team Peacock.
+
+Query functions are tagged as reads or writes (see routed). Writes run on
+the caller's connection to the primary. Reads run on a streaming replica,
+picked round robin from the healthy ones, each thread using its own
+autocommit connection to it.
+
+After a user's write, that user's reads stay on the primary (read your
+writes) until a replica has replayed the write: the primary's WAL position
+is noted after the write and a replica is only used again once its
+pg_last_wal_replay_lsn() has passed it. The stickiness also ends after
+sticky seconds, so a replica lagging by more than that serves stale reads
+(a server that is not a standby never reports a replay position and is
+only used for the user's reads again then). Reads of functions that take no
+username are never sticky.
+
+A replica that fails is skipped for retry seconds and the read is run on
+the primary instead.
+"""
+
+
+import threading
+from time import monotonic
+
+
+class Router:
+    """
+    Routes reads to replicas, with per-user read-your-writes stickiness.
+    """
+
+    def __init__(self, replicas: list, connect, sticky: float = 30.0, retry: float = 30.0):
+        """
+        :param replicas: replica DSNs
+        :param connect: function returning a new psycopg2 connection to a DSN
+        :param sticky: longest time (seconds) a user's reads stay on the
+            primary after the user's write
+        :param retry: seconds a failed replica is skipped
+        """
+
+        self.replicas = list(replicas)
+        self.connect = connect
+        self.sticky = sticky
+        self.retry = retry
+        self.local = threading.local()
+        # per-thread {dsn: connection} and write nesting depth
+        self.connections = []
+        self.pending = {}
+        # username -> (primary LSN after the write, sticky deadline, caught up replica DSNs)
+        self.down = {}
+        # replica DSN -> time it is tried again
+        self.turn = 0
+        self.lock = threading.Lock()
+        self.primary_reads = 0
+        self.replica_reads = 0
+
+    def replica_connection(self, dsn: str):
+        """
+        Gets this thread's connection to a replica, opening it if needed.
+        """
+
+        connections = self.local.__dict__.setdefault("connections", {})
+        conn = connections.get(dsn)
+
+        if conn is None or conn.closed:
+            conn = self.connect(dsn)
+            conn.autocommit = True
+            # reads only; never hold a snapshot open on the replica
+            connections[dsn] = conn
+
+            with self.lock:
+                self.connections.append(conn)
+
+        return conn
+
+    def fail(self, dsn: str) -> None:
+        """
+        Skips a replica for retry seconds and drops this thread's connection.
+        """
+
+        with self.lock:
+            self.down[dsn] = monotonic() + self.retry
+
+        conn = self.local.__dict__.get("connections", {}).pop(dsn, None)
+
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def healthy(self) -> list:
+        """
+        Gets the replicas not skipped, starting at the next in turn.
+        """
+
+        now = monotonic()
+
+        with self.lock:
+            replicas = [dsn for dsn in self.replicas if self.down.get(dsn, 0) <= now]
+            self.turn += 1
+            turn = self.turn
+
+        if not replicas:
+            return []
+
+        start = turn % len(replicas)
+        return replicas[start:] + replicas[:start]
+
+    def caught_up(self, username: str, dsn: str, conn) -> bool:
+        """
+        Checks whether a replica may serve a user's reads.
+        """
+
+        with self.lock:
+            entry = self.pending.get(username)
+
+            if entry is None:
+                return True
+
+            lsn, deadline, replayed = entry
+
+            if monotonic() > deadline:
+                del self.pending[username]
+                return True
+
+            if dsn in replayed:
+                return True
+
+        curs = conn.cursor()
+        curs.execute("SELECT COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, FALSE)", (lsn,))
+        done = curs.fetchone()[0]
+        curs.close()
+
+        if done:
+            with self.lock:
+                entry = self.pending.get(username)
+
+                if entry is not None:
+                    entry[2].add(dsn)
+
+                    if entry[2].issuperset(self.replicas):
+                        del self.pending[username]
+                        # every replica has the write
+
+        return done
+
+    def read(self, func, args: tuple, kwargs: dict, username: str = None):
+        """
+        Runs a read on a replica, or on the caller's connection (the
+        primary) if none may serve it.
+        """
+
+        if getattr(self.local, "writing", 0) == 0:
+            # reads inside a write see the primary, like the write itself
+            for dsn in self.healthy():
+                try:
+                    conn = self.replica_connection(dsn)
+
+                    if username is not None and not self.caught_up(username, dsn, conn):
+                        continue
+
+                    result = func(*args[:-1], conn, **kwargs)
+                except Exception as e:
+                    if not is_connection_error(e):
+                        raise
+
+                    self.fail(dsn)
+                    continue
+
+                self.replica_reads += 1
+                return result
+
+        self.primary_reads += 1
+        return func(*args, **kwargs)
+
+    def write(self, func, args: tuple, kwargs: dict, username: str = None):
+        """
+        Runs a write on the caller's connection and makes the user's reads
+        sticky to the primary.
+        """
+
+        self.local.writing = getattr(self.local, "writing", 0) + 1
+
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            self.local.writing -= 1
+
+        if username is not None and self.replicas:
+            conn = args[-1]
+            curs = conn.cursor()
+            curs.execute("SELECT pg_current_wal_insert_lsn()::TEXT")
+            lsn = curs.fetchone()[0]
+            curs.close()
+
+            if not conn.autocommit:
+                conn.commit()
+                # ends the transaction the SELECT opened, so the primary
+                # connection is not left idle in transaction
+
+            with self.lock:
+                self.pending[username] = (lsn, monotonic() + self.sticky, set())
+
+        return result
+
+    def close(self) -> None:
+        """
+        Closes every replica connection.
+        """
+
+        with self.lock:
+            for conn in self.connections:
+                if not conn.closed:
+                    conn.close()
+
+            self.connections = []
+
+
+def is_connection_error(error: Exception) -> bool:
+    """
+    Checks whether an error means the server or connection is unusable.
+    """
+
+    import psycopg2
+
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+def routed(kind: str, get_router):
+    """
+    Decorator factory tagging query functions as reads or writes.
+
+    The decorated function must take the database connection as its last
+    positional argument; if its first parameter is username, that user's
+    reads get read-your-writes stickiness.
+
+    :param kind: "read" or "write"
+    :param get_router: function returning the Router, or None to run every
+        query on the caller's connection
+    """
+
+    def decorator(func):
+        keyed = func.__code__.co_argcount > 0 and func.__code__.co_varnames[0] == "username"
+
+        def wrapper(*args, **kwargs):
+            router = get_router()
+
+            if router is None:
+                return func(*args, **kwargs)
+
+            username = args[0] if keyed else None
+
+            if kind == "write":
+                return router.write(func, args, kwargs, username)
+
+            return router.read(func, args, kwargs, username)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.routes = kind
+        return wrapper
+
+    return decorator
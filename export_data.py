@@ -0,0 +1,191 @@
+"""
+User data export.
+Team Peacock.
+
+Streams one user's (or every user's) watches, monthly play rollups, ratings,
+collections and collection movies to one file per table. CSV is written by
+COPY ... TO STDOUT and JSON Lines through a server-side cursor, so memory use
+stays constant however much history there is. Files can be gzip compressed.
+
+Usage: python export_data.py [--user USERNAME] [--format csv|jsonl] [--gzip] [--out DIR]
+"""
+
+
+import os
+import sys
+import gzip
+import json
+import psycopg2
+from time import perf_counter
+from PDM_proj import db_params
+
+
+# (file name, query selecting every user's rows, user filter)
+EXPORTS = (
+    ("watches", "SELECT username, mid, watchdate FROM watches", "username = %s"),
+    ("watches_monthly", "SELECT username, mid, month, plays FROM watches_user_monthly",
+     "username = %s"),
+    ("rates", "SELECT username, mid, rating FROM rates", "username = %s"),
+    ("collections", "SELECT cid, name, username FROM collection", "username = %s"),
+    ("collection_movies", """SELECT cm.cid, cm.mid FROM collectionmovies cm
+                          JOIN collection c ON cm.cid = c.cid""", "c.username = %s"),
+)
+
+OPTIONAL_TABLES = {"watches_monthly": "watches_user_monthly"}
+# exports skipped when their table is missing (partitioning not installed)
+
+FETCH_ROWS = 10000
+# rows per round trip of the JSON Lines cursor
+
+
+class CountingWriter:
+    """
+    File wrapper counting the bytes written through it.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes = 0
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        self.bytes += len(data)
+        return self.file.write(data)
+
+
+def export_query(query: str, user_filter: str, username: str, conn) -> str:
+    """
+    Filters an export query to a user if given.
+    """
+
+    if username is None:
+        return query
+
+    curs = conn.cursor()
+    query = curs.mogrify(query + " WHERE " + user_filter, (username,)).decode("utf-8")
+    curs.close()
+    return query
+
+
+def export_csv(query: str, out: CountingWriter, conn) -> int:
+    """
+    Streams a query to out as CSV with COPY.
+
+    :return: the number of rows exported
+    """
+
+    curs = conn.cursor()
+    curs.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", out)
+    count = curs.rowcount
+    # from the COPY command tag (names may contain newlines)
+    curs.close()
+    return count
+
+
+def export_jsonl(query: str, out: CountingWriter, conn) -> int:
+    """
+    Streams a query to out as JSON Lines through a server-side cursor.
+
+    :return: the number of rows exported
+    """
+
+    curs = conn.cursor(name="export")
+    curs.itersize = FETCH_ROWS
+    curs.execute(query)
+    count = 0
+
+    for row in curs:
+        if count == 0:
+            columns = [column[0] for column in curs.description]
+
+        out.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+        count += 1
+
+    curs.close()
+    return count
+
+
+def table_exists(table: str, conn) -> bool:
+    """
+    Checks whether a table exists.
+    """
+
+    curs = conn.cursor()
+    curs.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    found = curs.fetchone()[0]
+    curs.close()
+    return found
+
+
+def export(username: str, fmt: str, compress: bool, directory: str, conn) -> None:
+    """
+    Exports every table, printing rows, size and throughput per file.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    write = export_csv if fmt == "csv" else export_jsonl
+    total_rows = 0
+    total_bytes = 0
+    began = perf_counter()
+
+    for name, query, user_filter in EXPORTS:
+        if name in OPTIONAL_TABLES and not table_exists(OPTIONAL_TABLES[name], conn):
+            continue
+
+        path = os.path.join(directory, name + "." + fmt + (".gz" if compress else ""))
+        started = perf_counter()
+
+        with (gzip.open(path, "wb") if compress else open(path, "wb")) as file:
+            out = CountingWriter(file)
+            rows = write(export_query(query, user_filter, username, conn), out, conn)
+
+        conn.commit()
+        elapsed = max(perf_counter() - started, 1e-9)
+        print("%-18s %10d rows %10.1f MB %10.0f rows/s %8.1f MB/s" % (
+            name, rows, out.bytes / 1e6, rows / elapsed, out.bytes / 1e6 / elapsed))
+        total_rows += rows
+        total_bytes += out.bytes
+
+    elapsed = max(perf_counter() - began, 1e-9)
+    print("%-18s %10d rows %10.1f MB %10.0f rows/s %8.1f MB/s" % (
+        "total", total_rows, total_bytes / 1e6, total_rows / elapsed, total_bytes / 1e6 / elapsed))
+
+
+def main() -> None:
+    """
+    Runs the export.
+    """
+
+    username = None
+    fmt = "csv"
+    directory = "export"
+    args = sys.argv[1:]
+
+    try:
+        if "--user" in args:
+            username = args[args.index("--user") + 1]
+        if "--format" in args:
+            fmt = args[args.index("--format") + 1]
+        if "--out" in args:
+            directory = args[args.index("--out") + 1]
+    except IndexError:
+        print(__doc__)
+        sys.exit(1)
+
+    if fmt not in ("csv", "jsonl"):
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            export(username, fmt, "--gzip" in args, directory, conn)
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
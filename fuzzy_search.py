@@ -0,0 +1,244 @@
+"""
+Typo-tolerant catalog search.
+Team Peacock.
+
+Candidates come from an n-gram (trigram) inverted index, either held locally
+(NGramIndex) or from Postgres pg_trgm (pg_candidates, see
+migrations/0003_trigram_indexes.sql), and are ranked by edit distance. The
+candidate set is bounded (the rarest grams are read first and very common
+grams are skipped), so lookups stay fast on large catalogs.
+"""
+
+
+import heapq
+import threading
+from array import array
+from autocomplete import normalize
+
+
+GRAM = 3
+MAX_CANDIDATES = 200
+# candidates ranked by edit distance per lookup
+MAX_POSTINGS = 50000
+# grams in more names than this are too common to narrow anything down
+
+# pg_trgm lookups: (id, name) per kind, matching names containing a word
+# similar to the term (served by the GIN trigram indexes)
+PG_QUERIES = {
+    "movie": """SELECT mid, title FROM movie WHERE %(term)s <%% title
+                ORDER BY word_similarity(%(term)s, title) DESC LIMIT %(limit)s""",
+    "actor": """SELECT peid, coalesce(firstname, '') || ' ' || coalesce(lastname, '') FROM person
+                WHERE %(term)s <%% (coalesce(firstname, '') || ' ' || coalesce(lastname, ''))
+                AND EXISTS (SELECT 1 FROM actsin WHERE actsin.peid = person.peid)
+                ORDER BY word_similarity(%(term)s, coalesce(firstname, '') || ' ' || coalesce(lastname, '')) DESC
+                LIMIT %(limit)s""",
+    "studio": """SELECT prid, name FROM producer_studio WHERE %(term)s <%% name
+                ORDER BY word_similarity(%(term)s, name) DESC LIMIT %(limit)s""",
+    "genre": """SELECT gid, name FROM genre WHERE %(term)s <%% name
+                ORDER BY word_similarity(%(term)s, name) DESC LIMIT %(limit)s""",
+}
+
+
+def grams(text: str) -> set:
+    """
+    Gets the trigrams of a normalized string (words padded with spaces).
+    """
+
+    grams_found = set()
+
+    for word in text.split():
+        padded = "  " + word + " "
+        grams_found.update(padded[i:i + GRAM] for i in range(len(padded) - GRAM + 1))
+
+    return grams_found
+
+
+def edit_distance(a: str, b: str, bound: int) -> int:
+    """
+    Levenshtein distance between a and b, or bound + 1 once it exceeds bound.
+    """
+
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+
+    previous = list(range(len(b) + 1))
+
+    for i, ca in enumerate(a, 1):
+        current = [i]
+
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+
+        if min(current) > bound:
+            return bound + 1
+
+        previous = current
+
+    return previous[-1]
+
+
+def name_distance(term: str, name: str, bound: int) -> int:
+    """
+    Edit distance from a term to the closest run of words in a name.
+
+    Compares against each window of the name with the term's word count, so
+    "godfathr" is one edit from "The Godfather".
+    """
+
+    words = name.split()
+    width = max(len(term.split()), 1)
+
+    if len(words) <= width:
+        return edit_distance(term, name, bound)
+
+    return min(edit_distance(term, " ".join(words[i:i + width]), bound)
+               for i in range(len(words) - width + 1))
+
+
+def max_distance(term: str) -> int:
+    """
+    Gets the number of typos tolerated for a term of this length.
+    """
+
+    return 1 if len(term) <= 4 else 2 if len(term) <= 8 else 3
+
+
+def rank(term: str, candidates: list, k: int) -> list:
+    """
+    Ranks (kind, id, name, weight) candidates by edit distance.
+
+    :return: up to k (kind, id, name) tuples, closest first
+    """
+
+    term = normalize(term)
+    bound = max_distance(term)
+    scored = []
+
+    for kind, ident, name, weight in candidates:
+        distance = name_distance(term, normalize(name), bound)
+
+        if distance <= bound:
+            scored.append((distance, -weight, len(name), kind, ident, name))
+
+    scored.sort()
+    return [(kind, ident, name) for _, _, _, kind, ident, name in scored[:k]]
+
+
+def pg_candidates(kind: str, term: str, conn, limit: int = MAX_CANDIDATES) -> list:
+    """
+    Gets candidates from Postgres trigram similarity.
+
+    :return: a list of (kind, id, name, weight) tuples
+    """
+
+    curs = conn.cursor()
+    curs.execute(PG_QUERIES[kind], {"term": term, "limit": limit})
+    rows = [(kind, ident, name, 0) for ident, name in curs.fetchall()]
+    curs.close()
+    return rows
+
+
+class NGramIndex:
+    """
+    In-memory trigram inverted index over catalog names.
+    """
+
+    def __init__(self):
+        self.docs = []
+        # doc id -> (kind, id, name, weight), None once removed
+        self.doc_ids = {}
+        # (kind, id) -> doc id
+        self.postings = {}
+        # gram -> array of doc ids
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def add(self, kind: str, ident: int, name: str, weight: int = 0) -> None:
+        """
+        Adds (or replaces) one catalog entry.
+        """
+
+        with self.lock:
+            old = self.doc_ids.get((kind, ident))
+
+            if old is not None:
+                self.docs[old] = None
+                # stale postings of the old doc are skipped at lookup
+
+            doc = len(self.docs)
+            self.docs.append((kind, ident, name, weight))
+            self.doc_ids[(kind, ident)] = doc
+
+            for gram in grams(normalize(name)):
+                postings = self.postings.get(gram)
+
+                if postings is None:
+                    postings = self.postings[gram] = array("l")
+                postings.append(doc)
+
+    def load(self, rows: list) -> None:
+        """
+        Bulk-loads (kind, id, name, weight) rows, replacing the index.
+        """
+
+        docs = []
+        doc_ids = {}
+        postings = {}
+
+        for row in rows:
+            doc = len(docs)
+            docs.append(row)
+            doc_ids[(row[0], row[1])] = doc
+
+            for gram in grams(normalize(row[2])):
+                gram_postings = postings.get(gram)
+
+                if gram_postings is None:
+                    gram_postings = postings[gram] = array("l")
+                gram_postings.append(doc)
+
+        with self.lock:
+            self.docs = docs
+            self.doc_ids = doc_ids
+            self.postings = postings
+
+    def candidates(self, term: str, kind: str = None,
+                   limit: int = MAX_CANDIDATES) -> list:
+        """
+        Gets the entries sharing the most trigrams with a term.
+
+        :return: up to limit (kind, id, name, weight) tuples
+        """
+
+        term_grams = grams(normalize(term))
+
+        with self.lock:
+            lists = sorted((self.postings[g] for g in term_grams if g in self.postings), key=len)
+            usable = [p for p in lists if len(p) <= MAX_POSTINGS] or lists[:1]
+            # rarest grams first; common grams add cost but little signal
+            counts = {}
+
+            for postings in usable:
+                for doc in postings:
+                    counts[doc] = counts.get(doc, 0) + 1
+
+            docs = self.docs
+            counts = {doc: count for doc, count in counts.items()
+                      if docs[doc] is not None and (kind is None or docs[doc][0] == kind)}
+            # removed entries and other kinds are dropped before ranking, so
+            # they cannot crowd out the requested kind
+            best = heapq.nlargest(limit, counts, key=counts.get)
+
+        return [docs[doc] for doc in best]
+
+    def search(self, term: str, kind: str = None, k: int = 10) -> list:
+        """
+        Gets the catalog entries closest to a possibly misspelled term.
+
+        :return: up to k (kind, id, name) tuples, closest first
+        """
+
+        return rank(term, self.candidates(term, kind), k)
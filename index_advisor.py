@@ -0,0 +1,271 @@
+"""
+Index advisor.
+Team Peacock.
+
+Runs the app's read paths (searches, collections, friends, profile counters,
+top 10s, leaderboards, recommendations) against the live schema through a
+connection that records every statement they execute, then runs each
+statement under EXPLAIN ANALYZE and flags sequential scans of tables larger
+than SEQ_SCAN_ROWS. With --apply it applies the pending migrations (see
+migrate.py and migrations/0006_join_indexes.sql) and prints before/after
+timings.
+
+Usage: python index_advisor.py [--apply]
+"""
+
+
+import sys
+import psycopg2
+import PDM_proj
+from migrate import apply_pending
+from PDM_proj import db_params
+
+
+SEQ_SCAN_ROWS = 1000
+# smaller tables are cheaper to scan than to index
+REPEATS = 3
+# EXPLAIN ANALYZE runs per statement (the fastest is reported)
+
+# (name, function of (samples, conn)) for each app read path
+SHAPES = (
+    ("search title", lambda s, c: PDM_proj.find_movies(1, s["word"], 0, "a", c, limit=20)),
+    ("search release", lambda s, c: PDM_proj.find_movies(2, s["year"], 0, "a", c, limit=20)),
+    ("search cast", lambda s, c: PDM_proj.find_movies(3, s["lastname"], 0, "a", c, limit=20)),
+    ("search studio", lambda s, c: PDM_proj.find_movies(4, s["studio"], 2, "a", c, limit=20)),
+    ("search genre", lambda s, c: PDM_proj.find_movies(5, s["genre"], 3, "a", c, limit=20)),
+    ("collections", lambda s, c: PDM_proj.get_collections(s["owner"], c)),
+    ("open collection", lambda s, c: PDM_proj.find_from_collection(s["owner"], (s["cid"],), 0, "a", c)),
+    ("friends", lambda s, c: PDM_proj.get_friends(s["username"], c)),
+    ("find user", lambda s, c: PDM_proj.find_user(s["username"], s["email"], c)),
+    ("profile counters", lambda s, c: (PDM_proj.get_collection_count(s["username"], c),
+                                       PDM_proj.get_num_followers(s["username"], c),
+                                       PDM_proj.get_num_following(s["username"], c))),
+    ("viewing analytics", lambda s, c: PDM_proj.get_genre_minutes(s["username"], c)),
+    ("top 10 rating", lambda s, c: PDM_proj.get_user_top_10_movies(s["username"], 0, c)),
+    ("top 10 plays", lambda s, c: PDM_proj.get_user_top_10_movies(s["username"], 1, c)),
+    ("top 10 combined", lambda s, c: PDM_proj.get_user_top_10_movies(s["username"], 2, c)),
+    ("top 20 overall", lambda s, c: PDM_proj.get_overall_top_20_movies.uncached(c)),
+    ("top 20 friends", lambda s, c: PDM_proj.get_friends_top_20_movies(s["username"], c)),
+    ("top 5 new releases", lambda s, c: PDM_proj.get_top_5_new_releases.uncached(c)),
+    ("recommended", lambda s, c: PDM_proj.get_recommended_movies(s["username"], c)),
+    ("because you watched", lambda s, c: PDM_proj.get_cowatched_movies(s["mid"], c)),
+)
+
+
+class RecordingCursor:
+    """
+    Cursor wrapper recording each statement it executes.
+    """
+
+    def __init__(self, curs, statements: list, shape: list):
+        self.curs = curs
+        self.statements = statements
+        self.shape = shape
+        # [current shape name]
+
+    def execute(self, query, params=None):
+        if not isinstance(query, str):
+            query = query.as_string(self.curs)
+            # psycopg2.sql composables (find_movies)
+
+        self.statements.append((self.shape[0], query, params))
+        return self.curs.execute(query, params)
+
+    def __iter__(self):
+        return iter(self.curs)
+
+    def __getattr__(self, name):
+        return getattr(self.curs, name)
+
+
+class RecordingConnection:
+    """
+    Connection wrapper whose cursors record their statements.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = []
+        # (shape name, query, params)
+        self.shape = [None]
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self.conn.cursor(*args, **kwargs), self.statements, self.shape)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def sample_values(conn) -> dict:
+    """
+    Picks existing values for the query shapes' parameters.
+    """
+
+    curs = conn.cursor()
+    samples = {}
+
+    for key, query in (("username", "SELECT username FROM watches LIMIT 1"),
+                       ("mid", "SELECT mid FROM watches LIMIT 1"),
+                       ("word", "SELECT split_part(title, ' ', 1) FROM movie LIMIT 1"),
+                       ("year", "SELECT left(releasedate::TEXT, 4) FROM release LIMIT 1"),
+                       ("lastname", "SELECT lastname FROM person LIMIT 1"),
+                       ("studio", "SELECT name FROM producer_studio LIMIT 1"),
+                       ("genre", "SELECT name FROM genre LIMIT 1"),
+                       ("email", 'SELECT email FROM "User" LIMIT 1')):
+        curs.execute(query)
+        row = curs.fetchone()
+        samples[key] = row[0] if row is not None else ""
+
+    curs.execute("SELECT cid, username FROM collection LIMIT 1")
+    samples["cid"], samples["owner"] = curs.fetchone() or (0, samples["username"])
+    conn.rollback()
+    curs.close()
+    return samples
+
+
+def record_statements(samples: dict, conn) -> list:
+    """
+    Runs every shape and collects the statements it executes.
+
+    :return: a list of (shape name, query, params)
+    """
+
+    recording = RecordingConnection(conn)
+
+    for name, shape in SHAPES:
+        recording.shape[0] = name
+
+        try:
+            shape(samples, recording)
+        except Exception as e:
+            print("%s failed: %s" % (name, e))
+
+        conn.rollback()
+
+    return recording.statements
+
+
+def table_rows(conn) -> dict:
+    """
+    Gets the planner's row estimate of every table.
+    """
+
+    curs = conn.cursor()
+    curs.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')")
+    rows = dict(curs.fetchall())
+    curs.close()
+    return rows
+
+
+def seq_scans(plan: dict, rows: dict) -> list:
+    """
+    Finds sequential scans of large tables in an EXPLAIN plan tree.
+
+    :return: a list of table names
+    """
+
+    found = []
+
+    if plan.get("Node Type") == "Seq Scan":
+        estimate = rows.get(plan.get("Relation Name"), 0)
+
+        if estimate > SEQ_SCAN_ROWS or estimate < 0:
+            found.append(plan["Relation Name"])
+            # -1: never analyzed, size unknown
+
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child, rows))
+
+    return found
+
+
+def explain(statements: list, conn) -> list:
+    """
+    Runs each SELECT under EXPLAIN ANALYZE.
+
+    :return: a list of (shape name, fastest execution ms, flagged tables)
+    """
+
+    rows = table_rows(conn)
+    curs = conn.cursor()
+    results = []
+
+    for name, query, params in statements:
+        if not query.lstrip().upper().startswith(("SELECT", "WITH")):
+            continue
+
+        best = None
+
+        for _ in range(REPEATS):
+            try:
+                curs.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, params)
+                plan = curs.fetchone()[0][0]
+            except Exception as e:
+                print("%s: EXPLAIN failed: %s" % (name, e))
+                break
+            finally:
+                conn.rollback()
+
+            if best is None or plan["Execution Time"] < best["Execution Time"]:
+                best = plan
+
+        if best is not None:
+            results.append((name, best["Execution Time"], sorted(set(seq_scans(best["Plan"], rows)))))
+
+    curs.close()
+    return results
+
+
+def summarize(results: list) -> dict:
+    """
+    Totals the results per shape.
+
+    :return: {shape name: (total ms, flagged tables)}
+    """
+
+    totals = {}
+
+    for name, ms, tables in results:
+        total, flagged = totals.get(name, (0.0, set()))
+        totals[name] = (total + ms, flagged | set(tables))
+
+    return totals
+
+
+def main() -> None:
+    """
+    Reports (and with --apply, fixes) the app's sequential scans.
+    """
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            samples = sample_values(conn)
+            before = summarize(explain(record_statements(samples, conn), conn))
+
+            if "--apply" not in sys.argv[1:]:
+                print("%-20s %10s  %s" % ("query", "ms", "sequential scans"))
+
+                for name, _ in SHAPES:
+                    if name in before:
+                        ms, tables = before[name]
+                        print("%-20s %10.2f  %s" % (name, ms, ", ".join(sorted(tables)) or "-"))
+                return
+
+            for version, name in apply_pending(conn):
+                print("Applied %04d %s" % (version, name))
+
+            after = summarize(explain(record_statements(samples, conn), conn))
+            print("%-20s %10s %10s  %s" % ("query", "before ms", "after ms", "sequential scans after"))
+
+            for name, _ in SHAPES:
+                if name in before and name in after:
+                    print("%-20s %10.2f %10.2f  %s" % (name, before[name][0], after[name][0],
+                                                       ", ".join(sorted(after[name][1])) or "-"))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
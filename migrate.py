@@ -0,0 +1,176 @@
+"""
+Versioned schema migrations.
+Team Peacock.
+
+Applies migrations/NNNN_<name>.sql files in version order, each in its own
+transaction, and records them in schema_migrations (version, name, checksum,
+applied_at). Runners are serialized with an advisory lock. A migration whose
+file changed after it was applied is reported by --status but never re-run.
+
+Every migration is written to be idempotent, so a database where some of
+them were applied by hand can be brought under the runner as is.
+
+Usage: python migrate.py [--status] [--to VERSION]
+"""
+
+
+import os
+import sys
+import hashlib
+import psycopg2
+from PDM_proj import db_params
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+LOCK_ID = 0x50444d
+# advisory lock key shared by every migration runner
+
+SCHEMA_MIGRATIONS_DDL = """CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version     INTEGER PRIMARY KEY,
+                        name        VARCHAR NOT NULL,
+                        checksum    VARCHAR NOT NULL,
+                        applied_at  TIMESTAMP NOT NULL DEFAULT now())"""
+
+
+def available() -> list:
+    """
+    Gets the migration files.
+
+    :return: a sorted list of (version, name, path)
+    """
+
+    migrations = []
+
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        stem, ext = os.path.splitext(file_name)
+        version, _, name = stem.partition("_")
+
+        if ext == ".sql" and version.isdigit():
+            migrations.append((int(version), name, os.path.join(MIGRATIONS_DIR, file_name)))
+
+    return sorted(migrations)
+
+
+def checksum(path: str) -> str:
+    """
+    Gets the SHA-256 of a migration file.
+    """
+
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def applied(conn) -> dict:
+    """
+    Gets the applied migrations.
+
+    :return: {version: checksum}
+    """
+
+    curs = conn.cursor()
+    curs.execute(SCHEMA_MIGRATIONS_DDL)
+    curs.execute("SELECT version, checksum FROM schema_migrations")
+    versions = dict(curs.fetchall())
+    conn.commit()
+    curs.close()
+    return versions
+
+
+def apply_pending(conn, target: int = None) -> list:
+    """
+    Applies the migrations not applied yet, up to target if given.
+
+    :return: the (version, name) of each migration applied
+    """
+
+    curs = conn.cursor()
+    curs.execute("SELECT pg_advisory_lock(%s)", (LOCK_ID,))
+    done = []
+
+    try:
+        versions = applied(conn)
+
+        for version, name, path in available():
+            if version in versions or (target is not None and version > target):
+                continue
+
+            with open(path) as file:
+                ddl = file.read()
+
+            try:
+                curs.execute(ddl)
+                curs.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                             (version, name, checksum(path)))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+            done.append((version, name))
+    finally:
+        curs.execute("SELECT pg_advisory_unlock(%s)", (LOCK_ID,))
+        conn.commit()
+        curs.close()
+
+    return done
+
+
+def status(conn) -> list:
+    """
+    Gets every migration's state ("applied", "pending" or "changed").
+
+    :return: a list of (version, name, state)
+    """
+
+    versions = applied(conn)
+    states = []
+
+    for version, name, path in available():
+        if version not in versions:
+            states.append((version, name, "pending"))
+        elif versions[version] != checksum(path):
+            states.append((version, name, "changed"))
+        else:
+            states.append((version, name, "applied"))
+
+    return states
+
+
+def main() -> None:
+    """
+    Shows migration status or applies pending migrations.
+    """
+
+    target = None
+    args = sys.argv[1:]
+
+    try:
+        if "--to" in args:
+            target = int(args[args.index("--to") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            if "--status" in args:
+                for version, name, state in status(conn):
+                    print("%04d %-32s %s" % (version, name, state))
+                return
+
+            done = apply_pending(conn, target)
+
+            for version, name in done:
+                print("Applied %04d %s" % (version, name))
+
+            if not done:
+                print("Schema is up to date")
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+-- Converts watches into a table range-partitioned by watchdate (one
+-- partition per calendar month) and adds the monthly rollup tables that old
+-- partitions are folded into by partitions.py.
+
+CREATE TABLE IF NOT EXISTS watches_movie_monthly (
+    mid       INTEGER NOT NULL,
+    month     DATE    NOT NULL,
+    plays     BIGINT  NOT NULL,
+    viewers   BIGINT  NOT NULL,
+    PRIMARY KEY (mid, month)
+);
+
+CREATE TABLE IF NOT EXISTS watches_user_monthly (
+    username  VARCHAR NOT NULL,
+    mid       INTEGER NOT NULL,
+    month     DATE    NOT NULL,
+    plays     BIGINT  NOT NULL,
+    PRIMARY KEY (username, mid, month)
+);
+
+CREATE INDEX IF NOT EXISTS watches_user_monthly_mid_idx
+    ON watches_user_monthly (mid, month);
+
+DO $$
+DECLARE
+    first_month DATE;
+    last_month  DATE := date_trunc('month', CURRENT_DATE + INTERVAL '3 months');
+    cur_month   DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table pt
+               JOIN pg_class c ON c.oid = pt.partrelid
+               WHERE c.relname = 'watches') THEN
+        RETURN;
+        -- already partitioned
+    END IF;
+
+    CREATE TABLE watches_partitioned (LIKE watches INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE (watchdate);
+
+    SELECT COALESCE(date_trunc('month', min(watchdate)), date_trunc('month', CURRENT_DATE))
+        INTO first_month FROM watches;
+
+    cur_month := first_month;
+    WHILE cur_month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF watches_partitioned FOR VALUES FROM (%L) TO (%L)',
+            'watches_y' || to_char(cur_month, 'YYYY') || 'm' || to_char(cur_month, 'MM'),
+            cur_month, cur_month + INTERVAL '1 month');
+        cur_month := cur_month + INTERVAL '1 month';
+    END LOOP;
+
+    INSERT INTO watches_partitioned SELECT * FROM watches;
+
+    ALTER TABLE watches RENAME TO watches_unpartitioned;
+    ALTER TABLE watches_partitioned RENAME TO watches;
+
+    CREATE INDEX watches_username_watchdate_idx ON watches (username, watchdate);
+    CREATE INDEX watches_mid_watchdate_idx ON watches (mid, watchdate);
+END $$;
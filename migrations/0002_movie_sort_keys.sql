@@ -0,0 +1,93 @@
+-- Per-movie sort keys for find_movies/find_from_collection. The keys are the
+-- first element of each aggregated array MOVIE_QUERY used to sort on, kept up
+-- to date by triggers and indexed so ORDER BY ... LIMIT can stop early.
+
+DO $$
+BEGIN
+    IF to_regclass('movie_sort_keys') IS NULL THEN
+        CREATE TABLE movie_sort_keys AS
+            SELECT movie.mid, lower(movie.title) AS title_key,
+                producer_studio.name AS primary_studio,
+                genre.name AS primary_genre,
+                release.releasedate AS first_release
+            FROM movie, producer_studio, genre, release
+            WITH NO DATA;
+            -- takes the column types from the catalog tables
+        ALTER TABLE movie_sort_keys ADD PRIMARY KEY (mid);
+        ALTER TABLE movie_sort_keys ADD FOREIGN KEY (mid) REFERENCES movie (mid) ON DELETE CASCADE;
+    END IF;
+END $$;
+
+CREATE OR REPLACE FUNCTION refresh_movie_sort_keys(movie_id INTEGER) RETURNS VOID AS $$
+BEGIN
+    INSERT INTO movie_sort_keys (mid, title_key, primary_studio, primary_genre, first_release)
+    SELECT movie.mid, lower(movie.title),
+        (SELECT min(ps.name) FROM makesmovie mm
+            JOIN producer_studio ps ON mm.prid = ps.prid WHERE mm.mid = movie.mid),
+        (SELECT min(g.name) FROM moviegenre mg
+            JOIN genre g ON mg.gid = g.gid WHERE mg.mid = movie.mid),
+        (SELECT min(r.releasedate) FROM release r WHERE r.mid = movie.mid)
+    FROM movie WHERE movie.mid = movie_id
+    ON CONFLICT (mid) DO UPDATE SET
+        title_key = EXCLUDED.title_key,
+        primary_studio = EXCLUDED.primary_studio,
+        primary_genre = EXCLUDED.primary_genre,
+        first_release = EXCLUDED.first_release;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION movie_sort_keys_row_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM refresh_movie_sort_keys(NEW.mid);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND (TG_OP = 'DELETE' OR OLD.mid <> NEW.mid) THEN
+        PERFORM refresh_movie_sort_keys(OLD.mid);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- a renamed studio or genre changes the keys of every movie that has it
+CREATE OR REPLACE FUNCTION movie_sort_keys_name_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'producer_studio' THEN
+        PERFORM refresh_movie_sort_keys(mid) FROM makesmovie WHERE prid = NEW.prid;
+    ELSE
+        PERFORM refresh_movie_sort_keys(mid) FROM moviegenre WHERE gid = NEW.gid;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS movie_sort_keys_movie ON movie;
+CREATE TRIGGER movie_sort_keys_movie AFTER INSERT OR UPDATE OF title ON movie
+    FOR EACH ROW EXECUTE FUNCTION movie_sort_keys_row_trigger();
+
+DROP TRIGGER IF EXISTS movie_sort_keys_makesmovie ON makesmovie;
+CREATE TRIGGER movie_sort_keys_makesmovie AFTER INSERT OR UPDATE OR DELETE ON makesmovie
+    FOR EACH ROW EXECUTE FUNCTION movie_sort_keys_row_trigger();
+
+DROP TRIGGER IF EXISTS movie_sort_keys_moviegenre ON moviegenre;
+CREATE TRIGGER movie_sort_keys_moviegenre AFTER INSERT OR UPDATE OR DELETE ON moviegenre
+    FOR EACH ROW EXECUTE FUNCTION movie_sort_keys_row_trigger();
+
+DROP TRIGGER IF EXISTS movie_sort_keys_release ON release;
+CREATE TRIGGER movie_sort_keys_release AFTER INSERT OR UPDATE OR DELETE ON release
+    FOR EACH ROW EXECUTE FUNCTION movie_sort_keys_row_trigger();
+
+DROP TRIGGER IF EXISTS movie_sort_keys_producer_studio ON producer_studio;
+CREATE TRIGGER movie_sort_keys_producer_studio AFTER UPDATE OF name ON producer_studio
+    FOR EACH ROW EXECUTE FUNCTION movie_sort_keys_name_trigger();
+
+DROP TRIGGER IF EXISTS movie_sort_keys_genre ON genre;
+CREATE TRIGGER movie_sort_keys_genre AFTER UPDATE OF name ON genre
+    FOR EACH ROW EXECUTE FUNCTION movie_sort_keys_name_trigger();
+
+-- backfill
+SELECT refresh_movie_sort_keys(mid) FROM movie;
+
+CREATE INDEX IF NOT EXISTS movie_sort_keys_title_idx ON movie_sort_keys (title_key, first_release, mid);
+CREATE INDEX IF NOT EXISTS movie_sort_keys_studio_idx ON movie_sort_keys (primary_studio, title_key, mid);
+CREATE INDEX IF NOT EXISTS movie_sort_keys_genre_idx ON movie_sort_keys (primary_genre, title_key, mid);
+CREATE INDEX IF NOT EXISTS movie_sort_keys_release_idx ON movie_sort_keys (first_release, title_key, mid);
@@ -0,0 +1,14 @@
+-- Trigram indexes for typo-tolerant search (fuzzy_search.pg_candidates).
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS movie_title_trgm_idx
+    ON movie USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS person_name_trgm_idx
+    ON person USING gin ((coalesce(firstname, '') || ' ' || coalesce(lastname, '')) gin_trgm_ops);
+-- CONCAT is only STABLE, so it cannot be indexed; fuzzy_search.py queries
+-- this same expression
+CREATE INDEX IF NOT EXISTS producer_studio_name_trgm_idx
+    ON producer_studio USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS genre_name_trgm_idx
+    ON genre USING gin (name gin_trgm_ops);
@@ -0,0 +1,9 @@
+-- Precomputed content-based neighbours per movie (written by similar_movies.py).
+
+CREATE TABLE IF NOT EXISTS similar_movies (
+    mid          INTEGER NOT NULL,
+    rank         SMALLINT NOT NULL,
+    similar_mid  INTEGER NOT NULL,
+    score        REAL NOT NULL,
+    PRIMARY KEY (mid, rank)
+);
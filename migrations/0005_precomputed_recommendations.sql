@@ -0,0 +1,29 @@
+-- Per-user recommendation lists written by precompute_recommendations.py.
+-- kind is one of recommended, top10_rating, top10_plays, top10_combined and
+-- friends_top20.
+
+CREATE TABLE IF NOT EXISTS user_recommendations (
+    username  VARCHAR NOT NULL,
+    kind      VARCHAR NOT NULL,
+    rank      SMALLINT NOT NULL,
+    mid       INTEGER NOT NULL,
+    PRIMARY KEY (username, kind, rank)
+);
+
+CREATE TABLE IF NOT EXISTS precompute_runs (
+    run_id       SERIAL PRIMARY KEY,
+    shards       INTEGER NOT NULL,
+    bounds       VARCHAR[] NOT NULL,
+    -- lowest username of each shard; a shard ends where the next one starts
+    started_at   TIMESTAMP NOT NULL DEFAULT now(),
+    finished_at  TIMESTAMP
+);
+
+-- one row per finished shard; a resumed run skips these
+CREATE TABLE IF NOT EXISTS precompute_checkpoint (
+    run_id   INTEGER NOT NULL REFERENCES precompute_runs ON DELETE CASCADE,
+    shard    INTEGER NOT NULL,
+    users    INTEGER NOT NULL,
+    done_at  TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (run_id, shard)
+);
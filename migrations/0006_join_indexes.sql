@@ -0,0 +1,61 @@
+-- Indexes for MOVIE_QUERY's join graph and the app's other lookups.
+-- pdm_ensure_index skips an index when the table already has one whose key
+-- columns start with the same columns (e.g. a primary key) and that holds
+-- the INCLUDE columns, so no duplicate of an existing key is built.
+
+CREATE OR REPLACE FUNCTION pdm_ensure_index(index_name TEXT, table_name TEXT,
+                                            key_columns TEXT[], include_columns TEXT[] DEFAULT '{}')
+RETURNS VOID AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indrelid = table_name::regclass AND i.indpred IS NULL
+        AND (SELECT array_agg(a.attname::TEXT ORDER BY k.ord)
+             FROM unnest(i.indkey::INT2[]) WITH ORDINALITY AS k(attnum, ord)
+             JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+             WHERE k.ord <= array_length(key_columns, 1)) = key_columns
+        AND (SELECT array_agg(a.attname::TEXT)
+             FROM unnest(i.indkey::INT2[]) AS k(attnum)
+             JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum)
+            @> include_columns
+    ) THEN
+        RETURN;
+    END IF;
+
+    EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %s (%s)%s', index_name, table_name,
+                   (SELECT string_agg(quote_ident(c), ', ') FROM unnest(key_columns) c),
+                   CASE WHEN cardinality(include_columns) > 0
+                        THEN ' INCLUDE (' || (SELECT string_agg(quote_ident(c), ', ')
+                                             FROM unnest(include_columns) c) || ')'
+                        ELSE '' END);
+END;
+$$ LANGUAGE plpgsql;
+
+-- MOVIE_QUERY joins (both directions of each link table: by movie for the
+-- aggregates, by person/studio/genre for searches)
+SELECT pdm_ensure_index('release_mid_idx', 'release', '{mid}', '{releasedate}');
+SELECT pdm_ensure_index('makesmovie_mid_prid_idx', 'makesmovie', '{mid,prid}');
+SELECT pdm_ensure_index('makesmovie_prid_mid_idx', 'makesmovie', '{prid,mid}');
+SELECT pdm_ensure_index('actsin_mid_peid_idx', 'actsin', '{mid,peid}');
+SELECT pdm_ensure_index('actsin_peid_mid_idx', 'actsin', '{peid,mid}');
+SELECT pdm_ensure_index('directs_mid_peid_idx', 'directs', '{mid,peid}');
+SELECT pdm_ensure_index('directs_peid_mid_idx', 'directs', '{peid,mid}');
+SELECT pdm_ensure_index('moviegenre_mid_gid_idx', 'moviegenre', '{mid,gid}');
+SELECT pdm_ensure_index('moviegenre_gid_mid_idx', 'moviegenre', '{gid,mid}');
+SELECT pdm_ensure_index('rates_mid_idx', 'rates', '{mid}', '{rating}');
+-- covering: the rating average reads the index only
+
+-- per-user lookups
+SELECT pdm_ensure_index('rates_username_mid_idx', 'rates', '{username,mid}', '{rating}');
+SELECT pdm_ensure_index('watches_username_watchdate_idx', 'watches', '{username,watchdate}');
+SELECT pdm_ensure_index('watches_mid_watchdate_idx', 'watches', '{mid,watchdate}');
+SELECT pdm_ensure_index('watches_watchdate_idx', 'watches', '{watchdate}', '{mid}');
+-- the last-90-days leaderboard
+SELECT pdm_ensure_index('friends_username1_idx', 'friends', '{username1,username2}');
+SELECT pdm_ensure_index('friends_username2_idx', 'friends', '{username2,username1}');
+SELECT pdm_ensure_index('collection_username_idx', 'collection', '{username}', '{name}');
+SELECT pdm_ensure_index('collectionmovies_cid_mid_idx', 'collectionmovies', '{cid,mid}');
+SELECT pdm_ensure_index('user_email_idx', '"User"', '{email}');
+
+ANALYZE release, makesmovie, actsin, directs, moviegenre, rates, watches, friends,
+    collection, collectionmovies, "User";
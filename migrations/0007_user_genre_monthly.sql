@@ -0,0 +1,80 @@
+-- Per-user, per-month, per-genre watch minutes and plays for the profile
+-- analytics view, kept up to date by statement-level triggers on watches
+-- that fold each statement's transition table into the rollup (one upsert
+-- per statement, so batched journal flushes cost one pass). A watch of a
+-- movie with several genres counts toward each of them; movies without a
+-- genre are not counted. Genres are taken as of the watch.
+
+CREATE TABLE IF NOT EXISTS user_genre_monthly (
+    username  VARCHAR NOT NULL,
+    month     DATE    NOT NULL,
+    gid       INTEGER NOT NULL,
+    minutes   BIGINT  NOT NULL,
+    plays     BIGINT  NOT NULL,
+    PRIMARY KEY (username, month, gid)
+);
+
+CREATE OR REPLACE FUNCTION user_genre_monthly_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_genre_monthly ugm SET
+            minutes = ugm.minutes - removed.minutes,
+            plays = ugm.plays - removed.plays
+        FROM (SELECT w.username, date_trunc('month', w.watchdate)::DATE AS month, mg.gid,
+                  sum(COALESCE(movie.length, 0)) AS minutes, count(*) AS plays
+              FROM old_watches w
+              JOIN movie ON movie.mid = w.mid
+              JOIN moviegenre mg ON mg.mid = w.mid
+              GROUP BY 1, 2, 3) removed
+        WHERE ugm.username = removed.username AND ugm.month = removed.month AND ugm.gid = removed.gid;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO user_genre_monthly (username, month, gid, minutes, plays)
+        SELECT w.username, date_trunc('month', w.watchdate)::DATE, mg.gid,
+            sum(COALESCE(movie.length, 0)), count(*)
+        FROM new_watches w
+        JOIN movie ON movie.mid = w.mid
+        JOIN moviegenre mg ON mg.mid = w.mid
+        GROUP BY 1, 2, 3
+        ON CONFLICT (username, month, gid) DO UPDATE SET
+            minutes = user_genre_monthly.minutes + EXCLUDED.minutes,
+            plays = user_genre_monthly.plays + EXCLUDED.plays;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_genre_monthly_insert ON watches;
+CREATE TRIGGER user_genre_monthly_insert AFTER INSERT ON watches
+    REFERENCING NEW TABLE AS new_watches
+    FOR EACH STATEMENT EXECUTE FUNCTION user_genre_monthly_trigger();
+
+DROP TRIGGER IF EXISTS user_genre_monthly_update ON watches;
+CREATE TRIGGER user_genre_monthly_update AFTER UPDATE ON watches
+    REFERENCING OLD TABLE AS old_watches NEW TABLE AS new_watches
+    FOR EACH STATEMENT EXECUTE FUNCTION user_genre_monthly_trigger();
+
+DROP TRIGGER IF EXISTS user_genre_monthly_delete ON watches;
+CREATE TRIGGER user_genre_monthly_delete AFTER DELETE ON watches
+    REFERENCING OLD TABLE AS old_watches
+    FOR EACH STATEMENT EXECUTE FUNCTION user_genre_monthly_trigger();
+
+-- backfill from the full history (the triggers above already lock out
+-- concurrent watches until this migration commits); partitions.py drops
+-- rolled-up partitions without deleting rows, so the rollup keeps them
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM user_genre_monthly) THEN
+        INSERT INTO user_genre_monthly (username, month, gid, minutes, plays)
+        SELECT history.username, date_trunc('month', history.watchdate)::DATE, mg.gid,
+            sum(COALESCE(movie.length, 0) * history.plays), sum(history.plays)
+        FROM (SELECT username, mid, watchdate, 1 AS plays FROM watches
+              UNION ALL
+              SELECT username, mid, month AS watchdate, plays FROM watches_user_monthly) history
+        JOIN movie ON movie.mid = history.mid
+        JOIN moviegenre mg ON mg.mid = history.mid
+        GROUP BY 1, 2, 3;
+    END IF;
+END $$;
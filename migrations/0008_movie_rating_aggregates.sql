@@ -0,0 +1,69 @@
+-- Per-movie rating sum and count, so MOVIE_QUERY reads the average user
+-- rating from movie instead of joining every rating into its fan-out.
+-- Statement-level triggers on rates apply each statement's changes;
+-- repair_movie_ratings() recomputes drifted movies from rates (used for the
+-- backfill and by rating_check.py --repair).
+
+ALTER TABLE movie ADD COLUMN IF NOT EXISTS rating_sum BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE movie ADD COLUMN IF NOT EXISTS rating_count BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION movie_rating_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE movie SET
+            rating_sum = movie.rating_sum - removed.rating_sum,
+            rating_count = movie.rating_count - removed.rating_count
+        FROM (SELECT mid, COALESCE(sum(rating), 0) AS rating_sum, count(rating) AS rating_count
+              FROM old_rates GROUP BY mid) removed
+        WHERE movie.mid = removed.mid;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE movie SET
+            rating_sum = movie.rating_sum + added.rating_sum,
+            rating_count = movie.rating_count + added.rating_count
+        FROM (SELECT mid, COALESCE(sum(rating), 0) AS rating_sum, count(rating) AS rating_count
+              FROM new_rates GROUP BY mid) added
+        WHERE movie.mid = added.mid;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS movie_rating_insert ON rates;
+CREATE TRIGGER movie_rating_insert AFTER INSERT ON rates
+    REFERENCING NEW TABLE AS new_rates
+    FOR EACH STATEMENT EXECUTE FUNCTION movie_rating_trigger();
+
+DROP TRIGGER IF EXISTS movie_rating_update ON rates;
+CREATE TRIGGER movie_rating_update AFTER UPDATE ON rates
+    REFERENCING OLD TABLE AS old_rates NEW TABLE AS new_rates
+    FOR EACH STATEMENT EXECUTE FUNCTION movie_rating_trigger();
+
+DROP TRIGGER IF EXISTS movie_rating_delete ON rates;
+CREATE TRIGGER movie_rating_delete AFTER DELETE ON rates
+    REFERENCING OLD TABLE AS old_rates
+    FOR EACH STATEMENT EXECUTE FUNCTION movie_rating_trigger();
+
+-- rates is locked against writes for the rest of the transaction, so no
+-- trigger can apply a rating the recomputation has not seen
+CREATE OR REPLACE FUNCTION repair_movie_ratings() RETURNS INTEGER AS $$
+DECLARE
+    repaired INTEGER;
+BEGIN
+    LOCK TABLE rates IN SHARE MODE;
+
+    UPDATE movie SET rating_sum = actual.rating_sum, rating_count = actual.rating_count
+    FROM (SELECT movie.mid, COALESCE(sum(rates.rating), 0) AS rating_sum, count(rates.rating) AS rating_count
+          FROM movie LEFT JOIN rates ON movie.mid = rates.mid
+          GROUP BY movie.mid) actual
+    WHERE movie.mid = actual.mid
+    AND (movie.rating_sum, movie.rating_count) IS DISTINCT FROM (actual.rating_sum, actual.rating_count);
+
+    GET DIAGNOSTICS repaired = ROW_COUNT;
+    RETURN repaired;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT repair_movie_ratings();
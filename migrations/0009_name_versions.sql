@@ -0,0 +1,37 @@
+-- Change versions of person, genre and producer_studio names, so clients
+-- caching the names (name_dictionary.py) can fetch only what changed since
+-- their last refresh. Every insert or rename takes the next value of one
+-- shared sequence.
+
+CREATE SEQUENCE IF NOT EXISTS name_version_seq;
+
+CREATE OR REPLACE FUNCTION name_version_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.name_version := nextval('name_version_seq');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE person ADD COLUMN IF NOT EXISTS name_version BIGINT;
+ALTER TABLE genre ADD COLUMN IF NOT EXISTS name_version BIGINT;
+ALTER TABLE producer_studio ADD COLUMN IF NOT EXISTS name_version BIGINT;
+
+DROP TRIGGER IF EXISTS name_version_person ON person;
+CREATE TRIGGER name_version_person BEFORE INSERT OR UPDATE OF firstname, lastname ON person
+    FOR EACH ROW EXECUTE FUNCTION name_version_trigger();
+
+DROP TRIGGER IF EXISTS name_version_genre ON genre;
+CREATE TRIGGER name_version_genre BEFORE INSERT OR UPDATE OF name ON genre
+    FOR EACH ROW EXECUTE FUNCTION name_version_trigger();
+
+DROP TRIGGER IF EXISTS name_version_producer_studio ON producer_studio;
+CREATE TRIGGER name_version_producer_studio BEFORE INSERT OR UPDATE OF name ON producer_studio
+    FOR EACH ROW EXECUTE FUNCTION name_version_trigger();
+
+UPDATE person SET name_version = nextval('name_version_seq') WHERE name_version IS NULL;
+UPDATE genre SET name_version = nextval('name_version_seq') WHERE name_version IS NULL;
+UPDATE producer_studio SET name_version = nextval('name_version_seq') WHERE name_version IS NULL;
+
+CREATE INDEX IF NOT EXISTS person_name_version_idx ON person (name_version);
+CREATE INDEX IF NOT EXISTS genre_name_version_idx ON genre (name_version);
+CREATE INDEX IF NOT EXISTS producer_studio_name_version_idx ON producer_studio (name_version);
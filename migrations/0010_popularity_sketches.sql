@@ -0,0 +1,9 @@
+-- Per-day popularity sketches (count-min, space-saving heavy hitters and
+-- distinct-viewer HyperLogLogs, see popularity_sketch.py), merged into by
+-- every session with an optimistic version check.
+
+CREATE TABLE IF NOT EXISTS popularity_sketches (
+    window_start  DATE    PRIMARY KEY,
+    version       INTEGER NOT NULL,
+    sketch        BYTEA   NOT NULL
+);
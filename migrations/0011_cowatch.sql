@@ -0,0 +1,45 @@
+-- Movie-to-movie co-watch counts (written by cowatch.py): for each movie the
+-- movies watched by the same user in the same week, counted once per user
+-- week and kept for the most co-watched movies only.
+
+CREATE TABLE IF NOT EXISTS cowatch_topk (
+    mid        INTEGER NOT NULL,
+    other_mid  INTEGER NOT NULL,
+    count      INTEGER NOT NULL,
+    PRIMARY KEY (mid, other_mid)
+);
+
+CREATE INDEX IF NOT EXISTS cowatch_topk_mid_count_idx
+    ON cowatch_topk (mid, count DESC, other_mid);
+-- "because you watched" lookups read a movie's first rows of this index
+
+-- watches not counted yet, queued by a statement-level trigger on watches.
+-- A watch becomes visible here when its transaction commits, whatever its
+-- watchdate (the watch journal inserts watches well after they happened),
+-- so cowatch.py consumes the queue instead of a watchdate checkpoint
+CREATE TABLE IF NOT EXISTS cowatch_pending (
+    username   VARCHAR   NOT NULL,
+    mid        INTEGER   NOT NULL,
+    watchdate  TIMESTAMP NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION cowatch_queue_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO cowatch_pending (username, mid, watchdate)
+    SELECT username, mid, watchdate FROM new_watches;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS cowatch_queue ON watches;
+CREATE TRIGGER cowatch_queue AFTER INSERT ON watches
+    REFERENCING NEW TABLE AS new_watches
+    FOR EACH STATEMENT EXECUTE FUNCTION cowatch_queue_trigger();
+
+-- set by cowatch.py --rebuild; incremental runs need a full count first
+CREATE TABLE IF NOT EXISTS cowatch_state (
+    id          BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    rebuilt_at  TIMESTAMP NOT NULL
+);
+
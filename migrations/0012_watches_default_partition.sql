@@ -0,0 +1,5 @@
+-- Catch-all partition for watches outside every monthly partition, so
+-- watch_movie keeps working if partitions.py stops running. partitions.py
+-- moves its rows into the monthly partition when it creates that month.
+
+CREATE TABLE IF NOT EXISTS watches_default PARTITION OF watches DEFAULT;
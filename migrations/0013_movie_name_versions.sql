@@ -0,0 +1,13 @@
+-- Change versions of movie titles, from the name_version sequence of
+-- 0009_name_versions.sql, so the autocomplete and fuzzy search indexes can
+-- fetch only the titles and names changed since their last refresh.
+
+ALTER TABLE movie ADD COLUMN IF NOT EXISTS name_version BIGINT;
+
+DROP TRIGGER IF EXISTS name_version_movie ON movie;
+CREATE TRIGGER name_version_movie BEFORE INSERT OR UPDATE OF title ON movie
+    FOR EACH ROW EXECUTE FUNCTION name_version_trigger();
+
+UPDATE movie SET name_version = nextval('name_version_seq') WHERE name_version IS NULL;
+
+CREATE INDEX IF NOT EXISTS movie_name_version_idx ON movie (name_version);
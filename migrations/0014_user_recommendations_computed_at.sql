@@ -0,0 +1,6 @@
+-- When each precomputed list was written, so PDM_proj can fall back to the
+-- live queries for lists older than PDM_PRECOMPUTED_MAX_AGE. Lists written
+-- before this migration have no time and count as stale.
+
+ALTER TABLE user_recommendations ADD COLUMN IF NOT EXISTS computed_at TIMESTAMP;
+ALTER TABLE user_recommendations ALTER COLUMN computed_at SET DEFAULT now();
@@ -0,0 +1,193 @@
+"""
+Client-side dictionary of person, genre and studio names.
+Team Peacock.
+
+With id listings (see MOVIE_ID_QUERY in PDM_proj) the server returns arrays of
+ids instead of building and sending the same name strings for every row;
+this dictionary resolves them to display names locally.
+
+The names are loaded in bulk once and kept in a local file between runs.
+After that only names changed since the dictionary's version are fetched
+(person, genre and producer_studio carry a name_version from one shared
+sequence, see migrations/0009_name_versions.sql), at most every refresh
+seconds. Versions are assigned before commit, so a change committed out of
+version order can be skipped by an incremental refresh: ids that are not in
+the dictionary are fetched when they are looked up, and the whole
+dictionary is reloaded every full_reload seconds to pick up skipped renames.
+"""
+
+
+import os
+import json
+import threading
+from time import time
+
+
+# kind -> (query of (id, display name, version), id column)
+SOURCES = {
+    "person": ("SELECT peid, CONCAT(firstname, ' ', lastname), name_version FROM person", "peid"),
+    "genre": ("SELECT gid, name, name_version FROM genre", "gid"),
+    "studio": ("SELECT prid, name, name_version FROM producer_studio", "prid"),
+}
+
+FORMAT = 1
+# version of the cache file layout
+
+
+class NameDictionary:
+    """
+    Versioned, locally cached id -> name maps.
+    """
+
+    def __init__(self, path: str = None, refresh: float = 60.0, full_reload: float = 86400.0):
+        """
+        :param path: file keeping the dictionary between runs (None for none)
+        :param refresh: seconds between incremental refreshes
+        :param full_reload: seconds between full reloads
+        """
+
+        self.path = path
+        self.refresh_interval = refresh
+        self.full_reload = full_reload
+        self.names = {kind: {} for kind in SOURCES}
+        self.version = 0
+        # highest name_version loaded by a bulk or incremental refresh
+        self.loaded_at = 0.0
+        # time of the last full load
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+        if path is not None:
+            self.load_file()
+
+    def load_file(self) -> None:
+        """
+        Loads the dictionary saved by an earlier run, if any.
+        """
+
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if data.get("format") != FORMAT:
+            return
+
+        self.names = {kind: {int(i): name for i, name in data["names"].get(kind, {}).items()}
+                      for kind in SOURCES}
+        self.version = data["version"]
+        self.loaded_at = data["loaded_at"]
+
+    def save(self) -> None:
+        """
+        Saves the dictionary; the file is replaced atomically.
+        """
+
+        if self.path is None:
+            return
+
+        with open(self.path + ".tmp", "w") as file:
+            json.dump({"format": FORMAT, "version": self.version, "loaded_at": self.loaded_at,
+                       "names": self.names}, file)
+
+        os.replace(self.path + ".tmp", self.path)
+
+    def refresh(self, conn, force: bool = False) -> int:
+        """
+        Fetches the names changed since the dictionary's version (or all of
+        them when the dictionary is empty or due for a full reload).
+
+        :param force: refresh even if the last refresh is recent
+        :return: the number of names fetched
+        """
+
+        with self.lock:
+            now = time()
+
+            if not force and now - self.refreshed_at < self.refresh_interval:
+                return 0
+
+            full = self.version == 0 or now - self.loaded_at > self.full_reload
+            since = 0 if full else self.version
+            curs = conn.cursor()
+            names = {kind: {} for kind in SOURCES}
+            version = since
+            count = 0
+
+            for kind, (query, _) in SOURCES.items():
+                curs.execute(query + " WHERE name_version > %s", (since,))
+
+                for i, name, name_version in curs:
+                    names[kind][i] = name
+                    version = max(version, name_version or 0)
+                    count += 1
+
+            curs.close()
+
+            if full:
+                self.names = names
+                self.loaded_at = now
+            else:
+                for kind in SOURCES:
+                    self.names[kind].update(names[kind])
+
+            self.version = version
+            self.refreshed_at = now
+
+            if count:
+                self.save()
+
+            return count
+
+    def fetch(self, kind: str, ids: set, conn) -> None:
+        """
+        Fetches names missing from the dictionary by id.
+        """
+
+        query, column = SOURCES[kind]
+        curs = conn.cursor()
+        curs.execute(query + " WHERE " + column + " = ANY(%s)", (list(ids),))
+
+        with self.lock:
+            for i, name, _ in curs:
+                self.names[kind][i] = name
+                # the version is not advanced: older changes may be unseen
+
+        curs.close()
+
+    def resolve_rows(self, rows: list, columns: tuple, conn) -> list:
+        """
+        Replaces id arrays in result rows by sorted, distinct name lists.
+
+        :param columns: (column index, kind) pairs of the id array columns
+        :return: the resolved rows
+        """
+
+        if not rows:
+            return rows
+
+        self.refresh(conn)
+        missing = {kind: set() for kind in SOURCES}
+
+        for row in rows:
+            for index, kind in columns:
+                names = self.names[kind]
+                missing[kind].update(i for i in row[index] or () if i is not None and i not in names)
+
+        for kind, ids in missing.items():
+            if ids:
+                self.fetch(kind, ids, conn)
+
+        resolved = []
+
+        for row in rows:
+            row = list(row)
+
+            for index, kind in columns:
+                names = self.names[kind]
+                row[index] = sorted({names[i] for i in row[index] or () if i in names})
+
+            resolved.append(tuple(row))
+
+        return resolved
@@ -0,0 +1,241 @@
+"""
+Watches partition manager.
+Team Peacock.
+
+watches is range-partitioned by watchdate with one partition per calendar
+month (see migrations/0001_partitioned_watches.sql). This script creates the
+partitions for the upcoming months and rolls partitions older than the
+retention window into the per-movie and per-user monthly summary tables
+before dropping them.
+
+Watches outside every monthly partition land in watches_default
+(migrations/0012_watches_default_partition.sql) instead of failing, e.g.
+when this script has not run for a while. Creating a month moves its rows
+out of watches_default into the new partition.
+
+Usage: python partitions.py [--install] [--months-ahead N] [--retain-months N]
+"""
+
+
+import sys
+import psycopg2
+from datetime import date
+from migrate import apply_pending
+from PDM_proj import db_params
+
+
+MIGRATION_VERSION = 1
+# migrations/0001_partitioned_watches.sql
+DEFAULT_PARTITION = "watches_default"
+
+
+def add_months(month: date, count: int) -> date:
+    """
+    Adds a number of months to the first day of a month.
+    """
+
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    """
+    Gets the partition table name for a month.
+    """
+
+    return "watches_y%04dm%02d" % (month.year, month.month)
+
+
+def install(conn) -> None:
+    """
+    Converts watches into a partitioned table and creates the rollup tables.
+    """
+
+    apply_pending(conn, MIGRATION_VERSION)
+    print("Partitioned watches installed")
+
+
+def list_partitions(conn) -> list:
+    """
+    Gets the months that currently have a watches partition.
+
+    :return: a sorted list of dates (first day of each month)
+    """
+
+    curs = conn.cursor()
+    curs.execute("""SELECT child.relname FROM pg_inherits
+                 JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+                 JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+                 WHERE parent.relname = 'watches'""")
+    names = [row[0] for row in curs.fetchall()]
+    curs.close()
+
+    months = []
+
+    for name in names:
+        try:
+            months.append(date(int(name[9:13]), int(name[14:16]), 1))
+        except ValueError:
+            continue
+            # ignores partitions not created by this manager
+
+    return sorted(months)
+
+
+def default_months(conn) -> list:
+    """
+    Gets the months that have rows in the default partition.
+
+    :return: a list of dates (first day of each month)
+    """
+
+    curs = conn.cursor()
+    curs.execute("SELECT to_regclass(%s)", (DEFAULT_PARTITION,))
+
+    if curs.fetchone()[0] is None:
+        curs.close()
+        return []
+
+    curs.execute(f"SELECT DISTINCT date_trunc('month', watchdate)::DATE FROM {DEFAULT_PARTITION}")
+    months = [row[0] for row in curs.fetchall()]
+    curs.close()
+    return months
+
+
+def create_partition(month: date, curs) -> None:
+    """
+    Creates a month's partition, moving its rows out of the default partition.
+
+    The partition is filled before it is attached, so the default partition
+    never holds rows of an attached month. Statements on the partitions
+    themselves do not fire the statement-level triggers on watches, so the
+    moved rows are not counted again by the rollups built from them.
+    """
+
+    name = partition_name(month)
+    curs.execute(f"CREATE TABLE {name} (LIKE watches INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    curs.execute("SELECT to_regclass(%s)", (DEFAULT_PARTITION,))
+
+    if curs.fetchone()[0] is not None:
+        curs.execute(f"LOCK TABLE {DEFAULT_PARTITION} IN EXCLUSIVE MODE")
+        # holds off inserts into the month until it is attached; reads go on
+        curs.execute(f"""WITH moved AS (
+                     DELETE FROM {DEFAULT_PARTITION} WHERE watchdate >= %s AND watchdate < %s RETURNING *)
+                     INSERT INTO {name} SELECT * FROM moved""", (month, add_months(month, 1)))
+
+    curs.execute(f"ALTER TABLE watches ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+                 (month, add_months(month, 1)))
+
+
+def ensure_partitions(conn, months_ahead: int = 3) -> list:
+    """
+    Creates the partitions for the current month, the upcoming months and
+    any month with rows in the default partition.
+
+    :return: a list of the partition names that were created
+    """
+
+    this_month = date.today().replace(day=1)
+    existing = set(list_partitions(conn))
+    months = {add_months(this_month, offset) for offset in range(months_ahead + 1)}
+    months.update(default_months(conn))
+    created = []
+
+    curs = conn.cursor()
+
+    for month in sorted(months - existing):
+        create_partition(month, curs)
+        conn.commit()
+        # each month is moved in its own transaction
+        created.append(partition_name(month))
+
+    curs.close()
+    return created
+
+
+def rollup_partition(month: date, conn) -> None:
+    """
+    Folds a month's partition into the monthly summary tables and drops it.
+
+    Both steps run in one transaction so a failure leaves the partition in
+    place and the rollup can simply be retried.
+    """
+
+    name = partition_name(month)
+    curs = conn.cursor()
+
+    curs.execute(f"""INSERT INTO watches_movie_monthly (mid, month, plays, viewers)
+                 SELECT mid, %s, count(*), count(DISTINCT username) FROM {name}
+                 GROUP BY mid
+                 ON CONFLICT (mid, month) DO UPDATE SET
+                 plays = watches_movie_monthly.plays + EXCLUDED.plays,
+                 viewers = watches_movie_monthly.viewers + EXCLUDED.viewers""", (month,))
+
+    curs.execute(f"""INSERT INTO watches_user_monthly (username, mid, month, plays)
+                 SELECT username, mid, %s, count(*) FROM {name}
+                 GROUP BY username, mid
+                 ON CONFLICT (username, mid, month) DO UPDATE SET
+                 plays = watches_user_monthly.plays + EXCLUDED.plays""", (month,))
+
+    curs.execute(f"ALTER TABLE watches DETACH PARTITION {name}")
+    curs.execute(f"DROP TABLE {name}")
+    conn.commit()
+    curs.close()
+
+
+def apply_retention(conn, retain_months: int = 12) -> list:
+    """
+    Rolls up every partition older than the retention window.
+
+    :return: a list of the months that were rolled up
+    """
+
+    cutoff = add_months(date.today().replace(day=1), -retain_months)
+    rolled = []
+
+    for month in list_partitions(conn):
+        if month >= cutoff:
+            break
+
+        rollup_partition(month, conn)
+        rolled.append(month)
+
+    return rolled
+
+
+def main() -> None:
+    """
+    Runs partition maintenance.
+    """
+
+    months_ahead = 3
+    retain_months = 12
+    args = sys.argv[1:]
+
+    try:
+        if "--months-ahead" in args:
+            months_ahead = int(args[args.index("--months-ahead") + 1])
+        if "--retain-months" in args:
+            retain_months = int(args[args.index("--retain-months") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            if "--install" in args:
+                install(conn)
+
+            for name in ensure_partitions(conn, months_ahead):
+                print("Created partition " + name)
+
+            for month in apply_retention(conn, retain_months):
+                print("Rolled up partition " + partition_name(month))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
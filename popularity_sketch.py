@@ -0,0 +1,483 @@
+"""
+Approximate popularity sketches for the leaderboards.
+Team Peacock.
+
+Watches are summarized per calendar day (a window) by three mergeable
+structures:
+- a count-min sketch of plays per movie (any movie's plays, overestimated
+  by at most epsilon * plays in the window with probability 1 - delta),
+- a space-saving summary of the heavy hitters (the k most played movies,
+  each with an error bound), and
+- a HyperLogLog of distinct viewers for each tracked heavy hitter (viewers
+  before a movie became tracked in the window are not counted).
+
+Each session records its watches in local pending windows and merges them
+into popularity_sketches (one compressed row of a few KB per day) every
+flush_every watches or flush_after seconds, with an optimistic version check
+so concurrent sessions never lose each other's updates. Top-N queries merge
+the stored windows of the requested period. Every session must use the same
+sketch parameters; build_popularity.py --rebuild rewrites the windows from
+watches with the current ones.
+"""
+
+
+import math
+import zlib
+import struct
+import hashlib
+import threading
+from array import array
+from time import time
+from datetime import date, timedelta
+
+
+FORMAT = 1
+HEADER = struct.Struct("<4sHIIIIQ")
+# magic, format, width, depth, heavy hitters k, HLL bits, watches
+HEAVY_ENTRY = struct.Struct("<iII")
+# mid, count, error
+RETAIN_DAYS = 92
+# windows kept in popularity_sketches
+
+
+def hash64(value) -> tuple:
+    """
+    Gets two independent 64-bit hashes of a value (stable across processes).
+    """
+
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=16).digest()
+    return struct.unpack("<QQ", digest)
+
+
+class CountMin:
+    """
+    Count-min sketch of plays per movie.
+    """
+
+    def __init__(self, width: int, depth: int, table: array = None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else array("I", bytes(4 * width * depth))
+
+    @classmethod
+    def for_bounds(cls, epsilon: float, delta: float) -> "CountMin":
+        """
+        Sizes a sketch overestimating by at most epsilon * total with
+        probability 1 - delta.
+        """
+
+        return cls(math.ceil(math.e / epsilon), math.ceil(math.log(1 / delta)))
+
+    def cells(self, item) -> list:
+        """
+        Gets the item's cell in each row.
+        """
+
+        h1, h2 = hash64(item)
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, count: int = 1) -> None:
+        for cell in self.cells(item):
+            self.table[cell] += count
+
+    def estimate(self, item) -> int:
+        return min(self.table[cell] for cell in self.cells(item))
+
+    def merge(self, other: "CountMin") -> None:
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("count-min sketches of different sizes")
+
+        for i, value in enumerate(other.table):
+            if value:
+                self.table[i] += value
+
+
+class SpaceSaving:
+    """
+    Space-saving summary of the k most frequent items.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.counts = {}
+        # item -> [count, error]; count - error <= true count <= count
+
+    def floor(self) -> int:
+        """
+        Gets the count an untracked item may have had (0 until full).
+        """
+
+        if len(self.counts) < self.k:
+            return 0
+
+        return min(entry[0] for entry in self.counts.values())
+
+    def add(self, item, count: int = 1) -> None:
+        entry = self.counts.get(item)
+
+        if entry is not None:
+            entry[0] += count
+        elif len(self.counts) < self.k:
+            self.counts[item] = [count, 0]
+        else:
+            evicted = min(self.counts, key=lambda key: self.counts[key][0])
+            floor = self.counts.pop(evicted)[0]
+            self.counts[item] = [floor + count, floor]
+
+    def merge(self, other: "SpaceSaving") -> None:
+        """
+        Merges another summary (an untracked item is assumed to have the
+        other summary's floor count, which is added to its error).
+        """
+
+        floor, other_floor = self.floor(), other.floor()
+        merged = {}
+
+        for item in set(self.counts) | set(other.counts):
+            count, error = self.counts.get(item, (floor, floor))
+            other_count, other_error = other.counts.get(item, (other_floor, other_floor))
+            merged[item] = [count + other_count, error + other_error]
+
+        self.counts = dict(sorted(merged.items(), key=lambda entry: -entry[1][0])[:self.k])
+
+    def top(self, n: int) -> list:
+        """
+        :return: a list of (item, count, error), highest count first
+        """
+
+        ranked = sorted(self.counts.items(), key=lambda entry: (-entry[1][0], entry[0]))
+        return [(item, count, error) for item, (count, error) in ranked[:n]]
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct counter.
+    """
+
+    def __init__(self, bits: int, registers: bytearray = None):
+        self.bits = bits
+        self.registers = registers if registers is not None else bytearray(1 << bits)
+
+    def add(self, value) -> None:
+        h = hash64(value)[0]
+        index = h >> (64 - self.bits)
+        rest = (h << self.bits) & (2 ** 64 - 1)
+        rank = 64 - self.bits + 1 if rest == 0 else 65 - rest.bit_length()
+        # position of the first 1 bit after the index bits
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> float:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+
+        if estimate <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+            # linear counting for small cardinalities
+
+        return estimate
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if self.bits != other.bits:
+            raise ValueError("HyperLogLogs of different sizes")
+
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+
+class WindowSketch:
+    """
+    Plays and viewers of one window (or of several merged windows).
+    """
+
+    def __init__(self, width: int, depth: int, k: int, hll_bits: int):
+        self.cms = CountMin(width, depth)
+        self.heavy = SpaceSaving(k)
+        self.hll_bits = hll_bits
+        self.viewers = {}
+        # mid -> HyperLogLog, for the tracked heavy hitters
+        self.watches = 0
+
+    def add(self, mid: int, username: str, count: int = 1) -> None:
+        self.cms.add(mid, count)
+        self.heavy.add(mid, count)
+        self.watches += count
+
+        if mid in self.heavy.counts:
+            self.viewers.setdefault(mid, HyperLogLog(self.hll_bits)).add(username)
+
+        if len(self.viewers) > self.heavy.k:
+            self.viewers = {m: hll for m, hll in self.viewers.items() if m in self.heavy.counts}
+            # drop evicted movies' counters
+
+    def merge(self, other: "WindowSketch", viewers: bool = True) -> None:
+        """
+        :param viewers: also merge the distinct-viewer counters
+        """
+
+        self.cms.merge(other.cms)
+        self.heavy.merge(other.heavy)
+        self.watches += other.watches
+
+        if not viewers:
+            return
+
+        for mid, hll in other.viewers.items():
+            if mid in self.viewers:
+                self.viewers[mid].merge(hll)
+            else:
+                self.viewers[mid] = HyperLogLog(hll.bits, bytearray(hll.registers))
+
+        self.viewers = {m: hll for m, hll in self.viewers.items() if m in self.heavy.counts}
+
+    def top(self, n: int) -> list:
+        """
+        Gets the most played movies.
+
+        :return: a list of (mid, estimated plays, error bound, estimated
+            distinct viewers or None), most played first
+        """
+
+        bound = math.ceil(math.e / self.cms.width * self.watches)
+        # the count-min bound (epsilon * plays)
+        ranked = []
+
+        for mid, count, error in self.heavy.top(self.heavy.k):
+            estimate = min(count, self.cms.estimate(mid))
+            # both overestimate; the smaller is closer
+            viewers = self.viewers.get(mid)
+            ranked.append((mid, estimate, min(error, bound), viewers.count() if viewers else None))
+
+        ranked.sort(key=lambda entry: (-entry[1], entry[0]))
+        return ranked[:n]
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the window (zlib compressed).
+        """
+
+        parts = [HEADER.pack(b"PDMS", FORMAT, self.cms.width, self.cms.depth, self.heavy.k,
+                             self.hll_bits, self.watches),
+                 self.cms.table.tobytes(),
+                 struct.pack("<I", len(self.heavy.counts))]
+        parts.extend(HEAVY_ENTRY.pack(mid, count, error) for mid, (count, error) in self.heavy.counts.items())
+        parts.append(struct.pack("<I", len(self.viewers)))
+
+        for mid, hll in self.viewers.items():
+            parts.append(struct.pack("<i", mid))
+            parts.append(bytes(hll.registers))
+
+        return zlib.compress(b"".join(parts))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "WindowSketch":
+        data = zlib.decompress(data)
+        magic, version, width, depth, k, hll_bits, watches = HEADER.unpack_from(data)
+
+        if magic != b"PDMS" or version != FORMAT:
+            raise ValueError("not a popularity sketch")
+
+        sketch = cls(width, depth, k, hll_bits)
+        sketch.watches = watches
+        offset = HEADER.size
+        sketch.cms.table = array("I")
+        sketch.cms.table.frombytes(data[offset:offset + 4 * width * depth])
+        offset += 4 * width * depth
+
+        (count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+
+        for _ in range(count):
+            mid, plays, error = HEAVY_ENTRY.unpack_from(data, offset)
+            sketch.heavy.counts[mid] = [plays, error]
+            offset += HEAVY_ENTRY.size
+
+        (count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        size = 1 << hll_bits
+
+        for _ in range(count):
+            (mid,) = struct.unpack_from("<i", data, offset)
+            sketch.viewers[mid] = HyperLogLog(hll_bits, bytearray(data[offset + 4:offset + 4 + size]))
+            offset += 4 + size
+
+        return sketch
+
+
+class PopularitySketch:
+    """
+    A session's view of the shared per-day popularity sketches.
+    """
+
+    def __init__(self, epsilon: float = 0.01, delta: float = 0.01, k: int = 100, hll_bits: int = 8,
+                 flush_every: int = 20, flush_after: float = 60.0):
+        """
+        :param epsilon: count-min error per window, as a fraction of its plays
+        :param delta: probability a count-min estimate exceeds that error
+        :param k: heavy hitters tracked per window
+        :param hll_bits: log2 of the registers per distinct-viewer counter
+            (standard error about 1.04 / sqrt(2 ** hll_bits))
+        :param flush_every: pending watches that trigger a flush
+        :param flush_after: seconds after which pending watches are flushed
+        """
+
+        size = CountMin.for_bounds(epsilon, delta)
+        self.params = (size.width, size.depth, k, hll_bits)
+        self.flush_every = flush_every
+        self.flush_after = flush_after
+        self.pending = {}
+        # window date -> WindowSketch of watches not yet flushed
+        self.pending_watches = 0
+        self.flushed_at = time()
+        self.lock = threading.Lock()
+
+    def new_window(self) -> WindowSketch:
+        return WindowSketch(*self.params)
+
+    def record(self, mid: int, username: str, when) -> bool:
+        """
+        Records a watch locally.
+
+        :return: True if a flush is due
+        """
+
+        with self.lock:
+            window = self.pending.get(when.date())
+
+            if window is None:
+                window = self.pending[when.date()] = self.new_window()
+
+            window.add(mid, username)
+            self.pending_watches += 1
+            return self.pending_watches >= self.flush_every or time() - self.flushed_at > self.flush_after
+
+    def flush(self, conn) -> int:
+        """
+        Merges the pending windows into popularity_sketches and drops
+        windows older than RETAIN_DAYS.
+
+        :return: the number of watches flushed
+        """
+
+        curs = conn.cursor()
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            flushed, self.pending_watches = self.pending_watches, 0
+            self.flushed_at = time()
+
+        try:
+            for day in sorted(pending):
+                while not merge_window(day, pending[day], curs):
+                    conn.rollback()
+                    # another session updated the window first; merge again
+
+                conn.commit()
+                del pending[day]
+                # committed days are not re-queued if a later one fails
+
+            curs.execute("DELETE FROM popularity_sketches WHERE window_start < %s",
+                         (date.today() - timedelta(days=RETAIN_DAYS),))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+
+            with self.lock:
+                for day, window in pending.items():
+                    if day in self.pending:
+                        window.merge(self.pending[day])
+                    self.pending[day] = window
+
+                self.pending_watches += sum(window.watches for window in pending.values())
+                # the uncommitted days are kept for the next flush
+
+            raise
+        finally:
+            curs.close()
+
+        return flushed
+
+    def windows_since(self, since: date, conn) -> list:
+        """
+        Gets the stored and pending windows from since (inclusive).
+        """
+
+        curs = conn.cursor()
+        curs.execute("SELECT sketch FROM popularity_sketches WHERE window_start >= %s", (since,))
+        windows = [WindowSketch.from_bytes(bytes(data)) for (data,) in curs]
+        curs.close()
+
+        with self.lock:
+            windows.extend(window for day, window in self.pending.items() if day >= since)
+
+        return windows
+
+    def merge_plays(self, windows: list) -> WindowSketch:
+        """
+        Merges the play counts of windows (without the viewer counters).
+        """
+
+        merged = self.new_window()
+
+        for window in windows:
+            merged.merge(window, viewers=False)
+
+        return merged
+
+    def plays(self, mids: list, since: date, conn) -> dict:
+        """
+        Estimates the plays of any movies from since, tracked or not (from
+        the count-min sketch, so overestimated by at most epsilon * plays).
+
+        :return: a dict of mid -> estimated plays
+        """
+
+        merged = self.merge_plays(self.windows_since(since, conn))
+        return {mid: merged.cms.estimate(mid) for mid in mids}
+
+    def top(self, n: int, since: date, conn) -> list:
+        """
+        Gets the most played movies from since (see WindowSketch.top).
+        """
+
+        windows = self.windows_since(since, conn)
+        merged = self.merge_plays(windows)
+        ranked = []
+
+        for mid, plays, error, _ in merged.top(n):
+            viewers = HyperLogLog(merged.hll_bits)
+            tracked = False
+
+            for window in windows:
+                if mid in window.viewers:
+                    viewers.merge(window.viewers[mid])
+                    tracked = True
+
+            ranked.append((mid, plays, error, viewers.count() if tracked else None))
+
+        return ranked
+
+
+def merge_window(day: date, window: WindowSketch, curs) -> bool:
+    """
+    Merges a window into its stored row, if no other session changed the
+    row since it was read.
+
+    :return: False if the merge lost a race and must be retried
+    """
+
+    curs.execute("SELECT version, sketch FROM popularity_sketches WHERE window_start = %s", (day,))
+    row = curs.fetchone()
+
+    if row is None:
+        curs.execute("""INSERT INTO popularity_sketches (window_start, version, sketch)
+                     VALUES (%s, 0, %s) ON CONFLICT DO NOTHING""", (day, window.to_bytes()))
+        return curs.rowcount == 1
+
+    version, data = row
+    stored = WindowSketch.from_bytes(bytes(data))
+    stored.merge(window)
+    curs.execute("""UPDATE popularity_sketches SET sketch = %s, version = version + 1
+                 WHERE window_start = %s AND version = %s""", (stored.to_bytes(), day, version))
+    return curs.rowcount == 1
@@ -0,0 +1,267 @@
+"""
+Per-user recommendation precompute.
+Team Peacock.
+
+Splits users into username-range shards and computes, for every user of a
+shard at once with set-based queries, the play-history recommendations, the
+three top-10 lists and the friends top 20. Shards run on a process pool,
+each worker with its own connection; a shard's lists replace its users' old
+lists with COPY in the same transaction that checkpoints the shard, so an
+interrupted run resumes (--resume) with the shards it had not finished.
+Results go to user_recommendations (migrations/0005_precomputed_recommendations.sql),
+which PDM_proj reads when PDM_PRECOMPUTED=1.
+
+Usage: python precompute_recommendations.py [--shards N] [--workers N] [--resume]
+"""
+
+
+import io
+import sys
+import psycopg2
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PDM_proj import WATCH_HISTORY, db_params
+
+
+SHARDS = 64
+
+WORKER = {}
+# per-process database connection
+
+# (kind, query) per list; each query returns (username, mid, rank) for the
+# users matching {shard} (a username range filter on the given column)
+LIST_QUERIES = (
+    ("recommended", f"""
+        WITH ug AS (
+            SELECT username, gid FROM (
+                SELECT W.username, MG.gid, ROW_NUMBER() OVER (
+                    PARTITION BY W.username ORDER BY SUM(W.plays) DESC) AS rn
+                FROM {WATCH_HISTORY} W JOIN moviegenre MG ON W.mid = MG.mid
+                WHERE {{shard:W.username}}
+                GROUP BY W.username, MG.gid) g
+            WHERE rn <= 5
+        ), sim AS (
+            SELECT ug.username, W.username AS other
+            FROM ug JOIN moviegenre MG ON MG.gid = ug.gid JOIN {WATCH_HISTORY} W ON W.mid = MG.mid
+            WHERE W.username <> ug.username
+            GROUP BY ug.username, W.username
+            HAVING SUM(W.plays) >= 2
+        ), cand AS (
+            SELECT DISTINCT sim.username, W.mid
+            FROM sim JOIN {WATCH_HISTORY} W ON W.username = sim.other
+            JOIN moviegenre MG ON MG.mid = W.mid
+            JOIN ug ON ug.username = sim.username AND ug.gid = MG.gid
+            WHERE NOT EXISTS (SELECT 1 FROM {WATCH_HISTORY} H
+                              WHERE H.username = sim.username AND H.mid = W.mid)
+        )
+        SELECT username, mid, rank FROM (
+            SELECT cand.username, cand.mid, ROW_NUMBER() OVER (
+                PARTITION BY cand.username ORDER BY movie.rating DESC, movie.title) AS rank
+            FROM cand JOIN movie ON movie.mid = cand.mid) r
+        WHERE rank <= 15"""),
+    ("top10_rating", """
+        SELECT username, mid, rank FROM (
+            SELECT username, mid, ROW_NUMBER() OVER (
+                PARTITION BY username ORDER BY rating DESC, mid) AS rank
+            FROM rates WHERE {shard:username}) r
+        WHERE rank <= 10"""),
+    ("top10_plays", f"""
+        SELECT username, mid, rank FROM (
+            SELECT W.username, W.mid, ROW_NUMBER() OVER (
+                PARTITION BY W.username ORDER BY SUM(W.plays) DESC, W.mid) AS rank
+            FROM {WATCH_HISTORY} W WHERE {{shard:W.username}} GROUP BY W.username, W.mid) r
+        WHERE rank <= 10"""),
+    ("top10_combined", f"""
+        SELECT username, mid, rank FROM (
+            SELECT w.username, w.mid, ROW_NUMBER() OVER (
+                PARTITION BY w.username ORDER BY COALESCE(r.rating, 3) / 5.0 * w.num DESC, w.mid) AS rank
+            FROM (SELECT H.username, H.mid, SUM(H.plays) AS num FROM {WATCH_HISTORY} H
+                  WHERE {{shard:H.username}} GROUP BY H.username, H.mid) w
+            LEFT JOIN rates r ON r.username = w.username AND r.mid = w.mid) c
+        WHERE rank <= 10"""),
+    ("friends_top20", f"""
+        WITH f AS (
+            SELECT username1 AS username, username2 AS friend FROM friends WHERE {{shard:username1}}
+            UNION
+            SELECT username2, username1 FROM friends WHERE {{shard:username2}}
+        )
+        SELECT username, mid, rank FROM (
+            SELECT f.username, W.mid, ROW_NUMBER() OVER (
+                PARTITION BY f.username ORDER BY SUM(W.plays) DESC, W.mid) AS rank
+            FROM f JOIN {WATCH_HISTORY} W ON W.username = f.friend
+            GROUP BY f.username, W.mid) p
+        WHERE rank <= 20"""),
+)
+
+
+def shard_filter(query: str, high) -> str:
+    """
+    Replaces {shard:<column>} placeholders with username range filters.
+    """
+
+    while "{shard:" in query:
+        start = query.index("{shard:")
+        end = query.index("}", start)
+        column = query[start + len("{shard:"):end]
+        condition = f"{column} >= %(low)s" + (f" AND {column} < %(high)s" if high is not None else "")
+        query = query[:start] + condition + query[end + 1:]
+
+    return query
+
+
+def shard_bounds(shards: int, conn) -> list:
+    """
+    Splits usernames into about shards equal ranges.
+
+    :return: the lowest username of each shard
+    """
+
+    curs = conn.cursor()
+    curs.execute("""SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY username)
+                 FROM "User" """, ([i / shards for i in range(1, shards)],))
+    cuts = curs.fetchone()[0] or []
+    curs.close()
+    return [""] + sorted(set(cut for cut in cuts if cut is not None))
+
+
+def start_run(shards: int, resume: bool, conn) -> tuple:
+    """
+    Starts a run, or picks up the latest unfinished one.
+
+    :return: (run id, shard bounds, set of finished shards)
+    """
+
+    curs = conn.cursor()
+
+    if resume:
+        curs.execute("""SELECT run_id, bounds FROM precompute_runs WHERE finished_at IS NULL
+                     ORDER BY run_id DESC LIMIT 1""")
+        row = curs.fetchone()
+
+        if row is not None:
+            curs.execute("SELECT shard FROM precompute_checkpoint WHERE run_id = %s", (row[0],))
+            done = {shard for shard, in curs.fetchall()}
+            curs.close()
+            return row[0], row[1], done
+
+    bounds = shard_bounds(shards, conn)
+    curs.execute("INSERT INTO precompute_runs (shards, bounds) VALUES (%s, %s) RETURNING run_id",
+                 (len(bounds), bounds))
+    run_id = curs.fetchone()[0]
+    conn.commit()
+    curs.close()
+    return run_id, bounds, set()
+
+
+def init_worker(params: dict) -> None:
+    """
+    Opens a pool worker's connection.
+    """
+
+    WORKER["conn"] = psycopg2.connect(**params)
+
+
+def run_shard(run_id: int, shard: int, low: str, high) -> tuple:
+    """
+    Computes and stores every list of one shard (runs in a pool worker).
+
+    :return: (shard, users, rows written)
+    """
+
+    conn = WORKER["conn"]
+    curs = conn.cursor()
+    bounds = {"low": low, "high": high}
+    buffer = io.StringIO()
+    rows = 0
+
+    try:
+        for kind, query in LIST_QUERIES:
+            curs.execute(shard_filter(query, high), bounds)
+
+            for username, mid, rank in curs.fetchall():
+                buffer.write("%s\t%s\t%d\t%d\n" % (username.replace("\\", "\\\\").replace("\t", "\\t")
+                                                   .replace("\n", "\\n"), kind, rank, mid))
+                rows += 1
+
+        curs.execute(shard_filter('SELECT count(*) FROM "User" WHERE {shard:username}', high), bounds)
+        users = curs.fetchone()[0]
+
+        curs.execute(shard_filter("DELETE FROM user_recommendations WHERE {shard:username}", high), bounds)
+        buffer.seek(0)
+        curs.copy_expert("COPY user_recommendations (username, kind, rank, mid) FROM STDIN", buffer)
+        curs.execute("INSERT INTO precompute_checkpoint (run_id, shard, users) VALUES (%s, %s, %s)",
+                     (run_id, shard, users))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        curs.close()
+
+    return shard, users, rows
+
+
+def main() -> None:
+    """
+    Runs (or resumes) a precompute.
+    """
+
+    shards = SHARDS
+    workers = None
+    args = sys.argv[1:]
+
+    try:
+        if "--shards" in args:
+            shards = int(args[args.index("--shards") + 1])
+        if "--workers" in args:
+            workers = int(args[args.index("--workers") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            run_id, bounds, done = start_run(shards, "--resume" in args, conn)
+            pending = [shard for shard in range(len(bounds)) if shard not in done]
+            print("Run %d: %d shards, %d to go" % (run_id, len(bounds), len(pending)))
+
+            began = perf_counter()
+            total_users = 0
+            failed = 0
+
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                     initargs=(params,)) as pool:
+                tasks = [pool.submit(run_shard, run_id, shard, bounds[shard],
+                                     bounds[shard + 1] if shard + 1 < len(bounds) else None)
+                         for shard in pending]
+
+                for task in as_completed(tasks):
+                    try:
+                        shard, users, rows = task.result()
+                    except Exception as e:
+                        print("Shard failed (rerun with --resume): " + str(e))
+                        failed += 1
+                        continue
+
+                    total_users += users
+                    elapsed = perf_counter() - began
+                    print("shard %4d  %7d users  %8d rows  %8.1f users/s overall" % (
+                        shard, users, rows, total_users / max(elapsed, 1e-9)))
+
+            if failed == 0:
+                curs = conn.cursor()
+                curs.execute("UPDATE precompute_runs SET finished_at = now() WHERE run_id = %s", (run_id,))
+                conn.commit()
+                curs.close()
+
+            print("%d users in %.1fs (%.1f users/s), %d shards failed" % (
+                total_users, perf_counter() - began,
+                total_users / max(perf_counter() - began, 1e-9), failed))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Prefetching of likely-next screens.
+Team Peacock.
+
+The PTUI flow is predictable (after login users open a menu, after listing
+collections they open one), so queries for the next screen can start while
+the user is still reading the current one. A Prefetcher runs such queries
+on background threads, each with a connection from a small pool, and keeps
+the pending results in a per-session cache keyed by screen. Taking a result
+waits for it if it is still running and falls back to running the query
+directly if it was never prefetched or failed.
+
+Results are taken once (the next visit queries again), the session's own
+writes drop every pending result, and a result started more than max_age
+seconds before it is taken is discarded for a direct query, so a prefetched
+screen is never older than the user's last change nor than max_age (other
+users' follows or ratings may have changed it meanwhile).
+"""
+
+
+import queue
+import threading
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Background query runner with a per-session result cache.
+    """
+
+    def __init__(self, connect, workers: int = 2, max_age: float = 30.0):
+        """
+        :param connect: function returning a new psycopg2 connection
+        :param workers: background threads (and pooled connections)
+        :param max_age: seconds after its start a prefetched result is used
+        """
+
+        self.connect = connect
+        self.max_age = max_age
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.idle = queue.LifoQueue()
+        # pooled connections not in use
+        self.connections = []
+        self.cache = {}
+        # key -> (time started, Future of the result)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def acquire(self):
+        """
+        Gets a pooled connection, opening one if none is idle.
+        """
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+            conn.autocommit = True
+            # reads only; never hold a transaction open between prefetches
+
+            with self.lock:
+                self.connections.append(conn)
+
+            return conn
+
+    def call(self, func, args: tuple):
+        """
+        Runs func(*args, conn) on a pooled connection (on a worker thread).
+        """
+
+        conn = self.acquire()
+
+        try:
+            return func(*args, conn)
+        finally:
+            if conn.closed:
+                with self.lock:
+                    self.connections.remove(conn)
+            else:
+                self.idle.put(conn)
+
+    def prefetch(self, key, func, *args) -> None:
+        """
+        Starts func(*args, conn) in the background unless key is cached.
+        """
+
+        with self.lock:
+            entry = self.cache.get(key)
+
+            if entry is not None and monotonic() - entry[0] <= self.max_age:
+                return
+
+            self.cache[key] = (monotonic(), self.executor.submit(self.call, func, args))
+
+    def take(self, key, func, *args, conn):
+        """
+        Gets the prefetched result of key, or runs func(*args, conn).
+        """
+
+        with self.lock:
+            entry = self.cache.pop(key, None)
+
+        future = None
+
+        if entry is not None:
+            if monotonic() - entry[0] <= self.max_age:
+                future = entry[1]
+            else:
+                self.expired += 1
+                # too old to show; query again
+
+        if future is not None:
+            try:
+                result = future.result()
+                self.hits += 1
+                return result
+            except Exception:
+                pass
+                # the prefetch failed; run the query here instead
+
+        self.misses += 1
+        return func(*args, conn)
+
+    def invalidate(self) -> None:
+        """
+        Drops every pending result (after a write by this session).
+        """
+
+        with self.lock:
+            self.cache.clear()
+
+    def close(self) -> None:
+        """
+        Stops the workers and closes the pooled connections.
+        """
+
+        self.invalidate()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+        with self.lock:
+            for conn in self.connections:
+                if not conn.closed:
+                    conn.close()
+
+            self.connections = []
@@ -0,0 +1,95 @@
+"""
+Movie rating aggregate check.
+Team Peacock.
+
+Compares every movie's rating_sum / rating_count (kept up to date by the
+triggers of migrations/0008_movie_rating_aggregates.sql) with the ratings
+in rates and lists the movies that drifted. With --repair the drifted
+movies are recomputed by repair_movie_ratings(), which locks rates against
+writes until it commits.
+
+Usage: python rating_check.py [--repair]
+"""
+
+
+import sys
+import psycopg2
+from PDM_proj import db_params
+
+
+SHOW = 20
+# drifted movies listed in full
+
+DRIFT_QUERY = """SELECT movie.mid, movie.title, movie.rating_sum, movie.rating_count,
+                actual.rating_sum, actual.rating_count
+                FROM movie JOIN (
+                    SELECT movie.mid, COALESCE(sum(rates.rating), 0) AS rating_sum,
+                    count(rates.rating) AS rating_count
+                    FROM movie LEFT JOIN rates ON movie.mid = rates.mid
+                    GROUP BY movie.mid) actual ON movie.mid = actual.mid
+                WHERE (movie.rating_sum, movie.rating_count)
+                IS DISTINCT FROM (actual.rating_sum, actual.rating_count)
+                ORDER BY movie.mid"""
+
+
+def drifted(conn) -> list:
+    """
+    Finds movies whose stored aggregates differ from rates.
+
+    Ratings committed while the check runs can show up as drift; the repair
+    re-checks under a lock.
+
+    :return: a list of (mid, title, stored sum, stored count, actual sum, actual count)
+    """
+
+    curs = conn.cursor()
+    curs.execute(DRIFT_QUERY)
+    rows = curs.fetchall()
+    conn.rollback()
+    curs.close()
+    return rows
+
+
+def repair(conn) -> int:
+    """
+    Recomputes the drifted movies' aggregates.
+
+    :return: the number of movies repaired
+    """
+
+    curs = conn.cursor()
+    curs.execute("SELECT repair_movie_ratings()")
+    repaired = curs.fetchone()[0]
+    conn.commit()
+    curs.close()
+    return repaired
+
+
+def main() -> None:
+    """
+    Reports (and with --repair, fixes) drifted rating aggregates.
+    """
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            rows = drifted(conn)
+
+            for mid, title, stored_sum, stored_count, sum_, count in rows[:SHOW]:
+                print("%8d %-40s stored %d/%d, actual %d/%d" % (
+                    mid, (title or "")[:40], stored_sum, stored_count, sum_, count))
+
+            if len(rows) > SHOW:
+                print("... and %d more" % (len(rows) - SHOW))
+
+            print("%d movie(s) drifted" % len(rows))
+
+            if "--repair" in sys.argv[1:] and rows:
+                print("Repaired %d movie(s)" % repair(conn))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Buffered, paged terminal rendering of query results.
+Team Peacock.
+
+Each page of records is formatted into one string and written to the
+terminal in a single write, instead of one print per field (which over SSH
+means one small packet per line). Long arrays (cast lists) are truncated.
+Records are pulled from the result iterator one page at a time and the user
+is asked before the next page is formatted, so stopping early costs nothing.
+"""
+
+
+import sys
+from datetime import date, datetime
+
+
+PAGE_SIZE = 20
+MAX_ITEMS = 5
+# array elements shown before "(+N more)"
+
+
+def format_value(value, max_items: int = MAX_ITEMS) -> str:
+    """
+    Formats one field; arrays are joined and truncated.
+    """
+
+    if isinstance(value, (list, tuple)):
+        items = [str(item) for item in value[:max_items] if item is not None]
+        extra = len(value) - max_items
+        return ", ".join(items) + (" (+%d more)" % extra if extra > 0 else "")
+
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M")
+
+    if isinstance(value, date):
+        return value.isoformat()
+
+    return str(value)
+
+
+def format_record(title: str, number: int, record: tuple, labels: tuple) -> str:
+    """
+    Formats one record as its heading and one "label value" line per field.
+    """
+
+    lines = ["\n" + title + " #" + str(number)]
+
+    for label, value in zip(labels, record):
+        if label is not None:
+            lines.append(label + " " + format_value(value))
+
+    return "\n".join(lines) + "\n"
+
+
+def render(rows, title: str, labels: tuple, page_size: int = PAGE_SIZE,
+           out=None, ask=input) -> int:
+    """
+    Writes records page by page, asking before each further page.
+
+    :param rows: any iterable of records (read lazily)
+    :param page_size: records per page; None writes everything at once
+    :param out: text stream (default sys.stdout)
+    :param ask: prompt function (returns "q" to stop paging)
+    :return: the number of records written
+    """
+
+    out = out or sys.stdout
+    rows = iter(rows)
+    count = 0
+    page = []
+    record = next(rows, None)
+
+    while record is not None:
+        count += 1
+        page.append(format_record(title, count, record, labels))
+        record = next(rows, None)
+
+        if page_size is not None and len(page) == page_size and record is not None:
+            out.write("".join(page))
+            out.flush()
+            page = []
+
+            if ask("-- Enter for more, q to stop -- ").strip().lower() == "q":
+                break
+
+    page.append("\n")
+    out.write("".join(page))
+    out.flush()
+    return count
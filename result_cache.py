@@ -0,0 +1,178 @@
+"""
+Shared result cache for non-personalized queries.
+Team Peacock.
+
+Results are kept for a fixed TTL and shared by every session in the process.
+Concurrent misses on the same key are coalesced so only one caller runs the
+query while the others wait for its result (single-flight). An optional
+on-disk backing file keeps the cache warm across restarts.
+"""
+
+
+import os
+import pickle
+import threading
+from time import time
+
+
+class ResultCache:
+    """
+    Process-wide TTL cache with single-flight misses and hit-rate metrics.
+    """
+
+    def __init__(self, ttl: float = 300.0, path: str = None):
+        """
+        :param ttl: seconds a cached result stays valid
+        :param path: optional file used to persist entries across restarts
+        """
+
+        self.ttl = ttl
+        self.path = path
+        self.entries = {}
+        # key -> (expires_at, value)
+        self.in_flight = {}
+        # key -> threading.Event set when the running query finishes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        if path is not None:
+            self.load()
+
+    def get_or_compute(self, key, compute):
+        """
+        Gets a cached result, running compute() on a miss.
+
+        Only one thread runs compute() for a key at a time; other threads that
+        miss on the same key wait for it and share its result.
+        """
+
+        waited = False
+
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+
+                if entry is not None and entry[0] > time():
+                    if not waited:
+                        self.hits += 1
+                        # coalesced lookups were already counted
+                    return entry[1]
+
+                event = self.in_flight.get(key)
+
+                if event is None:
+                    event = threading.Event()
+                    self.in_flight[key] = event
+                    self.misses += 1
+                    break
+                    # this thread runs the query
+
+                if not waited:
+                    self.coalesced += 1
+                    waited = True
+
+            event.wait()
+            # another thread is running the query; use its result once it is
+            # stored (or retry the query if it failed)
+
+        try:
+            value = compute()
+
+            with self.lock:
+                self.entries[key] = (time() + self.ttl, value)
+
+            if self.path is not None:
+                self.save()
+
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def cached(self, name: str):
+        """
+        Decorator caching a query function by name and non-connection args.
+
+        The decorated function must take the database connection as its last
+        positional argument; the connection is not part of the cache key.
+        """
+
+        def decorator(func):
+            def wrapper(*args):
+                return self.get_or_compute((name,) + args[:-1], lambda: func(*args))
+
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            wrapper.uncached = func
+            return wrapper
+
+        return decorator
+
+    def invalidate(self, key=None) -> None:
+        """
+        Drops one entry, or every entry if no key is given.
+        """
+
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def metrics(self) -> dict:
+        """
+        Gets cache hit/miss counters and the hit rate.
+        """
+
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "entries": len(self.entries),
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+    def load(self) -> None:
+        """
+        Loads unexpired entries from the backing file.
+        """
+
+        now = time()
+
+        try:
+            with open(self.path, "rb") as file:
+                entries = pickle.load(file)
+
+            loaded = {key: entry for key, entry in entries.items() if entry[0] > now}
+        except Exception:
+            return
+            # a missing, truncated or foreign file (which unpickling can
+            # report as almost any exception) just means a cold cache
+
+        with self.lock:
+            self.entries.update(loaded)
+
+    def save(self) -> None:
+        """
+        Writes the entries to the backing file.
+
+        The file is replaced atomically so a crash never leaves a partial
+        cache behind.
+        """
+
+        with self.lock:
+            entries = dict(self.entries)
+
+        tmp_path = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+
+        try:
+            with open(tmp_path, "wb") as file:
+                pickle.dump(entries, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            print("Could not write result cache to " + self.path)
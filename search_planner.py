@@ -0,0 +1,225 @@
+"""
+Selectivity-aware planner for multi-criteria movie searches.
+Team Peacock.
+
+Each filter (e.g. genre=Horror, actor=Price, year>1970) selects a set of
+movie ids. The planner estimates how many movies each filter matches (from
+the Postgres planner's statistics, cached), runs the most selective filter
+first and narrows every later filter to the surviving ids, intersecting
+sorted id arrays as it goes. Only the final ids are handed back for paging
+and hydration.
+"""
+
+
+import re
+import threading
+from array import array
+from time import time
+
+
+# mid-selecting query per field (text fields match anywhere in the name;
+# {op} is the year comparison)
+FILTER_SQL = {
+    "title": "SELECT movie.mid FROM movie WHERE movie.title ILIKE %s",
+    "actor": """SELECT DISTINCT a.mid FROM actsin a JOIN person p ON a.peid = p.peid
+                WHERE (p.firstname ILIKE %s OR p.lastname ILIKE %s
+                OR CONCAT(p.firstname, ' ', p.lastname) ILIKE %s)""",
+    "director": """SELECT DISTINCT d.mid FROM directs d JOIN person p ON d.peid = p.peid
+                WHERE (p.firstname ILIKE %s OR p.lastname ILIKE %s
+                OR CONCAT(p.firstname, ' ', p.lastname) ILIKE %s)""",
+    "studio": """SELECT DISTINCT mm.mid FROM makesmovie mm JOIN producer_studio ps ON mm.prid = ps.prid
+                WHERE ps.name ILIKE %s""",
+    "genre": """SELECT DISTINCT mg.mid FROM moviegenre mg JOIN genre g ON mg.gid = g.gid
+                WHERE g.name ILIKE %s""",
+    "year": """SELECT DISTINCT r.mid FROM release r
+                WHERE EXTRACT(YEAR FROM r.releasedate::date) {op} %s""",
+}
+
+# columns holding the mid in each filter query (for narrowing to candidates)
+MID_COLUMNS = {"title": "movie.mid", "actor": "a.mid", "director": "d.mid",
+               "studio": "mm.mid", "genre": "mg.mid", "year": "r.mid"}
+
+YEAR_OPS = ("=", "<", ">", "<=", ">=")
+
+FILTER_PATTERN = re.compile(r"^\s*(\w+)\s*(<=|>=|=|<|>)\s*(.+?)\s*$")
+
+NARROW_LIMIT = 50000
+# candidate sets up to this size are passed to later filters as = ANY(ids)
+
+
+def parse_filter(text: str) -> tuple:
+    """
+    Parses a filter like "genre=Horror" or "year>1970".
+
+    :return: a (field, op, value) tuple, or None if the filter is invalid
+    """
+
+    found = FILTER_PATTERN.match(text)
+
+    if found is None:
+        return None
+
+    field, op, value = found.group(1).lower(), found.group(2), found.group(3)
+
+    if field not in FILTER_SQL:
+        return None
+
+    if field == "year":
+        if op not in YEAR_OPS or not value.isdigit():
+            return None
+        return field, op, int(value)
+
+    if op != "=":
+        return None
+
+    return field, op, value
+
+
+def compile_filter(field: str, op: str, value) -> tuple:
+    """
+    Builds the mid-selecting query of a filter.
+
+    :return: (query, params)
+    """
+
+    if field == "year":
+        return FILTER_SQL[field].format(op=op), (value,)
+
+    pattern = "%" + value + "%"
+    return FILTER_SQL[field], (pattern,) * FILTER_SQL[field].count("%s")
+
+
+class SelectivityCache:
+    """
+    Cached estimates of how many movies a filter matches.
+
+    Estimates come from EXPLAIN (the planner's table statistics), so they
+    cost one cheap round trip per distinct filter per TTL.
+    """
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+        self.estimates = {}
+        # (field, op, value) -> (expires_at, rows)
+        self.lock = threading.Lock()
+
+    def estimate(self, search_filter: tuple, conn) -> float:
+        """
+        Gets the estimated number of movies matching a filter.
+        """
+
+        key = (search_filter[0], search_filter[1], str(search_filter[2]).lower())
+
+        with self.lock:
+            entry = self.estimates.get(key)
+
+            if entry is not None and entry[0] > time():
+                return entry[1]
+
+        query, params = compile_filter(*search_filter)
+        curs = conn.cursor()
+        curs.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        rows = curs.fetchone()[0][0]["Plan"]["Plan Rows"]
+        curs.close()
+
+        with self.lock:
+            self.estimates[key] = (time() + self.ttl, rows)
+
+        return rows
+
+
+def intersect_sorted(a: array, b: array) -> array:
+    """
+    Intersects two sorted id arrays.
+
+    Walks the shorter array and gallops (exponential then binary search)
+    through the longer one, so a small set against a large one costs
+    O(small * log(large)).
+    """
+
+    if len(a) > len(b):
+        a, b = b, a
+
+    result = array("l")
+    j = 0
+
+    for value in a:
+        step = 1
+
+        while j + step < len(b) and b[j + step] < value:
+            step *= 2
+            # gallop forward
+
+        lo, hi = j, min(j + step, len(b))
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if b[mid] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        j = lo
+
+        if j == len(b):
+            break
+
+        if b[j] == value:
+            result.append(value)
+
+    return result
+
+
+def fetch_mids(search_filter: tuple, conn, candidates: array = None) -> array:
+    """
+    Runs a filter, optionally narrowed to candidate ids.
+
+    :return: the matching mids as a sorted array
+    """
+
+    query, params = compile_filter(*search_filter)
+
+    if candidates is not None:
+        query += f" AND {MID_COLUMNS[search_filter[0]]} = ANY(%s)"
+        params = params + (list(candidates),)
+
+    curs = conn.cursor()
+    curs.execute(f"SELECT mid FROM ({query}) matches ORDER BY mid", params)
+    mids = array("l", (row[0] for row in curs.fetchall()))
+    curs.close()
+    return mids
+
+
+def plan(filters: list, stats: SelectivityCache, conn) -> list:
+    """
+    Orders filters from most to least selective.
+
+    :return: a list of (estimated rows, filter) tuples
+    """
+
+    return sorted(((stats.estimate(f, conn), f) for f in filters), key=lambda pair: pair[0])
+
+
+def matching_mids(filters: list, stats: SelectivityCache, conn) -> array:
+    """
+    Gets the mids matching every filter.
+
+    :return: a sorted array of mids
+    """
+
+    mids = None
+
+    for _, search_filter in plan(filters, stats, conn):
+        if mids is None:
+            mids = fetch_mids(search_filter, conn)
+        elif len(mids) <= NARROW_LIMIT:
+            mids = fetch_mids(search_filter, conn, mids)
+            # the filter only checks the surviving candidates
+        else:
+            mids = intersect_sorted(mids, fetch_mids(search_filter, conn))
+
+        if len(mids) == 0:
+            break
+
+    return mids if mids is not None else array("l")
@@ -0,0 +1,122 @@
+"""
+Per-session memoization of a user's own data.
+Team Peacock.
+
+The collection and friend menus show the user's collections, a collection's
+movies and the friend list every time they are entered, although only the
+user's own writes change them. A SessionState keeps those lists per user
+and key; the write paths update the cached lists in place (or drop an entry
+whose new contents they cannot compute), so menu navigation stops
+re-querying unchanged data.
+
+Cached lists are never mutated: updates store new lists, so a caller still
+holding an older list is unaffected. Entries expire after ttl seconds, which
+bounds how stale a list can get when the same user writes from another
+session or others' ratings change the movie rows. verify() compares the
+cached lists with fresh query results, to check that the write paths keep
+the cache coherent.
+"""
+
+
+import threading
+from time import time
+
+
+class SessionState:
+    """
+    Per-user cache of lists with in-place write-through updates.
+    """
+
+    def __init__(self, ttl: float = 300.0):
+        """
+        :param ttl: seconds a cached list is used before it is re-queried
+        """
+
+        self.ttl = ttl
+        self.entries = {}
+        # (username, key) -> (loaded_at, list)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username: str, key, load) -> list:
+        """
+        Gets a cached list, calling load() if it is missing or expired.
+        """
+
+        with self.lock:
+            entry = self.entries.get((username, key))
+
+            if entry is not None and time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+
+        self.misses += 1
+        loaded_at = time()
+        value = list(load())
+
+        with self.lock:
+            self.entries[(username, key)] = (loaded_at, value)
+
+        return value
+
+    def matching(self, username: str, match) -> list:
+        """
+        Gets the user's entry keys that match (call with the lock held).
+
+        :param match: a key, or a function of a key returning True for a match
+        """
+
+        test = match if callable(match) else (lambda key: key == match)
+        return [k for k in self.entries if k[0] == username and test(k[1])]
+
+    def update(self, username: str, match, func) -> None:
+        """
+        Replaces each matching cached list by func(list).
+
+        func returns None when the new list cannot be computed from the old
+        one; the entry is then dropped.
+        """
+
+        with self.lock:
+            for entry_key in self.matching(username, match):
+                loaded_at, value = self.entries[entry_key]
+                value = func(value)
+
+                if value is None:
+                    del self.entries[entry_key]
+                else:
+                    self.entries[entry_key] = (loaded_at, list(value))
+
+    def drop(self, username: str, match) -> None:
+        """
+        Drops the user's matching entries.
+        """
+
+        with self.lock:
+            for entry_key in self.matching(username, match):
+                del self.entries[entry_key]
+
+    def verify(self, username: str, load) -> list:
+        """
+        Compares the user's cached lists with fresh results.
+
+        Lists are compared as multisets, since ties in a query's ordering
+        may come back in any order.
+
+        :param load: function of a key returning the fresh list
+        :return: a list of (key, cached list, fresh list) for each mismatch
+        """
+
+        with self.lock:
+            cached = [(k[1], entry[1]) for k, entry in self.entries.items() if k[0] == username]
+
+        mismatches = []
+
+        for key, value in cached:
+            fresh = list(load(key))
+
+            if sorted(map(repr, value)) != sorted(map(repr, fresh)):
+                mismatches.append((key, value, fresh))
+
+        return mismatches
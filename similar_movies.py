@@ -0,0 +1,241 @@
+"""
+"More like this" precompute.
+Team Peacock.
+
+Encodes every movie's genres, cast, directors and studios (the attributes
+MOVIE_QUERY aggregates) as a sparse TF-IDF style feature vector, computes the
+top-K cosine neighbours of every movie with batched sparse matrix products
+and stores them in similar_movies (see migrations/0004_similar_movies.sql),
+where PDM_proj.get_similar_movies looks them up.
+
+Usage: python similar_movies.py [--k N] [--batch N]
+"""
+
+
+import io
+import sys
+import psycopg2
+from time import perf_counter
+from PDM_proj import db_params
+
+
+K = 20
+BATCH = 1024
+# maximum movies per similarity product
+PRODUCT_NONZEROS = 1 << 24
+# entries per similarity product (about 200 MB); a batch holding movies
+# with common features (a genre, a big studio) is cut shorter to fit
+COPY_ROWS = 100000
+# rows buffered per COPY
+
+# (feature prefix, weight, query) per attribute; rarer features get a higher
+# IDF weight on top of the attribute weight
+FEATURE_QUERIES = (
+    ("genre", 1.0, "SELECT mid, gid FROM moviegenre"),
+    ("cast", 0.8, "SELECT mid, peid FROM actsin"),
+    ("director", 1.2, "SELECT mid, peid FROM directs"),
+    ("studio", 0.6, "SELECT mid, prid FROM makesmovie"),
+)
+
+
+def load_features(conn) -> tuple:
+    """
+    Builds the L2-normalized movie x feature matrix.
+
+    :return: (CSR matrix, array of mids in row order)
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    curs = conn.cursor()
+    curs.execute("SELECT mid FROM movie ORDER BY mid")
+    mids = np.array([row[0] for row in curs.fetchall()], dtype=np.int64)
+    rows, cols, weights = [], [], []
+    n_features = 0
+
+    for _, weight, query in FEATURE_QUERIES:
+        curs.execute(query)
+        pairs = np.unique(np.array(curs.fetchall(), dtype=np.int64).reshape(-1, 2), axis=0)
+        # a credit listed twice still counts once
+
+        if len(pairs) == 0:
+            continue
+
+        row_index = np.searchsorted(mids, pairs[:, 0])
+        valid = (row_index < len(mids)) & (mids[np.minimum(row_index, len(mids) - 1)] == pairs[:, 0])
+        features, col_index = np.unique(pairs[valid, 1], return_inverse=True)
+        rows.append(row_index[valid])
+        cols.append(col_index + n_features)
+        weights.append(np.full(valid.sum(), weight))
+        n_features += len(features)
+
+    curs.close()
+
+    if n_features == 0:
+        return sparse.csr_matrix((len(mids), 0)), mids
+
+    matrix = sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(mids), n_features))
+    df = np.bincount(matrix.indices, minlength=n_features)
+    idf = np.log((1 + len(mids)) / (1 + df)) + 1
+    matrix = matrix.multiply(idf).tocsr()
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.diags(1 / norms) @ matrix
+    return matrix.tocsr(), mids
+
+
+def product_batches(matrix, batch: int, budget: int):
+    """
+    Splits the rows into runs whose products with the whole matrix hold at
+    most budget entries (and at most batch rows).
+
+    A row's product has at most one entry per row sharing one of its
+    features, bounded by the sum of its features' document frequencies, so
+    a run can be sized before its product is computed. A row over budget on
+    its own gets a run of one (at most one entry per row of the matrix).
+
+    :return: a list of (start, end) row ranges
+    """
+
+    import numpy as np
+
+    rows = matrix.shape[0]
+    frequencies = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    pattern = matrix.copy()
+    pattern.data = np.ones(len(pattern.data))
+    cost = np.minimum(pattern @ frequencies, rows)
+    bounds = np.cumsum(cost)
+    runs = []
+    start = 0
+
+    while start < rows:
+        spent = bounds[start - 1] if start else 0
+        end = int(np.searchsorted(bounds, spent + budget, side="right"))
+        end = min(max(end, start + 1), start + batch, rows)
+        runs.append((start, end))
+        start = end
+
+    return runs
+
+
+def top_k_neighbours(matrix, k: int, batch: int, budget: int = PRODUCT_NONZEROS):
+    """
+    Yields (row, neighbour rows, scores) for every movie.
+
+    Similarities are computed a run of rows at a time as a sparse product
+    with the whole matrix (see product_batches), so each product holds at
+    most budget entries however widely the features are shared, and is
+    pruned to each row's top k before the next run.
+    """
+
+    import numpy as np
+
+    transposed = matrix.T.tocsc()
+
+    for start, end in product_batches(matrix, batch, budget):
+        product = (matrix[start:end] @ transposed).tocsr()
+        product.setdiag(0, k=start)
+        # a movie is not similar to itself
+        product.eliminate_zeros()
+
+        for i in range(product.shape[0]):
+            lo, hi = product.indptr[i], product.indptr[i + 1]
+            scores = product.data[lo:hi]
+            cols = product.indices[lo:hi]
+
+            if len(scores) > k:
+                best = np.argpartition(-scores, k)[:k]
+                scores, cols = scores[best], cols[best]
+
+            order = np.argsort(-scores, kind="stable")
+            yield start + i, cols[order], scores[order]
+
+
+def store(neighbours, mids, conn) -> int:
+    """
+    Replaces similar_movies with the computed neighbours (using COPY).
+
+    Rows are copied in chunks of COPY_ROWS into a staging table while the
+    neighbours are computed, then replace the old ones with one DELETE and
+    INSERT, so readers are never blocked and keep seeing the old neighbours
+    until the transaction commits.
+
+    :return: the number of rows written
+    """
+
+    curs = conn.cursor()
+    curs.execute("CREATE TEMP TABLE similar_movies_staging (LIKE similar_movies) ON COMMIT DROP")
+    buffer = io.StringIO()
+    buffered = 0
+    count = 0
+
+    for row, cols, scores in neighbours:
+        for rank, (col, score) in enumerate(zip(cols, scores), 1):
+            buffer.write("%d\t%d\t%d\t%.6f\n" % (mids[row], rank, mids[col], score))
+
+        buffered += len(cols)
+        count += len(cols)
+
+        if buffered >= COPY_ROWS:
+            copy_rows(buffer, curs)
+            buffer = io.StringIO()
+            buffered = 0
+
+    copy_rows(buffer, curs)
+    curs.execute("DELETE FROM similar_movies")
+    curs.execute("""INSERT INTO similar_movies (mid, rank, similar_mid, score)
+                 SELECT mid, rank, similar_mid, score FROM similar_movies_staging""")
+    conn.commit()
+    curs.close()
+    return count
+
+
+def copy_rows(buffer: io.StringIO, curs) -> None:
+    """
+    Copies buffered similar_movies rows into the staging table.
+    """
+
+    buffer.seek(0)
+    curs.copy_expert("COPY similar_movies_staging (mid, rank, similar_mid, score) FROM STDIN", buffer)
+
+
+def main() -> None:
+    """
+    Recomputes similar_movies.
+    """
+
+    k = K
+    batch = BATCH
+    args = sys.argv[1:]
+
+    try:
+        if "--k" in args:
+            k = int(args[args.index("--k") + 1])
+        if "--batch" in args:
+            batch = int(args[args.index("--batch") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            began = perf_counter()
+            matrix, mids = load_features(conn)
+            print("Encoded %d movies x %d features in %.1fs" % (
+                matrix.shape[0], matrix.shape[1], perf_counter() - began))
+
+            began = perf_counter()
+            count = store(top_k_neighbours(matrix, k, batch), mids, conn)
+            print("Stored %d neighbours in %.1fs" % (count, perf_counter() - began))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+In-memory follow graph for "people you may know".
+Team Peacock.
+
+The friends table is loaded in bulk into a CSR adjacency structure (a row
+offset array and one flat array of followed user indexes). Follows and
+unfollows made since the load override individual rows until there are
+enough of them to rebuild the CSR arrays.
+
+Suggestions are the users followed by the most of a user's follows: the
+2-hop neighbourhood is gathered with one vectorized index and counted with
+bincount. The expansion is bounded; when a user follows more than
+MAX_EXPANSION second-hop edges' worth of people, the follows with the
+fewest follows of their own are expanded first (very widely following
+accounts say little about who a user knows).
+"""
+
+
+import threading
+
+
+MAX_EXPANSION = 2000000
+# second-hop edges counted per suggestion
+COMPACT_AT = 1024
+# overridden rows at which the CSR arrays are rebuilt
+
+
+class SocialGraph:
+    """
+    CSR follow graph (username1 follows username2) with incremental updates.
+    """
+
+    def __init__(self):
+        import numpy as np
+
+        self.names = []
+        # user index -> username
+        self.index = {}
+        # username -> user index
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.overrides = {}
+        # user index -> sorted array of follows changed since the last build
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def user(self, username: str) -> int:
+        """
+        Gets a user's index, adding the user if new (caller holds the lock).
+        """
+
+        found = self.index.get(username)
+
+        if found is None:
+            found = self.index[username] = len(self.names)
+            self.names.append(username)
+
+        return found
+
+    def load(self, rows) -> None:
+        """
+        Bulk-loads (username1, username2) follow rows, replacing the graph.
+        """
+
+        import numpy as np
+
+        index = {}
+        sources = []
+        targets = []
+
+        for username1, username2 in rows:
+            sources.append(index.setdefault(username1, len(index)))
+            targets.append(index.setdefault(username2, len(index)))
+
+        with self.lock:
+            self.index = index
+            self.names = list(index)
+            # dicts keep insertion order, so names[i] has index i
+            self.build(np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int32))
+
+    def build(self, sources, targets) -> None:
+        """
+        Builds the CSR arrays from edge arrays (caller holds the lock).
+        """
+
+        import numpy as np
+
+        order = np.lexsort((targets, sources))
+        counts = np.bincount(sources, minlength=len(self.names))
+        self.indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.indices = targets[order]
+        self.overrides = {}
+
+    def follows_locked(self, user: int):
+        """
+        Gets the sorted follows of a user index (caller holds the lock).
+        """
+
+        override = self.overrides.get(user)
+
+        if override is not None:
+            return override
+
+        if user + 1 >= len(self.indptr):
+            return self.indices[:0]
+            # joined since the last build
+
+        return self.indices[self.indptr[user]:self.indptr[user + 1]]
+
+    def update(self, username1: str, username2: str, following: bool) -> None:
+        """
+        Records a follow (following=True) or unfollow.
+        """
+
+        import numpy as np
+
+        with self.lock:
+            user = self.user(username1)
+            friend = self.user(username2)
+            follows = self.follows_locked(user)
+
+            if following:
+                follows = np.union1d(follows, np.array([friend], dtype=np.int32))
+            else:
+                follows = follows[follows != friend]
+
+            self.overrides[user] = follows.astype(np.int32)
+
+            if len(self.overrides) >= COMPACT_AT:
+                self.compact_locked()
+
+    def compact_locked(self) -> None:
+        """
+        Folds the overridden rows into new CSR arrays (caller holds the lock).
+        """
+
+        import numpy as np
+
+        rows = [self.follows_locked(user) for user in range(len(self.names))]
+        sources = np.repeat(np.arange(len(rows), dtype=np.int64), [len(row) for row in rows])
+        targets = np.concatenate(rows).astype(np.int32) if rows else self.indices[:0]
+        self.build(sources, targets)
+
+    def suggest(self, username: str, k: int = 10) -> list:
+        """
+        Gets the users most followed by a user's follows.
+
+        :return: up to k (username, mutual follow count) tuples, most first
+        """
+
+        import numpy as np
+
+        with self.lock:
+            user = self.index.get(username)
+
+            if user is None:
+                return []
+
+            follows = self.follows_locked(user)
+
+            if len(follows) == 0:
+                return []
+
+            changed = self.changed_locked(follows)
+            degrees = self.degrees_locked(follows, changed)
+
+            if degrees.sum() > MAX_EXPANSION:
+                order = np.argsort(degrees, kind="stable")
+                kept = order[np.cumsum(degrees[order]) <= MAX_EXPANSION]
+                follows, degrees, changed = follows[kept], degrees[kept], changed[kept]
+                # bounded expansion: the least-connected follows first
+
+            candidates = self.gather_locked(follows, degrees, changed)
+            counts = np.bincount(candidates, minlength=len(self.names))
+            counts[user] = 0
+            counts[follows] = 0
+            # already followed (or self)
+
+            found = np.flatnonzero(counts)
+
+            if len(found) > k:
+                found = found[np.argpartition(-counts[found], k - 1)[:k]]
+
+            found = found[np.lexsort((found, -counts[found]))]
+            return [(self.names[i], int(counts[i])) for i in found]
+
+    def changed_locked(self, users):
+        """
+        Flags the users whose rows are not in the CSR arrays (caller holds the lock).
+        """
+
+        import numpy as np
+
+        changed = users + 1 >= len(self.indptr)
+
+        if self.overrides:
+            changed |= np.isin(users, np.fromiter(self.overrides, dtype=np.int64))
+
+        return changed
+
+    def degrees_locked(self, users, changed):
+        """
+        Gets the follow counts of several users (caller holds the lock).
+        """
+
+        import numpy as np
+
+        stored = users[~changed]
+        degrees = np.zeros(len(users), dtype=np.int64)
+        degrees[~changed] = self.indptr[stored + 1] - self.indptr[stored]
+        degrees[changed] = [len(self.follows_locked(u)) for u in users[changed]]
+        return degrees
+
+    def gather_locked(self, users, degrees, changed):
+        """
+        Concatenates the follows of several users (caller holds the lock).
+        """
+
+        import numpy as np
+
+        stored = ~changed
+        starts = self.indptr[users[stored]]
+        lengths = degrees[stored]
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        # one fancy index gathers every unchanged user's CSR row
+        parts = [self.indices[positions]]
+        parts.extend(self.follows_locked(u) for u in users[changed])
+        return np.concatenate(parts)
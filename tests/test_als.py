@@ -0,0 +1,35 @@
+"""
+ALS interaction matrix tests.
+Team Peacock.
+"""
+
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+from als import build_matrix, solve_rows
+
+
+def test_zero_strength_pairs_are_not_observed():
+    matrix, users, mids = build_matrix([("a", 1, 0.0), ("b", 2, 3.0), ("a", 2, 0.0)])
+
+    assert matrix.nnz == 1
+    assert matrix[users.index("b"), list(mids).index(2)] == 3.0
+
+
+def test_low_rating_only_user_keeps_zero_factors():
+    matrix, users, mids = build_matrix([("a", 1, 0.0), ("b", 1, 2.0), ("b", 2, 1.0)])
+    fixed = np.ones((len(mids), 4), dtype=np.float32)
+    factors = solve_rows(matrix, fixed, 0.05, 10.0)
+
+    assert not factors[users.index("a")].any()
+    assert factors[users.index("b")].any()
+
+
+def test_repeated_pairs_are_summed():
+    matrix, users, mids = build_matrix([("a", 1, 1.0), ("a", 1, 2.0)])
+
+    assert matrix.nnz == 1
+    assert matrix[0, 0] == 3.0
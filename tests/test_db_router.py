@@ -0,0 +1,149 @@
+"""
+Read/write routing tests.
+Team Peacock.
+
+The routing tests against real servers need a primary and at least one
+streaming replica of it (see "Replica routing" in the README); they are
+skipped unless PDM_DSN and PDM_REPLICA_DSNS are set.
+"""
+
+
+import os
+import pytest
+from db_router import Router
+
+
+PRIMARY = os.environ.get("PDM_DSN")
+REPLICAS = [dsn.strip() for dsn in os.environ.get("PDM_REPLICA_DSNS", "").split(",") if dsn.strip()]
+
+needs_replicas = pytest.mark.skipif(not (PRIMARY and REPLICAS),
+                                    reason="needs PDM_DSN and PDM_REPLICA_DSNS")
+
+
+class FakeCursor:
+    def execute(self, query: str, params: tuple = None) -> None:
+        self.query = query
+
+    def fetchone(self) -> tuple:
+        return ("0/16B3748",)
+
+    def close(self) -> None:
+        pass
+
+
+class FakeConnection:
+    def __init__(self, autocommit: bool = False):
+        self.autocommit = autocommit
+        self.commits = 0
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor()
+
+    def commit(self) -> None:
+        self.commits += 1
+
+
+def noop_write(username: str, conn) -> str:
+    return "written"
+
+
+def test_write_ends_the_lsn_transaction():
+    router = Router(["replica"], None)
+    conn = FakeConnection()
+
+    assert router.write(noop_write, ("ann", conn), {}, "ann") == "written"
+    assert conn.commits == 1
+    assert router.pending["ann"][0] == "0/16B3748"
+
+
+def test_write_leaves_autocommit_connections_alone():
+    router = Router(["replica"], None)
+    conn = FakeConnection(autocommit=True)
+    router.write(noop_write, ("ann", conn), {}, "ann")
+
+    assert conn.commits == 0
+
+
+@pytest.fixture
+def primary():
+    """
+    A primary connection with a scratch router_test table.
+    """
+
+    import psycopg2
+
+    conn = psycopg2.connect(PRIMARY)
+    curs = conn.cursor()
+    curs.execute("DROP TABLE IF EXISTS router_test")
+    curs.execute("CREATE TABLE router_test (username VARCHAR, n INTEGER)")
+    conn.commit()
+    yield conn
+    curs.execute("DROP TABLE IF EXISTS router_test")
+    conn.commit()
+    conn.close()
+
+
+def add_row(username: str, conn) -> None:
+    curs = conn.cursor()
+    curs.execute("INSERT INTO router_test (username, n) VALUES (%s, 1)", (username,))
+    conn.commit()
+    curs.close()
+
+
+def count_rows(username: str, conn) -> int:
+    curs = conn.cursor()
+    curs.execute("SELECT count(*) FROM router_test WHERE username = %s", (username,))
+    count = curs.fetchone()[0]
+    curs.close()
+    return count
+
+
+def in_recovery(conn) -> bool:
+    curs = conn.cursor()
+    curs.execute("SELECT pg_is_in_recovery()")
+    recovering = curs.fetchone()[0]
+    curs.close()
+    return recovering
+
+
+@needs_replicas
+def test_reads_without_user_go_to_a_replica(primary):
+    import psycopg2
+
+    router = Router(REPLICAS, psycopg2.connect)
+
+    try:
+        assert router.read(in_recovery, (primary,), {}) is True
+        assert router.replica_reads == 1
+    finally:
+        router.close()
+
+
+@needs_replicas
+def test_reads_follow_the_users_writes(primary):
+    import psycopg2
+
+    router = Router(REPLICAS, psycopg2.connect)
+
+    try:
+        for i in range(1, 21):
+            router.write(add_row, ("ann", primary), {}, "ann")
+
+            assert router.read(count_rows, ("ann", primary), {}, "ann") == i
+    finally:
+        router.close()
+
+
+@needs_replicas
+def test_write_leaves_primary_idle(primary):
+    import psycopg2
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+    router = Router(REPLICAS, psycopg2.connect)
+
+    try:
+        router.write(add_row, ("ann", primary), {}, "ann")
+
+        assert primary.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    finally:
+        router.close()
@@ -0,0 +1,85 @@
+"""
+Prefetcher tests.
+Team Peacock.
+"""
+
+
+import pytest
+import prefetch
+from prefetch import Prefetcher
+
+
+class FakeConnection:
+    autocommit = False
+    closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prefetch, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def prefetcher():
+    prefetcher = Prefetcher(FakeConnection, max_age=10)
+    yield prefetcher
+    prefetcher.close()
+
+
+def counter():
+    """
+    A query function returning how often it has run.
+    """
+
+    runs = []
+
+    def query(conn):
+        runs.append(1)
+        return len(runs)
+
+    return query
+
+
+def test_take_uses_fresh_result(clock, prefetcher):
+    query = counter()
+    prefetcher.prefetch("collections", query)
+    clock[0] += 5
+
+    assert prefetcher.take("collections", query, conn=None) == 1
+    assert (prefetcher.hits, prefetcher.misses) == (1, 0)
+
+
+def test_take_requeries_expired_result(clock, prefetcher):
+    query = counter()
+    prefetcher.prefetch("collections", query)
+    prefetcher.cache["collections"][1].result()
+    clock[0] += 11
+
+    assert prefetcher.take("collections", query, conn=None) == 2
+    assert (prefetcher.hits, prefetcher.misses, prefetcher.expired) == (0, 1, 1)
+
+
+def test_prefetch_restarts_expired_result(clock, prefetcher):
+    query = counter()
+    prefetcher.prefetch("collections", query)
+    prefetcher.cache["collections"][1].result()
+    clock[0] += 11
+    prefetcher.prefetch("collections", query)
+
+    assert prefetcher.take("collections", query, conn=None) == 2
+    assert prefetcher.hits == 1
+
+
+def test_invalidate_drops_results(clock, prefetcher):
+    query = counter()
+    prefetcher.prefetch("collections", query)
+    prefetcher.cache["collections"][1].result()
+    prefetcher.invalidate()
+
+    assert prefetcher.take("collections", query, conn=None) == 2
+    assert prefetcher.misses == 1
@@ -0,0 +1,370 @@
+"""
+Session cache coherence tests.
+Team Peacock.
+
+Checks SessionState itself, and that the write functions' in-place updates
+of the cached collections, collection movies and friends match what a
+fresh query returns afterwards. The database is replaced by an in-memory
+model answering the same reads and writes.
+"""
+
+
+import pytest
+import session_state
+import PDM_proj
+from session_state import SessionState
+
+
+def test_get_loads_once():
+    state = SessionState()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [(1,)]
+
+    assert state.get("ann", "friends", load) == [(1,)]
+    assert state.get("ann", "friends", load) == [(1,)]
+    assert len(loads) == 1
+    assert (state.hits, state.misses) == (1, 1)
+
+
+def test_entries_are_per_user():
+    state = SessionState()
+    state.get("ann", "friends", lambda: [("bob",)])
+
+    assert state.get("bob", "friends", lambda: [("ann",)]) == [("ann",)]
+
+
+def test_get_reloads_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(session_state, "time", lambda: now[0])
+    state = SessionState(ttl=10)
+    state.get("ann", "friends", lambda: [("bob",)])
+    now[0] += 5
+
+    assert state.get("ann", "friends", lambda: [("carl",)]) == [("bob",)]
+
+    now[0] += 10
+
+    assert state.get("ann", "friends", lambda: [("carl",)]) == [("carl",)]
+
+
+def test_update_replaces_matching_lists():
+    state = SessionState()
+    state.get("ann", ("collection", 1, 0, "a"), lambda: [(1,), (2,)])
+    state.get("ann", ("collection", 1, 1, "d"), lambda: [(2,), (1,)])
+    state.get("ann", ("collection", 2, 0, "a"), lambda: [(2,)])
+    old = state.get("ann", ("collection", 1, 0, "a"), list)
+    state.update("ann", lambda key: key[:2] == ("collection", 1), lambda rows: [r for r in rows if r[0] != 2])
+
+    assert state.get("ann", ("collection", 1, 0, "a"), list) == [(1,)]
+    assert state.get("ann", ("collection", 1, 1, "d"), list) == [(1,)]
+    assert state.get("ann", ("collection", 2, 0, "a"), list) == [(2,)]
+    assert old == [(1,), (2,)]
+    # lists handed out earlier are not mutated
+
+
+def test_update_skips_missing_entries():
+    state = SessionState()
+    state.update("ann", "friends", lambda rows: rows + [("bob",)])
+
+    assert state.get("ann", "friends", lambda: []) == []
+
+
+def test_drop_forces_reload():
+    state = SessionState()
+    state.get("ann", "collections", lambda: [(1, "a", 0, 0)])
+    state.get("ann", "friends", lambda: [("bob",)])
+    state.drop("ann", "collections")
+
+    assert state.get("ann", "collections", lambda: []) == []
+    assert state.get("ann", "friends", lambda: []) == [("bob",)]
+
+
+def test_verify_reports_mismatches():
+    state = SessionState()
+    state.get("ann", "friends", lambda: [("bob",), ("carl",)])
+    state.get("ann", "collections", lambda: [(1, "a", 0, 0)])
+    fresh = {"friends": [("carl",), ("bob",)], "collections": [(1, "b", 0, 0)]}
+
+    assert state.verify("ann", fresh.get) == [("collections", [(1, "a", 0, 0)], [(1, "b", 0, 0)])]
+
+
+class FakeDatabase:
+    """
+    In-memory collections, collection movies and friends.
+    """
+
+    def __init__(self):
+        self.movies = {10: 90, 11: 120, 12: None, 13: 75}
+        # mid -> length
+        self.collections = {1: ["ann", "drama"], 2: ["ann", "Comedy"], 3: ["bob", "other"]}
+        self.contents = {(1, 10), (1, 11), (3, 13)}
+        self.friends = {("ann", "bob")}
+
+    def movie(self, mid: int) -> tuple:
+        return (mid, "Movie %d" % mid, [], [], [], self.movies[mid], "PG", [], [], None)
+
+    def execute_write(self, query: str, params: tuple, conn) -> int:
+        if query.startswith("INSERT INTO collection ("):
+            self.collections[max(self.collections) + 1] = [params[1], params[0]]
+        elif query.startswith("DELETE FROM collection "):
+            return 1 if self.collections.pop(params[0], None) else 0
+        elif query.startswith("UPDATE collection SET name"):
+            self.collections[params[1]][1] = params[0]
+        elif query.startswith("INSERT INTO collectionmovies"):
+            if params in self.contents:
+                return 0
+            self.contents.add(params)
+        elif query.startswith("DELETE FROM collectionmovies"):
+            if params not in self.contents:
+                return 0
+            self.contents.remove(params)
+        elif query.startswith("INSERT INTO friends"):
+            self.friends.add(params)
+        elif query.startswith("DELETE FROM friends"):
+            if params not in self.friends:
+                return 0
+            self.friends.remove(params)
+        else:
+            raise AssertionError("unexpected write " + query)
+
+        return 1
+
+    def get_collections(self, username: str, conn) -> list:
+        rows = []
+
+        for cid, (owner, name) in self.collections.items():
+            if owner == username:
+                mids = [mid for c, mid in self.contents if c == cid]
+                lengths = [self.movies[mid] for mid in mids if self.movies[mid] is not None]
+
+                if not mids:
+                    rows.append((cid, name, 0, 0))
+                else:
+                    rows.append((cid, name, len(mids), sum(lengths) if lengths else None))
+                    # SUM ignores NULLs and is NULL if all are
+
+        return sorted(rows, key=lambda row: row[1].lower())
+        # a case-insensitive collation, unlike Python's default ordering
+
+    def get_friends(self, username: str, conn) -> list:
+        return sorted((friend,) for user, friend in self.friends if user == username)
+
+    def find_from_collection(self, username: str, collection: tuple, sort_op: int, order_by: str, conn) -> list:
+        rows = [self.movie(mid) for c, mid in self.contents if c == collection[0]]
+        return sorted(rows, key=lambda row: row[0], reverse=order_by == "d")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """
+    Points PDM_proj's session cache at a FakeDatabase.
+    """
+
+    fake = FakeDatabase()
+    monkeypatch.setattr(PDM_proj, "SESSION_STATE", SessionState())
+    monkeypatch.setattr(PDM_proj, "VERIFY_SESSION", False)
+    monkeypatch.setattr(PDM_proj, "ROUTER", None)
+    monkeypatch.setattr(PDM_proj, "PREFETCHER", None)
+    monkeypatch.setattr(PDM_proj, "SOCIAL_GRAPH", None)
+    monkeypatch.setattr(PDM_proj, "WRITE_COMMITTER", None)
+    monkeypatch.setattr(PDM_proj, "execute_write", fake.execute_write)
+    monkeypatch.setattr(PDM_proj, "get_collections", fake.get_collections)
+    monkeypatch.setattr(PDM_proj, "get_friends", fake.get_friends)
+    monkeypatch.setattr(PDM_proj, "find_from_collection", fake.find_from_collection)
+    return fake
+
+
+def warm(username: str, db) -> None:
+    """
+    Loads every cached list the menus would show.
+    """
+
+    PDM_proj.session_collections(username, None)
+    PDM_proj.session_friends(username, None)
+
+    for cid, (owner, _) in db.collections.items():
+        if owner == username:
+            PDM_proj.session_collection_movies(username, (cid,), 0, "a", None)
+            PDM_proj.session_collection_movies(username, (cid,), 0, "d", None)
+
+
+def assert_coherent(username: str, db) -> None:
+    """
+    Checks that every cached list equals a fresh query, in order.
+    """
+
+    def load(key):
+        if key == "collections":
+            return db.get_collections(username, None)
+        if key == "friends":
+            return db.get_friends(username, None)
+        return db.find_from_collection(username, (key[1],), key[2], key[3], None)
+
+    state = PDM_proj.SESSION_STATE
+    cached = {key[1]: entry[1] for key, entry in state.entries.items() if key[0] == username}
+
+    for key, value in cached.items():
+        assert value == load(key), key
+
+
+def test_add_movie_updates_count_and_minutes(db, capsys):
+    warm("ann", db)
+    PDM_proj.add_movie_to_collection("ann", (2,), db.movie(13), None)
+    PDM_proj.add_movie_to_collection("ann", (1,), db.movie(12), None)
+    # a movie without a length adds no minutes
+
+    assert_coherent("ann", db)
+    warm("ann", db)
+    assert_coherent("ann", db)
+
+
+def test_del_movie_updates_count_minutes_and_contents(db, capsys):
+    warm("ann", db)
+    misses = PDM_proj.SESSION_STATE.misses
+    PDM_proj.del_movie_from_collection("ann", (1,), db.movie(11), None)
+
+    assert_coherent("ann", db)
+    warm("ann", db)
+    assert PDM_proj.SESSION_STATE.misses == misses
+    # the deletion was applied in place, nothing is re-queried
+    PDM_proj.del_movie_from_collection("ann", (1,), db.movie(10), None)
+    assert_coherent("ann", db)
+
+
+def test_minutes_keep_sql_nulls(db, capsys):
+    warm("ann", db)
+    PDM_proj.add_movie_to_collection("ann", (2,), db.movie(12), None)
+    # only a movie without a length: SUM is NULL
+
+    assert_coherent("ann", db)
+    assert [row[3] for row in PDM_proj.session_collections("ann", None) if row[0] == 2] == [None]
+
+    PDM_proj.add_movie_to_collection("ann", (2,), db.movie(13), None)
+    assert_coherent("ann", db)
+
+    PDM_proj.del_movie_from_collection("ann", (2,), db.movie(13), None)
+    # back to NULL, which the cached sum cannot tell from 0
+    assert_coherent("ann", db)
+    warm("ann", db)
+    assert_coherent("ann", db)
+
+    PDM_proj.del_movie_from_collection("ann", (2,), db.movie(12), None)
+    assert_coherent("ann", db)
+
+
+def test_update_can_drop_entries():
+    state = SessionState()
+    state.get("ann", "collections", lambda: [(1, "a", 0, 0)])
+    state.update("ann", "collections", lambda rows: None)
+
+    assert not state.matching("ann", "collections")
+
+
+def test_failed_write_leaves_cache(db, capsys):
+    warm("ann", db)
+    PDM_proj.del_movie_from_collection("ann", (2,), db.movie(10), None)
+
+    assert "Something went wrong" in capsys.readouterr().out
+    assert_coherent("ann", db)
+
+
+def test_rename_collection_keeps_database_order(db, capsys):
+    warm("ann", db)
+    PDM_proj.rename_collection("ann", (1,), "action", None)
+    warm("ann", db)
+
+    assert_coherent("ann", db)
+    assert [row[1] for row in PDM_proj.session_collections("ann", None)] == ["action", "Comedy"]
+
+
+def test_add_and_del_collection(db, capsys):
+    warm("ann", db)
+    PDM_proj.add_collection("ann", "Westerns", None)
+    warm("ann", db)
+    assert_coherent("ann", db)
+
+    PDM_proj.del_collection("ann", (1, "drama"), None)
+    assert_coherent("ann", db)
+    assert not PDM_proj.SESSION_STATE.matching("ann", PDM_proj.collection_movie_keys(1))
+
+
+def test_follow_and_unfollow(db, capsys):
+    warm("ann", db)
+    PDM_proj.follow("ann", ("carl",), None)
+    assert_coherent("ann", db)
+
+    PDM_proj.unfollow("ann", ("bob",), None)
+    assert_coherent("ann", db)
+    assert PDM_proj.session_friends("ann", None) == [("carl",)]
+
+
+def test_writes_do_not_touch_other_users(db, capsys):
+    warm("ann", db)
+    warm("bob", db)
+    PDM_proj.add_movie_to_collection("ann", (1,), db.movie(13), None)
+    PDM_proj.follow("ann", ("carl",), None)
+
+    assert_coherent("bob", db)
+
+
+class QueuedCommitter:
+    """
+    Stands in for an async GroupCommitter whose writes complete on demand.
+    """
+
+    durability = "async"
+
+    def __init__(self):
+        self.callbacks = []
+
+    def when_done(self, func) -> None:
+        self.callbacks.append(func)
+
+    def complete(self, rowcount, error) -> None:
+        for func in self.callbacks:
+            func(rowcount, error)
+
+        self.callbacks = []
+
+
+class RecordingGraph:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, username1: str, username2: str, following: bool) -> None:
+        self.updates.append((username1, username2, following))
+
+
+def test_queued_write_drops_instead_of_updating(db, monkeypatch, capsys):
+    committer = QueuedCommitter()
+    graph = RecordingGraph()
+    monkeypatch.setattr(PDM_proj, "WRITE_COMMITTER", committer)
+    monkeypatch.setattr(PDM_proj, "SOCIAL_GRAPH", graph)
+    warm("ann", db)
+    PDM_proj.follow("ann", ("carl",), None)
+
+    assert not PDM_proj.SESSION_STATE.matching("ann", "friends")
+    assert graph.updates == []
+
+    PDM_proj.session_friends("ann", None)
+    committer.complete(1, None)
+
+    assert not PDM_proj.SESSION_STATE.matching("ann", "friends")
+    # a list reloaded before the commit is dropped again
+    assert graph.updates == [("ann", "carl", True)]
+
+
+def test_failed_queued_write_leaves_graph(db, monkeypatch, capsys):
+    committer = QueuedCommitter()
+    graph = RecordingGraph()
+    monkeypatch.setattr(PDM_proj, "WRITE_COMMITTER", committer)
+    monkeypatch.setattr(PDM_proj, "SOCIAL_GRAPH", graph)
+    warm("ann", db)
+    PDM_proj.unfollow("ann", ("bob",), None)
+    committer.complete(None, RuntimeError("lost connection"))
+
+    assert graph.updates == []
+    assert not PDM_proj.SESSION_STATE.matching("ann", "friends")
@@ -0,0 +1,55 @@
+"""
+Similarity product batching tests.
+Team Peacock.
+"""
+
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sparse = pytest.importorskip("scipy.sparse")
+
+from similar_movies import product_batches, top_k_neighbours
+
+
+def features(rows: int = 60, seed: int = 3):
+    """
+    A random movie x feature matrix with one feature every movie has.
+    """
+
+    rng = np.random.default_rng(seed)
+    matrix = sparse.random(rows, 40, density=0.1, random_state=rng, format="lil")
+    matrix[:, 0] = 1.0
+    # a near-universal feature, like a common genre
+    return matrix.tocsr()
+
+
+def test_batches_fit_the_budget():
+    matrix = features()
+    runs = product_batches(matrix, 1024, 200)
+
+    assert runs[0][0] == 0 and runs[-1][1] == matrix.shape[0]
+    assert all(a[1] == b[0] for a, b in zip(runs, runs[1:]))
+
+    for start, end in runs:
+        product = matrix[start:end] @ matrix.T
+        assert end - start == 1 or product.nnz <= 200
+
+
+def test_batches_respect_batch_rows():
+    runs = product_batches(features(), 7, 1 << 30)
+
+    assert max(end - start for start, end in runs) == 7
+
+
+def test_neighbours_do_not_depend_on_the_budget():
+    matrix = features()
+    small = list(top_k_neighbours(matrix, 5, 1024, 100))
+    large = list(top_k_neighbours(matrix, 5, 1024, 1 << 30))
+
+    assert [row for row, _, _ in small] == list(range(matrix.shape[0]))
+
+    for (row, cols, scores), (_, big_cols, big_scores) in zip(small, large):
+        assert row not in cols
+        assert np.allclose(scores, big_scores)
+        assert set(cols) == set(big_cols) or len(set(scores)) < len(scores)
@@ -0,0 +1,91 @@
+"""
+ALS recommender trainer.
+Team Peacock.
+
+Reads every user's plays (watches and the monthly rollups) and ratings,
+trains implicit-feedback factors with als.py and saves them to the model
+directory PDM_proj serves recommendations from (PDM_ALS_DIR, default
+als_model/). Run it periodically, e.g. nightly.
+
+Usage: python train_als.py [--factors N] [--iterations N] [--workers N]
+"""
+
+
+import sys
+import psycopg2
+from time import perf_counter
+from als import FACTORS, ITERATIONS, build_matrix, train, save
+from PDM_proj import WATCH_HISTORY, ALS_DIR, db_params
+
+
+RATING_WEIGHT = 0.5
+# strength added per star above the 2.5 midpoint (low ratings add nothing)
+
+INTERACTIONS_QUERY = f"""SELECT username, mid, SUM(plays) FROM {WATCH_HISTORY} W
+                     GROUP BY username, mid
+                     UNION ALL
+                     SELECT username, mid, (rating - 2.5) * {RATING_WEIGHT} FROM rates
+                     WHERE rating > 2.5"""
+
+FETCH_ROWS = 100000
+# rows per round trip of the server-side cursor
+
+
+def load_interactions(conn) -> list:
+    """
+    Reads (username, mid, strength) interactions in bulk.
+    """
+
+    curs = conn.cursor(name="als_interactions")
+    curs.itersize = FETCH_ROWS
+    curs.execute(INTERACTIONS_QUERY)
+    rows = [(username, mid, float(strength)) for username, mid, strength in curs]
+    curs.close()
+    conn.commit()
+    return rows
+
+
+def main() -> None:
+    """
+    Trains and saves the model.
+    """
+
+    factors = FACTORS
+    iterations = ITERATIONS
+    workers = None
+    args = sys.argv[1:]
+
+    try:
+        if "--factors" in args:
+            factors = int(args[args.index("--factors") + 1])
+        if "--iterations" in args:
+            iterations = int(args[args.index("--iterations") + 1])
+        if "--workers" in args:
+            workers = int(args[args.index("--workers") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(1)
+
+    with db_params() as params:
+        conn = psycopg2.connect(**params)
+
+        try:
+            began = perf_counter()
+            rows = load_interactions(conn)
+        finally:
+            conn.close()
+
+    matrix, users, mids = build_matrix(rows)
+    print("Loaded %d interactions (%d users x %d movies) in %.1fs" % (
+        matrix.nnz, len(users), len(mids), perf_counter() - began))
+
+    began = perf_counter()
+    user_factors, item_factors = train(matrix, factors, iterations, workers=workers)
+    print("Trained %d iterations in %.1fs" % (iterations, perf_counter() - began))
+
+    save(ALS_DIR, user_factors, item_factors, users, mids)
+    print("Saved model to " + ALS_DIR)
+
+
+if __name__ == "__main__":
+    main()
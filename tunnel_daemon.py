@@ -0,0 +1,69 @@
+"""
+Shared SSH tunnel daemon.
+Team Peacock.
+
+Keeps one SSH tunnel to the database open and hands its connection
+parameters to PTUI processes over a local socket, so each launch can skip
+the SSH negotiation (see PDM_proj.daemon_params). The socket file is only
+readable by the current user since the parameters include the password.
+
+Usage: python tunnel_daemon.py
+"""
+
+
+import os
+import json
+import socket
+from PDM_proj import db_params, TUNNEL_SOCKET
+
+
+def serve(params: dict) -> None:
+    """
+    Answers every socket connection with the connection parameters.
+    """
+
+    if os.path.exists(TUNNEL_SOCKET):
+        os.remove(TUNNEL_SOCKET)
+        # left over from a daemon that did not shut down cleanly
+
+    payload = json.dumps(params).encode("utf-8")
+    old_umask = os.umask(0o177)
+
+    try:
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(TUNNEL_SOCKET)
+    finally:
+        os.umask(old_umask)
+
+    server.listen()
+    print("Tunnel daemon listening on " + TUNNEL_SOCKET)
+
+    try:
+        while True:
+            client, _ = server.accept()
+
+            with client:
+                client.sendall(payload)
+    finally:
+        server.close()
+        os.remove(TUNNEL_SOCKET)
+
+
+def main() -> None:
+    """
+    Opens the tunnel and serves it until interrupted.
+    """
+
+    if os.path.exists(TUNNEL_SOCKET):
+        os.remove(TUNNEL_SOCKET)
+        # db_params must not attach to a stale daemon socket
+
+    try:
+        with db_params() as params:
+            serve(params)
+    except KeyboardInterrupt:
+        print("Tunnel daemon stopped")
+
+
+if __name__ == "__main__":
+    main()
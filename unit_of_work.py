@@ -0,0 +1,250 @@
+"""
+Unit-of-work layer for database writes.
+Team Peacock.
+
+UnitOfWork defers the commits of everything run through it to a single
+commit at the end of a block. GroupCommitter collects writes from any number
+of sessions/threads onto one connection and commits them in groups, so many
+user actions share one WAL flush.
+"""
+
+
+import queue
+import threading
+from time import monotonic
+from concurrent.futures import Future
+
+
+DURABILITY_MODES = ("strict", "relaxed", "async")
+# strict  - callers wait until their group is committed and flushed
+# relaxed - callers wait for the commit, but it does not wait for the WAL
+#           flush (synchronous_commit = off; a crash can lose the last groups)
+# async   - callers return as soon as the write is queued; the row count is
+#           not known yet and a failed write is only reported (see report)
+
+
+class UnitOfWork:
+    """
+    Connection wrapper that turns commit() into a no-op until the block ends.
+
+    Usable anywhere a connection is expected:
+        with UnitOfWork(conn) as uow:
+            watch_movie(username, movie, uow)
+            ...
+    commits once on exit, or rolls everything back if the block raises.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def commit(self) -> None:
+        pass
+        # deferred to __exit__
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+
+
+class GroupCommitter:
+    """
+    Commits writes from many callers in groups on a dedicated connection.
+
+    A group is closed once max_batch writes are queued or max_delay seconds
+    have passed since its first write, whichever comes first. Each write runs
+    under its own savepoint so a failing write only fails its own caller.
+    """
+
+    def __init__(self, connect, max_delay: float = 0.005, max_batch: int = 256,
+                 durability: str = "strict"):
+        """
+        :param connect: function returning a new psycopg2 connection
+        :param max_delay: latency bound in seconds for a queued write
+        :param max_batch: maximum number of writes per commit
+        :param durability: one of DURABILITY_MODES
+        """
+
+        if durability not in DURABILITY_MODES:
+            raise ValueError("unknown durability mode: " + durability)
+
+        self.connect = connect
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.durability = durability
+        self.pending = queue.Queue()
+        self.groups = 0
+        self.writes = 0
+        self.failed = 0
+        # queued async writes that failed
+        self.last = None
+        # future of the most recently queued write
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, query: str, params: tuple = None) -> Future:
+        """
+        Queues a write.
+
+        :return: a future resolving to the write's row count once committed
+        """
+
+        future = Future()
+        self.last = future
+        self.pending.put((query, params, future))
+        return future
+
+    def execute(self, query: str, params: tuple = None) -> int:
+        """
+        Queues a write and, unless durability is "async", waits for its commit.
+
+        :return: the write's row count (1 in async mode, where it is unknown)
+        """
+
+        future = self.submit(query, params)
+
+        if self.durability == "async":
+            future.add_done_callback(self.report)
+            return 1
+
+        return future.result()
+
+    def report(self, future: Future) -> None:
+        """
+        Reports a failed async write (runs on the committer thread).
+        """
+
+        error = future.exception()
+
+        if error is not None:
+            self.failed += 1
+            print("Queued write failed: " + str(error).strip())
+
+    def when_done(self, func) -> None:
+        """
+        Calls func(row count, error) once the most recently queued write has
+        committed or failed, on the committer thread (or now if it already has).
+        """
+
+        def done(future):
+            error = future.exception()
+            func(None if error is not None else future.result(), error)
+
+        self.last.add_done_callback(done)
+
+    def next_group(self) -> list:
+        """
+        Blocks for the first write and collects a group behind it.
+        """
+
+        group = [self.pending.get()]
+        deadline = monotonic() + self.max_delay
+
+        while len(group) < self.max_batch and group[-1] is not None:
+            remaining = deadline - monotonic()
+
+            try:
+                if remaining > 0:
+                    group.append(self.pending.get(timeout=remaining))
+                else:
+                    group.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        return group
+
+    def open(self):
+        """
+        Opens the committer's connection.
+        """
+
+        conn = self.connect()
+
+        if self.durability != "strict":
+            curs = conn.cursor()
+            curs.execute("SET synchronous_commit TO OFF")
+            conn.commit()
+            curs.close()
+
+        return conn
+
+    def commit_group(self, group: list, conn) -> list:
+        """
+        Runs one group of writes in a single transaction.
+
+        :return: a list of (future, row count, error) tuples
+        """
+
+        results = []
+        curs = conn.cursor()
+
+        for query, params, future in group:
+            try:
+                curs.execute("SAVEPOINT uow_write")
+                curs.execute(query, params)
+                results.append((future, curs.rowcount, None))
+                curs.execute("RELEASE SAVEPOINT uow_write")
+            except Exception as e:
+                curs.execute("ROLLBACK TO SAVEPOINT uow_write")
+                results.append((future, None, e))
+
+        curs.close()
+        conn.commit()
+        return results
+
+    def run(self) -> None:
+        """
+        Commit loop (runs on the committer thread).
+        """
+
+        conn = None
+        stopping = False
+
+        while not stopping:
+            group = self.next_group()
+
+            if group[-1] is None:
+                group.pop()
+                stopping = True
+                # close() was called; commit what is left and exit
+
+            try:
+                if conn is None or conn.closed:
+                    conn = self.open()
+                results = self.commit_group(group, conn)
+            except Exception as e:
+                results = [(future, None, e) for _, _, future in group]
+                # the whole group failed (commit error or lost connection)
+
+                if conn is not None and not conn.closed:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        conn.close()
+
+            self.groups += 1
+            self.writes += len(results)
+
+            for future, rowcount, error in results:
+                if error is None:
+                    future.set_result(rowcount)
+                else:
+                    future.set_exception(error)
+
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def close(self) -> None:
+        """
+        Commits every queued write and stops the committer.
+        """
+
+        self.pending.put(None)
+        self.thread.join()
@@ -0,0 +1,434 @@
+"""
+Write-behind journal for watch events.
+Team Peacock.
+
+watch_movie appends each watch to a local append-only journal (fsynced) and
+returns; a background flusher drains the journal into watches in batches.
+The flusher stores its journal position in the database in the same
+transaction as each batch, so after a crash every journaled watch is
+inserted exactly once. Appends block once too many watches are waiting,
+which pushes back on the caller while the database is slow or unreachable;
+after append_timeout seconds the append gives up and reports the stall.
+
+A batch failing max_attempts times in a row is bisected inside one
+transaction: records the database rejects (e.g. a deleted movie or user)
+are moved to watches.rejected with the error, the rest are inserted.
+
+Journal files are named watches.<generation>.journal. The appender starts a
+new generation once the current file passes rotate_bytes; the flusher
+deletes a generation once it has drained it and a newer one exists.
+"""
+
+
+import os
+import json
+import threading
+from time import monotonic
+from datetime import datetime
+
+
+CHECKPOINT_DDL = """CREATE TABLE IF NOT EXISTS watch_journal_checkpoint (
+                 journal    VARCHAR PRIMARY KEY,
+                 generation BIGINT NOT NULL,
+                 position   BIGINT NOT NULL)"""
+
+
+class WatchJournal:
+    """
+    Durable local journal of watches with a background database flusher.
+    """
+
+    def __init__(self, directory: str, connect, batch_size: int = 500,
+                 flush_interval: float = 0.5, max_pending: int = 10000,
+                 rotate_bytes: int = 1 << 20, max_attempts: int = 5,
+                 append_timeout: float = 30.0):
+        """
+        :param directory: directory holding the journal files
+        :param connect: function returning a new psycopg2 connection
+        :param batch_size: maximum watches inserted per transaction
+        :param flush_interval: seconds the flusher waits for more watches
+        :param max_pending: un-flushed watches at which append() blocks
+        :param rotate_bytes: journal file size that starts a new generation
+        :param max_attempts: failed writes of a batch before it is bisected
+        :param append_timeout: seconds append() waits while the journal is full
+        """
+
+        self.directory = directory
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.rotate_bytes = rotate_bytes
+        self.max_attempts = max_attempts
+        self.append_timeout = append_timeout
+        self.name = os.path.abspath(directory)
+        # checkpoint key, so several journals can share a database
+        self.cond = threading.Condition()
+        self.closing = False
+        self.stopped = threading.Event()
+        # set by close(); cuts short the retry backoff
+        self.flushed = 0
+        self.rejected = 0
+
+        os.makedirs(directory, exist_ok=True)
+        generations = self.generations()
+        self.generation = generations[-1] if generations else 0
+        self.file = open(self.path(self.generation), "ab")
+        self.drop_torn_record()
+        self.pending = sum(self.count_records(g) for g in generations)
+        # an upper bound until the flusher has read its checkpoint
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def path(self, generation: int) -> str:
+        """
+        Gets the file path of a journal generation.
+        """
+
+        return os.path.join(self.directory, "watches.%d.journal" % generation)
+
+    def generations(self) -> list:
+        """
+        Gets the sorted generations present on disk.
+        """
+
+        generations = []
+
+        for name in os.listdir(self.directory):
+            parts = name.split(".")
+
+            if len(parts) == 3 and parts[0] == "watches" and parts[2] == "journal":
+                try:
+                    generations.append(int(parts[1]))
+                except ValueError:
+                    continue
+
+        return sorted(generations)
+
+    def count_records(self, generation: int) -> int:
+        """
+        Counts the complete records in a journal generation.
+        """
+
+        with open(self.path(generation), "rb") as file:
+            return file.read().count(b"\n")
+
+    def drop_torn_record(self) -> None:
+        """
+        Truncates a partially written last record left by a crash.
+
+        A torn record was never fsynced, so its watch was never reported as
+        recorded.
+        """
+
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+
+        if size == 0:
+            return
+
+        with open(self.path(self.generation), "rb") as file:
+            data = file.read()
+
+        end = data.rfind(b"\n") + 1
+
+        if end != size:
+            self.file.truncate(end)
+            os.fsync(self.file.fileno())
+
+    def append(self, username: str, mid: int, watchdate: datetime) -> bool:
+        """
+        Durably records a watch; it reaches the database asynchronously.
+
+        Blocks while max_pending watches are waiting to be flushed, for up to
+        append_timeout seconds.
+
+        :return: whether the watch was recorded
+        """
+
+        record = json.dumps({"username": username, "mid": mid,
+                             "watchdate": watchdate.isoformat()}) + "\n"
+        deadline = monotonic() + self.append_timeout
+
+        with self.cond:
+            while self.pending >= self.max_pending and not self.closing:
+                if monotonic() >= deadline:
+                    print("Watch journal stalled: %d watches are waiting to be flushed" % self.pending)
+                    return False
+
+                self.cond.wait(deadline - monotonic())
+                # backpressure: the database is not keeping up
+
+            if self.file.tell() >= self.rotate_bytes:
+                self.file.close()
+                self.generation += 1
+                self.file = open(self.path(self.generation), "ab")
+
+            self.file.write(record.encode("utf-8"))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending += 1
+            self.cond.notify_all()
+
+        return True
+
+    def read_checkpoint(self, conn) -> tuple:
+        """
+        Gets the flusher's (generation, position) from the database.
+        """
+
+        curs = conn.cursor()
+        curs.execute(CHECKPOINT_DDL)
+        curs.execute("SELECT generation, position FROM watch_journal_checkpoint WHERE journal = %s",
+                     (self.name,))
+        row = curs.fetchone()
+        conn.commit()
+        curs.close()
+
+        if row is None:
+            generations = self.generations()
+            return (generations[0] if generations else 0), 0
+
+        return row
+
+    def read_batch(self, generation: int, position: int) -> tuple:
+        """
+        Reads up to batch_size complete records from a position.
+
+        :return: (list of records, position after the last record)
+        """
+
+        try:
+            with open(self.path(generation), "rb") as file:
+                file.seek(position)
+                lines = []
+
+                while len(lines) < self.batch_size:
+                    line = file.readline()
+
+                    if not line.endswith(b"\n"):
+                        break
+                        # end of file (or a record still being written)
+
+                    lines.append(line)
+                    position += len(line)
+        except FileNotFoundError:
+            return [], position
+
+        return [json.loads(line) for line in lines], position
+
+    def write_batch(self, records: list, generation: int, position: int, conn) -> None:
+        """
+        Inserts a batch and advances the checkpoint in one transaction.
+        """
+
+        from psycopg2.extras import execute_values
+
+        curs = conn.cursor()
+        execute_values(curs, "INSERT INTO watches (username, mid, watchdate) VALUES %s",
+                       [(r["username"], r["mid"], r["watchdate"]) for r in records])
+        curs.execute("""INSERT INTO watch_journal_checkpoint (journal, generation, position)
+                     VALUES (%s, %s, %s) ON CONFLICT (journal) DO UPDATE SET
+                     generation = EXCLUDED.generation, position = EXCLUDED.position""",
+                     (self.name, generation, position))
+        conn.commit()
+        curs.close()
+
+    def write_rejecting(self, records: list, generation: int, position: int, conn) -> None:
+        """
+        Inserts a batch, moving the records the database rejects aside.
+
+        The batch is bisected under savepoints down to the failing records,
+        which are appended (with the error) to watches.rejected before the
+        rest is committed with the checkpoint.
+        """
+
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        curs = conn.cursor()
+        rejected = []
+        parts = [records]
+
+        while parts:
+            part = parts.pop()
+            curs.execute("SAVEPOINT journal_part")
+
+            try:
+                execute_values(curs, "INSERT INTO watches (username, mid, watchdate) VALUES %s",
+                               [(r["username"], r["mid"], r["watchdate"]) for r in part])
+                curs.execute("RELEASE SAVEPOINT journal_part")
+                continue
+            except psycopg2.OperationalError:
+                raise
+                # the connection, not the data: retry the batch later
+            except psycopg2.Error as e:
+                curs.execute("ROLLBACK TO SAVEPOINT journal_part")
+                error = str(e).strip()
+
+            if len(part) == 1:
+                rejected.append(dict(part[0], error=error))
+            else:
+                half = len(part) // 2
+                parts.append(part[half:])
+                parts.append(part[:half])
+
+        if rejected:
+            with open(os.path.join(self.directory, "watches.rejected"), "a", encoding="utf-8") as file:
+                for record in rejected:
+                    file.write(json.dumps(record) + "\n")
+
+                file.flush()
+                os.fsync(file.fileno())
+            # may repeat a record if the commit below fails, never loses one
+
+            print("Watch journal rejected %d watches, see %s" % (
+                len(rejected), os.path.join(self.directory, "watches.rejected")))
+
+        curs.execute("""INSERT INTO watch_journal_checkpoint (journal, generation, position)
+                     VALUES (%s, %s, %s) ON CONFLICT (journal) DO UPDATE SET
+                     generation = EXCLUDED.generation, position = EXCLUDED.position""",
+                     (self.name, generation, position))
+        conn.commit()
+        curs.close()
+
+        with self.cond:
+            self.rejected += len(rejected)
+
+    def drained(self, generation: int, position: int) -> bool:
+        """
+        Checks whether a generation is superseded and read to its end.
+
+        Called holding self.cond, so append() cannot write to the generation
+        or rotate past it meanwhile; once superseded, the file is final.
+        """
+
+        if generation >= self.generation:
+            return False
+
+        try:
+            return os.path.getsize(self.path(generation)) == position
+        except FileNotFoundError:
+            return True
+
+    def run(self) -> None:
+        """
+        Flusher loop (runs on the flusher thread).
+        """
+
+        conn = None
+        checkpoint = None
+        backoff = self.flush_interval
+        failures = 0
+        # consecutive failed attempts at the current checkpoint
+
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = self.connect()
+                    checkpoint = None
+
+                if checkpoint is None:
+                    checkpoint = self.read_checkpoint(conn)
+                    self.recount(*checkpoint)
+
+                generation, position = checkpoint
+                records, end = self.read_batch(generation, position)
+
+                if records:
+                    if failures >= self.max_attempts:
+                        self.write_rejecting(records, generation, end, conn)
+                    else:
+                        self.write_batch(records, generation, end, conn)
+
+                    checkpoint = (generation, end)
+                    backoff = self.flush_interval
+                    failures = 0
+
+                    with self.cond:
+                        self.pending -= len(records)
+                        self.flushed += len(records)
+                        self.cond.notify_all()
+                    continue
+
+                with self.cond:
+                    drained = self.drained(generation, position)
+
+                    if not drained and generation < self.generation:
+                        continue
+                        # records were appended after the read; read them
+
+                if drained:
+                    self.write_batch([], generation + 1, 0, conn)
+                    if os.path.exists(self.path(generation)):
+                        os.remove(self.path(generation))
+                    checkpoint = (generation + 1, 0)
+                    continue
+                    # this generation is drained and a newer one exists
+
+                with self.cond:
+                    if self.closing:
+                        break
+
+                    if self.pending == 0:
+                        self.cond.wait(self.flush_interval)
+
+            except Exception as e:
+                print("Watch journal flush failed (will retry): " + str(e))
+                failures += 1
+
+                if conn is not None and not conn.closed:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        conn.close()
+
+                if self.stopped.wait(backoff):
+                    break
+
+                backoff = min(backoff * 2, 30)
+
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def recount(self, generation: int, position: int) -> None:
+        """
+        Sets the pending count from the checkpoint (watches to replay).
+        """
+
+        pending = 0
+
+        for g in self.generations():
+            if g < generation:
+                continue
+
+            with open(self.path(g), "rb") as file:
+                if g == generation:
+                    file.seek(position)
+                pending += file.read().count(b"\n")
+
+        with self.cond:
+            self.pending = pending
+            self.cond.notify_all()
+
+    def close(self, timeout: float = 10.0) -> None:
+        """
+        Waits (up to timeout seconds) for the journal to drain and stops.
+
+        Anything not flushed by then stays in the journal and is replayed on
+        the next start.
+        """
+
+        deadline = monotonic() + timeout
+
+        with self.cond:
+            while self.pending > 0 and monotonic() < deadline:
+                self.cond.wait(deadline - monotonic())
+
+            self.closing = True
+            self.stopped.set()
+            self.cond.notify_all()
+
+        self.thread.join(timeout=max(deadline - monotonic(), 0) + self.flush_interval)
+        self.file.close()